@@ -0,0 +1,194 @@
+#Imports
+import random
+import time
+from Hub_Protocol import SYNC_BYTE, CTRL_SYNC_BYTE, CTRL_PROBE, CTRL_VERSION, CTRL_NAK, CTRL_BAUD, HELLO_MSG, BAUD_RATES, BAUD_CONFIRM_TIME, crc8, Decode_Event, Frame_Decoder
+
+################################################################################
+#Chance of each byte being corrupted when the serial port runs faster than the
+#arduino can keep up with
+FAST_BAUD_ERROR_RATE = 0.02
+
+################################################################################
+class Arduino_Emulator:
+	"""
+	Models the firmware running on the arduino (rokenbok/rokenbok.ino) and the
+	hub it is plugged into. Bytes the host pc would send over the serial port
+	go in and the bytes the arduino would send back come out. Lets the hub
+	code run without an arduino, for example to benchmark it
+	"""
+	############################################################################
+	def __init__(self, max_baudrate=None, error_rate=0.0, seed=None):
+		"""
+		PURPOSE: creates a new Arduino_Emulator
+		ARGS:
+			max_baudrate (int): fastest baud rate that works reliably, bytes 
+								sent faster than this get corrupted. If None 
+								then every baud rate works
+			error_rate (float): chance of any byte being corrupted on the 
+								serial port
+			seed (int): seed for the random number generator that corrupts 
+						bytes
+		RETURNS: new instance of an Arduino_Emulator
+		NOTES: bytes are only corrupted when the transport tells us the baud 
+			   rate the host pc is using (see feed)
+		"""
+		self.max_baudrate = max_baudrate
+		self.error_rate = float(error_rate)
+		self.rng = random.Random(seed)
+		self.reset()
+
+	############################################################################
+	def reset(self):
+		"""
+		PURPOSE: puts the emulator in the state the arduino is in right after
+				 it boots
+		ARGS: none
+		RETURNS: (bytes) bytes the arduino sends when it boots
+		NOTES:
+		"""
+		#Parses frames from the host pc and keeps our desired state, same as
+		#the firmware
+		self.decoder = Frame_Decoder()
+
+		#Actual state of the hub, laid out like a frame without the sync bytes
+		self.cur_state = bytearray(self.decoder.state)
+
+		#Baud rate we are listening at, if the host pc doesn't keep a new one
+		#soon after we switch we go back to the one we booted at like the 
+		#firmware
+		self.baudrate = BAUD_RATES[0]
+		self.next_baudrate = None
+		self.baud_time = None
+
+		#Statistics
+		self.frames = 0
+		self.naks = 0
+
+		#Let the host pc know we are ready for frames
+		return HELLO_MSG
+
+	############################################################################
+	def feed(self, data, baudrate=None):
+		"""
+		PURPOSE: handles bytes sent by the host pc
+		ARGS:
+			data (bytes): bytes the host pc wrote to the serial port
+			baudrate (int): baud rate the host pc is using, if None then the 
+							serial port is perfect
+		RETURNS: (bytes) bytes the arduino writes back to the host pc, as 
+				 the host pc would receive them
+		NOTES:
+		"""
+		if self.baud_time is not None and (time.time() - self.baud_time) >= BAUD_CONFIRM_TIME:
+			#The host pc never kept the new baud rate
+			self.baudrate = BAUD_RATES[0]
+			self.baud_time = None
+			self.decoder.mode = 'hunt'
+
+		noisy = baudrate is not None
+		resp = bytearray()
+		for byte in data:
+			if noisy:
+				byte = self.line_byte(byte, baudrate)
+			event = self.decoder.feed_byte(byte)
+			if event == Decode_Event.FRAME:
+				self.frames += 1
+				#The hub picks up our desired state right away
+				self.update_hub()
+				out = self.state_frame()
+			elif event == Decode_Event.CTRL:
+				out = self.handle_ctrl(self.decoder.cmd, self.decoder.arg)
+			elif event == Decode_Event.NAK:
+				#Ask the host pc to resync us with a keyframe
+				self.naks += 1
+				out = bytes([CTRL_SYNC_BYTE, CTRL_SYNC_BYTE, CTRL_NAK, self.decoder.expected_seq])
+			else:
+				continue
+			if noisy:
+				out = bytes(self.line_byte(byte, baudrate) for byte in out)
+			resp += out
+
+			#Switch baud rates only after answering at the old one
+			if self.next_baudrate is not None:
+				self.baudrate = self.next_baudrate
+				self.next_baudrate = None
+				self.baud_time = time.time() if self.baudrate != BAUD_RATES[0] else None
+				self.decoder.mode = 'hunt'
+		return bytes(resp)
+
+	############################################################################
+	def line_byte(self, byte, baudrate):
+		"""
+		PURPOSE: models a byte going over the serial port
+		ARGS:
+			byte (int): the byte that was sent
+			baudrate (int): baud rate the host pc is using
+		RETURNS: (int) the byte that was received
+		NOTES: if the two ends are at different baud rates the byte turns 
+			   into garbage
+		"""
+		if baudrate != self.baudrate:
+			return self.rng.randrange(256)
+		error_rate = self.error_rate
+		if self.max_baudrate is not None and baudrate > self.max_baudrate:
+			error_rate = max(error_rate, FAST_BAUD_ERROR_RATE)
+		if error_rate and self.rng.random() < error_rate:
+			return byte ^ (1 << self.rng.randrange(8))
+		return byte
+
+	############################################################################
+	def handle_ctrl(self, cmd, arg):
+		"""
+		PURPOSE: handles a control message from the host pc
+		ARGS:
+			cmd (int): the command byte
+			arg (int): the argument byte, 0 if the command doesn't have one
+		RETURNS: (bytes) bytes the arduino writes back to the host pc
+		NOTES: unknown commands are ignored
+		"""
+		if cmd == CTRL_PROBE:
+			return HELLO_MSG
+		elif cmd == CTRL_VERSION:
+			self.decoder.set_version(arg)
+			return bytes([CTRL_SYNC_BYTE, CTRL_SYNC_BYTE, CTRL_VERSION, self.decoder.version])
+		elif cmd == CTRL_BAUD:
+			#Switched to after the answer is sent, see feed
+			if arg >= len(BAUD_RATES):
+				arg = BAUD_RATES.index(self.baudrate)
+			elif self.baud_time is not None and BAUD_RATES[arg] == self.baudrate:
+				#The host pc is keeping the new baud rate
+				self.baud_time = None
+			else:
+				self.next_baudrate = BAUD_RATES[arg]
+			return bytes([CTRL_SYNC_BYTE, CTRL_SYNC_BYTE, CTRL_BAUD, arg])
+		return b''
+
+	############################################################################
+	def update_hub(self):
+		"""
+		PURPOSE: models the hub reading our desired state over SPI
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		self.cur_state[:] = self.decoder.state
+
+	############################################################################
+	def state_frame(self):
+		"""
+		PURPOSE: builds the frame the arduino sends with the actual state of
+				 the hub
+		ARGS: none
+		RETURNS: (bytes) the frame
+		NOTES: version 3 adds the sequence number of the frame we just applied 
+			   and a CRC of the state and sequence number
+		"""
+		frame = bytes([SYNC_BYTE, SYNC_BYTE]) + bytes(self.cur_state)
+		if self.decoder.version >= 3:
+			tail = bytes(self.cur_state) + bytes([self.decoder.seq])
+			frame = bytes([SYNC_BYTE, SYNC_BYTE]) + tail + bytes([crc8(tail)])
+		return frame
+
+	############################################################################
+
+################################################################################
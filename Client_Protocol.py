@@ -0,0 +1,155 @@
+#Imports
+from enum import Enum
+import struct
+
+################################################################################
+#Protocol version 1 messages between the clients and the server are a
+#message type followed by two argument bytes
+MSG_LEN = 3	#bytes per message
+
+#Messages to spectators are a message type, a byte that is 1 if the actual
+#state of the hub is known, the state the controllers want and the actual
+#state of the hub (both laid out like a frame to the arduino without the sync
+#bytes)
+STATE_LEN = 19
+SPECTATE_MSG_LEN = 2 + 2 * STATE_LEN
+
+#Protocol version 2 frames are a 2 byte length (most significant byte first)
+#followed by that many bytes of records. Each record is a message type, the
+#length of its data and its data, so one frame can carry several messages and
+#a record can carry any amount of data. A KEY_PRESS record carries a key and
+#whether it was pressed for every key event in it, the other records carry
+#the same arguments as in version 1 without the padding.
+#
+#Every connection starts out speaking version 1. After START the client sends
+#VERSION with the highest version it speaks, the server answers VERSION with
+#the version both of them will speak and both switch to it right after. The
+#client sends nothing else until it gets the answer (an older server never
+#answers, so the client gives up and keeps speaking version 1)
+PROTOCOL_VERSION = 2
+FRAME_HEADER_LEN = 2
+MAX_FRAME_LEN = 0xFFFF
+MAX_RECORD_DATA = 0xFF
+
+################################################################################
+class Message_Type(Enum):
+	START = 1	#server sends at the beginning of a connection if a controller is available, with the session token for sending key states over UDP (0 if it can't be used)
+	FULL = 2	#server sends at the beginning of a conneciton (right before closing the connection) if a controller is unavailable
+	KEY_PRESS = 3	#client sends to indicate they pressed a key
+	TRUE_SEL = 4	#server sends to update client on their selected value
+	END = 5	#client or server sends to indicate connection is closing
+	STATE = 6	#server sends to spectators with the state of every controller
+	WAIT = 7	#server sends when no controller is available with the client's place in line
+	HEARTBEAT = 8	#server sends regularly with an id, client sends it straight back
+	VERSION = 9	#client sends after START with the highest protocol version it speaks, server answers with the version both will speak
+
+################################################################################
+def encode_frame(records):
+	"""
+	PURPOSE: builds a protocol version 2 frame
+	ARGS:
+		records (list): a (Message_Type, bytes) tuple for each record
+	RETURNS: (bytes) the frame
+	NOTES: KEY_PRESS data longer than a record can hold is split over
+		   several records. Raises a ValueError if the frame is too long
+	"""
+	payload = bytearray()
+	for msg_type, data in records:
+		step = MAX_RECORD_DATA - (MAX_RECORD_DATA % 2) if msg_type == Message_Type.KEY_PRESS else MAX_RECORD_DATA
+		for start in range(0, max(len(data), 1), step):
+			chunk = data[start:start + step]
+			payload.append(msg_type.value)
+			payload.append(len(chunk))
+			payload += chunk
+	if len(payload) > MAX_FRAME_LEN:
+		raise ValueError("Frame too long!")
+	return struct.pack('>H', len(payload)) + bytes(payload)
+
+################################################################################
+def encode_msg(version, msg_type, data=b''):
+	"""
+	PURPOSE: builds a single message in a protocol version
+	ARGS:
+		version (int): the protocol version
+		msg_type (Message_Type): type of the message
+		data (bytes): arguments of the message
+	RETURNS: (bytes) the message, or in version 2 a frame holding it
+	NOTES: in version 1 the arguments are cut or padded to fit
+	"""
+	if version >= 2:
+		return encode_frame([(msg_type, data)])
+	return bytes([msg_type.value]) + bytes(data[:MSG_LEN - 1]).ljust(MSG_LEN - 1, b'\x00')
+
+################################################################################
+def decode_frame(payload):
+	"""
+	PURPOSE: splits the payload of a protocol version 2 frame into records
+	ARGS:
+		payload (bytes): the frame without its length
+	RETURNS: (list) a (message type value, bytes) tuple for each record
+	NOTES: the message type is left as an int so unknown types can be
+		   skipped. Raises a ValueError if a record runs past the end of
+		   the frame
+	"""
+	records = []
+	idx = 0
+	while idx < len(payload):
+		if idx + 2 > len(payload):
+			raise ValueError("Truncated record!")
+		msg_type = payload[idx]
+		data_len = payload[idx + 1]
+		idx += 2
+		if idx + data_len > len(payload):
+			raise ValueError("Truncated record!")
+		records.append((msg_type, bytes(payload[idx:idx + data_len])))
+		idx += data_len
+	return records
+
+################################################################################
+def frame_len(header):
+	"""
+	PURPOSE: gets the length of a protocol version 2 frame's payload
+	ARGS:
+		header (bytes): the first FRAME_HEADER_LEN bytes of the frame
+	RETURNS: (int) number of bytes after the header
+	NOTES:
+	"""
+	return struct.unpack('>H', header)[0]
+
+################################################################################
+def read_records(buf, start, version):
+	"""
+	PURPOSE: reads the next message out of bytes received
+	ARGS:
+		buf (bytearray): the bytes received
+		start (int): index in buf the message starts at
+		version (int): the protocol version the message was sent in
+	RETURNS: (list, int) a (message type value, bytes) tuple for each record
+			 in the message and the index in buf right after it, None if 
+			 buf doesn't hold all of the message yet
+	NOTES: in version 2 the message is a whole frame
+	"""
+	if version >= 2:
+		if len(buf) - start < FRAME_HEADER_LEN:
+			return None
+		end = start + FRAME_HEADER_LEN + frame_len(buf[start:start + FRAME_HEADER_LEN])
+		if len(buf) < end:
+			return None
+		return (decode_frame(buf[start + FRAME_HEADER_LEN:end]), end)
+	end = start + MSG_LEN
+	if len(buf) < end:
+		return None
+	return ([(buf[start], bytes(buf[start + 1:end]))], end)
+
+################################################################################
+def key_events(data):
+	"""
+	PURPOSE: reads the key events in a KEY_PRESS record
+	ARGS:
+		data (bytes): the data of the record
+	RETURNS: (list) a (ascii code, pressed) tuple for each key event
+	NOTES: a trailing odd byte is ignored
+	"""
+	return [(data[ii], bool(data[ii + 1])) for ii in range(0, len(data) - 1, 2)]
+
+################################################################################
@@ -1,5 +1,17 @@
 #Imports
+import asyncio
 import socket
+import time
+
+################################################################################
+#Bytes the receive buffer starts out holding. Every recv call fills as much of
+#it as it can, so a burst of messages that already arrived is read with one
+#call and then handed out from the buffer
+RECV_BUF_SIZE = 4096
+
+#Max messages handed to one sendmsg call, the kernel won't take more than 
+#IOV_MAX (at least 1024 on linux) buffers at once
+MAX_SEND_BUFS = 512
 
 ################################################################################
 class Fixed_Len_Socket:
@@ -7,12 +19,17 @@ class Fixed_Len_Socket:
 	Implements a socket that always sends a message of a fixed length
 	"""
 	############################################################################
-	def __init__(self, msg_len, sock=None):
+	def __init__(self, msg_len, sock=None, buf_size=RECV_BUF_SIZE, nodelay=True):
 		"""
 		PURPOSE: creates a new Fixed_Len_Socket
 		ARGS:
 			msg_len (int): number of bytes in each message
 			sock (socket): socket to use, if None then creates one
+			buf_size (int): bytes the receive buffer starts out holding, it
+							grows if a message doesn't fit
+			nodelay (bool): if True then messages are sent right away 
+							instead of being held back by Nagle's algorithm 
+							until the last packet is acknowledged
 		RETURNS: new instance of a Fixed_Len_Socket
 		NOTES:
 		"""
@@ -22,6 +39,20 @@ class Fixed_Len_Socket:
 			self.sock = sock
 		else:
 			self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		try:
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(bool(nodelay)))
+		except OSError as e:
+			#Not a TCP socket
+			pass
+
+		#Bytes are received straight into buf. The ones from start to end 
+		#haven't been handed out yet, once the space after end runs out they
+		#are moved back to the front. recv_calls counts the recv calls made
+		self.buf = bytearray(max(int(buf_size), self.msg_len))
+		self.view = memoryview(self.buf)
+		self.start = 0
+		self.end = 0
+		self.recv_calls = 0
 
 	############################################################################
 	def __del__(self):
@@ -52,32 +83,228 @@ class Fixed_Len_Socket:
 		ARGS:
 			msg (bytes): message to send
 		RETURNS: none
-		NOTES: raises a RuntimeError if socket connection breaks
+		NOTES: raises a RuntimeError if socket connection breaks. A message 
+			   of another length (like a length prefixed frame) is sent whole
 		"""
 		bytes_sent = 0
-		while bytes_sent < self.msg_len:
+		while bytes_sent < len(msg):
 			sent = self.sock.send(msg[bytes_sent:])
 			if sent == 0:
 				raise RuntimeError("Socket broken")
 			bytes_sent += sent
 
 	############################################################################
-	def recv(self):
+	def send_many(self, msgs):
+		"""
+		PURPOSE: sends several messages at once
+		ARGS:
+			msgs (list): the messages (bytes) to send, in order
+		RETURNS: none
+		NOTES: raises a RuntimeError if socket connection breaks. The messages
+			   are handed to the kernel together with one sendmsg call where 
+			   there is one. If that doesn't take all of them the socket is 
+			   corked until the rest are sent, so they go out in full packets
+			   instead of trickling out
+		"""
+		if not hasattr(self.sock, 'sendmsg'):
+			self.send(b''.join(msgs))
+			return
+		bufs = [memoryview(msg) for msg in msgs if len(msg)]
+		corked = False
+		try:
+			while bufs:
+				bytes_sent = self.sock.sendmsg(bufs[:MAX_SEND_BUFS])
+				if bytes_sent == 0:
+					raise RuntimeError("Socket broken")
+				while bufs and bytes_sent >= len(bufs[0]):
+					bytes_sent -= len(bufs.pop(0))
+				if bufs:
+					bufs[0] = bufs[0][bytes_sent:]
+					if not corked:
+						corked = self.cork()
+		finally:
+			if corked:
+				self.uncork()
+
+	############################################################################
+	def cork(self):
+		"""
+		PURPOSE: holds back partial packets until uncork is called
+		ARGS: none
+		RETURNS: (bool) True if the socket was corked, False if corking 
+				 isn't supported (only linux TCP sockets can be)
+		NOTES: full packets are still sent while corked
+		"""
+		if not hasattr(socket, 'TCP_CORK'):
+			return False
+		try:
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+		except OSError as e:
+			return False
+		return True
+
+	############################################################################
+	def uncork(self):
+		"""
+		PURPOSE: sends everything held back since cork was called
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		try:
+			self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+		except (AttributeError, OSError) as e:
+			pass
+
+	############################################################################
+	def fill(self, num_bytes, deadline=None):
+		"""
+		PURPOSE: receives until the buffer holds a number of bytes
+		ARGS:
+			num_bytes (int): bytes the buffer must hold
+			deadline (float): time.monotonic() time to give up at, if None
+							  then waits as long as the socket does
+		RETURNS: (bool) True once the buffer holds them, False if the socket
+				 is non-blocking and they haven't all arrived yet
+		NOTES: raises a RuntimeError if socket connection breaks and a 
+			   TimeoutError if the deadline passes first. Either way the 
+			   bytes received so far stay in the buffer
+		"""
+		timeout = self.sock.gettimeout()
+		use_deadline = deadline is not None and timeout != 0
+		try:
+			while self.end - self.start < num_bytes:
+				if self.start + num_bytes > len(self.buf):
+					#Make room at the end by moving what's left to the front, 
+					#or into a bigger buffer if it still won't fit
+					left = self.end - self.start
+					if num_bytes > len(self.buf):
+						buf = bytearray(max(num_bytes, 2 * len(self.buf)))
+						buf[:left] = self.view[self.start:self.end]
+						self.view.release()
+						self.buf = buf
+						self.view = memoryview(self.buf)
+					else:
+						self.buf[:left] = bytes(self.view[self.start:self.end])
+					self.start = 0
+					self.end = left
+				if use_deadline:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						raise socket.timeout("timed out")
+					self.sock.settimeout(remaining if timeout is None else min(remaining, timeout))
+				try:
+					bytes_recvd = self.sock.recv_into(self.view[self.end:])
+				except BlockingIOError as e:
+					return False
+				self.recv_calls += 1
+				if bytes_recvd == 0:
+					raise RuntimeError("Socket broken")
+				self.end += bytes_recvd
+		finally:
+			if use_deadline:
+				self.sock.settimeout(timeout)
+		return True
+
+	############################################################################
+	def take(self, num_bytes):
+		"""
+		PURPOSE: hands out bytes from the buffer
+		ARGS:
+			num_bytes (int): number of bytes, the buffer must hold them
+		RETURNS: (bytes) the bytes
+		NOTES:
+		"""
+		msg = bytes(self.view[self.start:self.start + num_bytes])
+		self.start += num_bytes
+		if self.start == self.end:
+			self.start = 0
+			self.end = 0
+		return msg
+
+	############################################################################
+	def pending(self):
+		"""
+		PURPOSE: gets how much of the next messages has been received
+		ARGS: none
+		RETURNS: (int) number of bytes received but not handed out yet
+		NOTES:
+		"""
+		return self.end - self.start
+
+	############################################################################
+	def recv(self, msg_len=None, timeout=None, deadline=None):
 		"""
 		PURPOSE: receives an entire fixed length message
+		ARGS:
+			msg_len (int): number of bytes to receive, if None then the 
+						   fixed message length
+			timeout (float): max seconds to wait, if None then waits as long
+							 as the socket does
+			deadline (float): time.monotonic() time to give up at, for 
+							  waiting on several messages with one deadline
+		RETURNS (bytes): array of bytes representing message, None if the 
+						 socket is non-blocking and the whole message hasn't
+						 arrived yet
+		NOTES: raises a RuntimeError is socket conneciton breaks and a 
+			   TimeoutError if it times out. Only calls recv if the message 
+			   hasn't already been received, and any part of it received 
+			   before timing out is kept for the next call
+		"""
+		if msg_len is None:
+			msg_len = self.msg_len
+		if timeout is not None:
+			deadline = min(time.monotonic() + timeout, deadline if deadline is not None else float('inf'))
+		if not self.fill(msg_len, deadline):
+			return None
+		return self.take(msg_len)
+
+	############################################################################
+	def recv_many(self, timeout=None, deadline=None):
+		"""
+		PURPOSE: receives every fixed length message that has arrived
+		ARGS:
+			timeout (float): max seconds to wait, if None then waits as long
+							 as the socket does
+			deadline (float): time.monotonic() time to give up at
+		RETURNS: (list) the messages (bytes), in the order they arrived. 
+				 Empty if the socket is non-blocking and no whole message 
+				 has arrived yet
+		NOTES: blocks until there is at least one message. Raises a 
+			   RuntimeError if socket connection breaks and a TimeoutError 
+			   if it times out
+		"""
+		if timeout is not None:
+			deadline = min(time.monotonic() + timeout, deadline if deadline is not None else float('inf'))
+		if not self.fill(self.msg_len, deadline):
+			return []
+		count = (self.end - self.start) // self.msg_len
+		return [self.take(self.msg_len) for ii in range(count)]
+
+	############################################################################
+	def setblocking(self, blocking):
+		"""
+		PURPOSE: switches between blocking and non-blocking mode
+		ARGS:
+			blocking (bool): if False then recv and recv_many return right 
+							 away with whatever whole messages have arrived
+		RETURNS: none
+		NOTES: sending in non-blocking mode raises a BlockingIOError if the 
+			   socket's send buffer is full
+		"""
+		self.sock.setblocking(blocking)
+
+	############################################################################
+	def fileno(self):
+		"""
+		PURPOSE: gets the file descriptor of the socket, so it can be 
+				 waited on with select or a selector
 		ARGS: none
-		RETURNS (bytes): array of bytes representing message
-		NOTES: raises a RuntimeError is socket conneciton breaks
+		RETURNS: (int) the file descriptor
+		NOTES: messages already in the buffer don't make it readable, check
+			   pending first
 		"""
-		chunks = bytes()
-		bytes_recvd = 0
-		while bytes_recvd < self.msg_len:
-			chunk = self.sock.recv(self.msg_len)
-			if chunk == b'':
-				raise RuntimeError("Socket broken")
-			chunks += chunk
-			bytes_recvd += len(chunk)
-		return chunks
+		return self.sock.fileno()
 
 	############################################################################
 	def close(self):
@@ -85,10 +312,202 @@ class Fixed_Len_Socket:
 		PURPOSE: closes the socket if its open
 		ARGS: none
 		RETURNS: none
-		NOTES:
+		NOTES: shuts the socket down first so any thread blocked receiving on
+			   it wakes up
 		"""
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError as e:
+			pass
 		self.sock.close()
 
 	############################################################################
 
-################################################################################
\ No newline at end of file
+################################################################################
+class Async_Fixed_Len_Socket:
+	"""
+	Sends and receives messages of a fixed length like a Fixed_Len_Socket, but
+	over asyncio streams so waiting doesn't tie up a thread
+	"""
+	############################################################################
+	def __init__(self, msg_len, reader=None, writer=None, buf_size=RECV_BUF_SIZE):
+		"""
+		PURPOSE: creates a new Async_Fixed_Len_Socket
+		ARGS:
+			msg_len (int): number of bytes in each message
+			reader (asyncio.StreamReader): stream to receive on, if None then
+										   call connect
+			writer (asyncio.StreamWriter): stream to send on
+			buf_size (int): max bytes read from the stream at once
+		RETURNS: new instance of an Async_Fixed_Len_Socket
+		NOTES:
+		"""
+		#Save arguments
+		self.msg_len = int(msg_len)
+		self.reader = reader
+		self.writer = writer
+		self.buf_size = int(buf_size)
+
+		#Bytes received, the ones before start have been handed out already
+		#and are dropped in one go before the next read. Also the reads made
+		self.buf = bytearray()
+		self.start = 0
+		self.recv_calls = 0
+
+	############################################################################
+	async def connect(self, ip, port):
+		"""
+		PURPOSE: connects to an open socket on the other end
+		ARGS:
+			ip (str): ip address of the socket to connec to
+			port (int): the port to connect with
+		RETURNS: none
+		NOTES: asyncio turns Nagle's algorithm off for us
+		"""
+		self.reader, self.writer = await asyncio.open_connection(ip, port)
+
+	############################################################################
+	async def send(self, msg):
+		"""
+		PURPOSE: sends an entire fixed length message
+		ARGS:
+			msg (bytes): message to send
+		RETURNS: none
+		NOTES: waits if the stream is too far behind sending
+		"""
+		self.writer.write(msg)
+		await self.writer.drain()
+
+	############################################################################
+	async def send_many(self, msgs):
+		"""
+		PURPOSE: sends several messages at once
+		ARGS:
+			msgs (list): the messages (bytes) to send, in order
+		RETURNS: none
+		NOTES: waits if the stream is too far behind sending
+		"""
+		self.writer.writelines(msgs)
+		await self.writer.drain()
+
+	############################################################################
+	def write(self, msg):
+		"""
+		PURPOSE: queues a message to be sent without waiting
+		ARGS:
+			msg (bytes): message to send
+		RETURNS: none
+		NOTES: for callbacks on the event loop that can't wait, the stream 
+			   sends it as soon as it can
+		"""
+		self.writer.write(msg)
+
+	############################################################################
+	def write_many(self, msgs):
+		"""
+		PURPOSE: queues several messages to be sent together without waiting
+		ARGS:
+			msgs (list): the messages (bytes) to send, in order
+		RETURNS: none
+		NOTES: see write
+		"""
+		self.writer.writelines(msgs)
+
+	############################################################################
+	async def fill(self, num_bytes):
+		"""
+		PURPOSE: receives until the buffer holds a number of bytes
+		ARGS:
+			num_bytes (int): bytes the buffer must hold
+		RETURNS: none
+		NOTES: raises a RuntimeError if socket connection breaks. If it is 
+			   cancelled the bytes received so far stay in the buffer
+		"""
+		while len(self.buf) - self.start < num_bytes:
+			if self.start:
+				del self.buf[:self.start]
+				self.start = 0
+			data = await self.reader.read(max(self.buf_size, num_bytes - len(self.buf)))
+			self.recv_calls += 1
+			if not data:
+				raise RuntimeError("Socket broken")
+			self.buf += data
+
+	############################################################################
+	def take(self, num_bytes):
+		"""
+		PURPOSE: hands out bytes from the buffer
+		ARGS:
+			num_bytes (int): number of bytes, the buffer must hold them
+		RETURNS: (bytes) the bytes
+		NOTES: only moves past the bytes, fill drops them later
+		"""
+		msg = bytes(self.buf[self.start:self.start + num_bytes])
+		self.start += num_bytes
+		if self.start == len(self.buf):
+			self.buf.clear()
+			self.start = 0
+		return msg
+
+	############################################################################
+	def pending(self):
+		"""
+		PURPOSE: gets how much of the next messages has been received
+		ARGS: none
+		RETURNS: (int) number of bytes received but not handed out yet
+		NOTES:
+		"""
+		return len(self.buf) - self.start
+
+	############################################################################
+	async def recv(self, msg_len=None, timeout=None):
+		"""
+		PURPOSE: receives an entire fixed length message
+		ARGS:
+			msg_len (int): number of bytes to receive, if None then the 
+						   fixed message length
+			timeout (float): max seconds to wait, if None then waits forever
+		RETURNS (bytes): array of bytes representing message
+		NOTES: raises a RuntimeError is socket conneciton breaks and a 
+			   TimeoutError if it times out. Any part of the message 
+			   received before timing out is kept for the next call
+		"""
+		if msg_len is None:
+			msg_len = self.msg_len
+		await asyncio.wait_for(self.fill(msg_len), timeout)
+		return self.take(msg_len)
+
+	############################################################################
+	async def recv_many(self, timeout=None):
+		"""
+		PURPOSE: receives every fixed length message that has arrived
+		ARGS:
+			timeout (float): max seconds to wait, if None then waits forever
+		RETURNS: (list) the messages (bytes), in the order they arrived
+		NOTES: waits until there is at least one message. Raises a 
+			   RuntimeError if socket connection breaks and a TimeoutError 
+			   if it times out
+		"""
+		await asyncio.wait_for(self.fill(self.msg_len), timeout)
+		count = self.pending() // self.msg_len
+		return [self.take(self.msg_len) for ii in range(count)]
+
+	############################################################################
+	async def close(self):
+		"""
+		PURPOSE: closes the connection if its open
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		if self.writer is None:
+			return
+		try:
+			self.writer.close()
+			await self.writer.wait_closed()
+		except (OSError, RuntimeError) as e:
+			pass
+
+	############################################################################
+
+################################################################################
@@ -0,0 +1,402 @@
+#Imports
+from Rokenbok_Hub import Rokenbok_Hub, Restart_Status, Restart_State
+from Hub_Protocol import SYNC_BYTE, SEL_IDX, FRAME_LEN, STATE_LEN
+from Hub_Transport import Loopback_Transport
+from Metrics import Histogram, WRITE_BUCKETS
+from multiprocessing import shared_memory
+import multiprocessing
+import math
+import struct
+import threading
+import time
+
+################################################################################
+#Layout of the shared memory block. Each part is written by one process and
+#read by the other, guarded by its own seqlock: a counter the writer makes odd
+#before writing and even again after, so a reader that sees the same even
+#count before and after copying knows it got a whole update. The desired state
+#is written by us, the actual state and stats by the hub process
+SEQ_FMT = '<I'
+SEQ_LEN = struct.calcsize(SEQ_FMT)
+DES_FMT = '<%ds' % STATE_LEN
+CUR_FMT = '<Bd%ds' % STATE_LEN	#actual state known, time it arrived, state
+#Stats are the restarts asked for, the state of the last one, the stats of
+#Rokenbok_Hub.get_stats, whether frames are being sent, the write latency
+#histogram and the locks of the hub
+STATS_FMT = '<IBdQQQQQQQQB%dQdQ' % (len(WRITE_BUCKETS) + 1) + 'QddQdd'
+STATS_HEAD_LEN = 12
+DES_OFFSET = 0
+CUR_OFFSET = 64
+STATS_OFFSET = 128
+SHM_SIZE = STATS_OFFSET + SEQ_LEN + struct.calcsize(STATS_FMT)
+
+#Seconds between stats updates from the hub process, and the longest we wait
+#for anything before checking if we should stop
+STATS_PERIOD = 0.1
+
+#Seconds a seqlock can stay in the middle of a write before we decide the
+#process writing it died
+SEQLOCK_TIMEOUT = 1.0
+
+################################################################################
+class Seqlock:
+	"""
+	A part of a shared memory block guarded by a sequence counter so one
+	process can write it while another reads it without a lock
+	"""
+	############################################################################
+	def __init__(self, buf, offset, fmt):
+		"""
+		PURPOSE: creates a new Seqlock
+		ARGS:
+			buf (memoryview): the shared memory
+			offset (int): where in buf the counter starts, the values follow
+						  it
+			fmt (str): struct format of the values
+		RETURNS: new instance of a Seqlock
+		NOTES: only one process may write
+		"""
+		self.buf = buf
+		self.offset = offset
+		self.values = struct.Struct(fmt)
+
+	############################################################################
+	def write(self, *values):
+		"""
+		PURPOSE: writes new values
+		ARGS:
+			*values: the values, as given to struct.pack
+		RETURNS: none
+		NOTES:
+		"""
+		seq = struct.unpack_from(SEQ_FMT, self.buf, self.offset)[0]
+		struct.pack_into(SEQ_FMT, self.buf, self.offset, (seq + 1) & 0xFFFFFFFF)
+		self.values.pack_into(self.buf, self.offset + SEQ_LEN, *values)
+		struct.pack_into(SEQ_FMT, self.buf, self.offset, (seq + 2) & 0xFFFFFFFF)
+
+	############################################################################
+	def read(self, timeout=SEQLOCK_TIMEOUT):
+		"""
+		PURPOSE: reads the latest values
+		ARGS:
+			timeout (float): max seconds to keep retrying for
+		RETURNS: (tuple) the values and the sequence count they were written
+				 with, the count is last
+		NOTES: retries until it gets values that weren't being written while
+			   it copied them. Raises a RuntimeError if it can't within
+			   timeout seconds, which means the writer died in the middle of
+			   a write
+		"""
+		deadline = time.monotonic() + timeout
+		while True:
+			seq = struct.unpack_from(SEQ_FMT, self.buf, self.offset)[0]
+			if seq & 1:
+				if time.monotonic() > deadline:
+					raise RuntimeError("Shared memory writer stopped in the middle of a write")
+				time.sleep(0)
+				continue
+			values = self.values.unpack_from(self.buf, self.offset + SEQ_LEN)
+			if struct.unpack_from(SEQ_FMT, self.buf, self.offset)[0] == seq:
+				return values + (seq,)
+
+	############################################################################
+
+################################################################################
+def run_hub_process(shm_name, des_changed, cur_changed, restart, stop, emulated, kwargs):
+	"""
+	PURPOSE: runs a Rokenbok_Hub in the hub process and connects it to the
+			 shared memory
+	ARGS:
+		shm_name (str): name of the shared memory block
+		des_changed (multiprocessing.Event): set when we write a new desired
+											 state
+		cur_changed (multiprocessing.Event): set when the actual state of
+											 the hub changes
+		restart (multiprocessing.Event): set to restart the arduino
+		stop (multiprocessing.Event): set to stop the hub process
+		emulated (bool): if True talks to an emulated arduino in memory
+		kwargs (dict): arguments for the Rokenbok_Hub
+	RETURNS: none
+	NOTES: runs as the main function of the hub process
+	"""
+	shm = shared_memory.SharedMemory(name=shm_name)
+	des_block = Seqlock(shm.buf, DES_OFFSET, DES_FMT)
+	cur_block = Seqlock(shm.buf, CUR_OFFSET, CUR_FMT)
+	stats_block = Seqlock(shm.buf, STATS_OFFSET, STATS_FMT)
+
+	#A seqlock only allows one writer, but the actual state is written by
+	#both the read thread of the hub and this one
+	cur_write_lock = threading.Lock()
+
+	if emulated:
+		kwargs['transport'] = Loopback_Transport()
+	rh = Rokenbok_Hub(**kwargs)
+	restarts = 1
+
+	def publish_cur():
+		des_state, cur_state = rh.get_state()
+		cur_time = rh.cur_time
+		with cur_write_lock:
+			if cur_state is None:
+				cur_block.write(0, math.nan, bytes(STATE_LEN))
+			else:
+				cur_block.write(1, cur_time, cur_state)
+
+	def state_changed():
+		publish_cur()
+		cur_changed.set()
+	rh.add_state_cb(state_changed)
+
+	try:
+		while not stop.is_set():
+			if des_changed.wait(STATS_PERIOD):
+				#Clear before reading so a change written while we read sets
+				#it again
+				des_changed.clear()
+				rh.set_state(des_block.read()[0])
+			if restart.is_set():
+				restart.clear()
+				rh.restart_arduino()
+				restarts += 1
+
+			#Keep the stats and the time we last heard from the arduino up
+			#to date
+			publish_cur()
+			hub_stats = rh.get_stats()
+			latency = hub_stats['write_latency']
+			locks = hub_stats['locks']
+			stats_block.write(restarts, rh.restart_status.state.value, hub_stats['fps'], hub_stats['frames'], hub_stats['parse_errors'], hub_stats['link_version'], hub_stats['baudrate'] or 0, hub_stats['tx_frames'], hub_stats['tx_bytes'], hub_stats['naks'], hub_stats['retransmits'], rh.streaming.is_set(), *latency.counts, latency.sum, latency.count, *locks['state'], *locks['cur'])
+	finally:
+		rh.remove_state_cb(state_changed)
+		rh.stop()
+		shm.close()
+
+################################################################################
+class Rokenbok_Hub_Process(Rokenbok_Hub):
+	"""
+	A Rokenbok_Hub that runs the threads talking to the arduino in a process
+	of their own, so their timing doesn't depend on how busy the threads of
+	this process are. Our state and the actual state of the hub are passed
+	back and forth through shared memory. Only the state of Rokenbok_Hub is
+	set up here, its methods that talk to the arduino are run by the
+	Rokenbok_Hub in the hub process
+	"""
+	############################################################################
+	def __init__(self, arduino_port=None, baudrate=115200, heartbeat=0.5, max_fps=200, emulated=False, **kwargs):
+		"""
+		PURPOSE: creates a new Rokenbok_Hub_Process
+		ARGS:
+			arduino_port (str): name of the serial port to communicate to the
+								arduino with. If left at 'None' then it will
+								try to find the correct serial port itself.
+			baudrate (int): baudrate to communicate to the arduino with
+			heartbeat (float): max number of seconds between frames sent to
+							   the arduino when nothing changes
+			max_fps (float): max number of frames per second sent to the
+							 arduino
+			emulated (bool): if True the hub process talks to an emulated
+							 arduino in memory instead of a serial port
+			**kwargs: any other arguments of Rokenbok_Hub except transport,
+					  which can't be passed to another process
+		RETURNS: new instance of a Rokenbok_Hub_Process
+		NOTES: the hub process is spawned rather than forked so it doesn't
+			   inherit the threads of this process
+		"""
+		#Our state and the actual state of the hub, see Rokenbok_Hub. Everything
+		#in our frame after the sync bytes is written to the shared memory 
+		#whenever it changes, and the actual state and stats are read from it
+		self.init_state()
+		self.stats = None
+
+		#Create the shared memory and start the hub process
+		self.shm = shared_memory.SharedMemory(create=True, size=SHM_SIZE)
+		self.des_block = Seqlock(self.shm.buf, DES_OFFSET, DES_FMT)
+		self.cur_block = Seqlock(self.shm.buf, CUR_OFFSET, CUR_FMT)
+		self.stats_block = Seqlock(self.shm.buf, STATS_OFFSET, STATS_FMT)
+		self.des_block.write(bytes(self.frame[2:]))
+		ctx = multiprocessing.get_context('spawn')
+		self.des_changed = ctx.Event()
+		self.cur_changed = ctx.Event()
+		self.restart = ctx.Event()
+		self.stop_process = ctx.Event()
+		kwargs.update({'arduino_port' : arduino_port, 'baudrate' : baudrate, 'heartbeat' : heartbeat, 'max_fps' : max_fps})
+		self.process = ctx.Process(target=run_hub_process, args=(self.shm.name, self.des_changed, self.cur_changed, self.restart, self.stop_process, emulated, kwargs), daemon=True)
+		self.process.start()
+
+		#The hub process restarts the arduino when it starts, restarts counts
+		#the restarts we have asked for so we know which one it is reporting
+		self.restarts = 1
+		self.restart_status = Restart_Status()
+		self.restart_status.set_state(Restart_State.OPENING)
+		self.streaming = threading.Event()
+		self.dead = False
+
+		#Start the thread reading the state of the hub from the hub process
+		self.keep_going = threading.Event()
+		self.keep_going.set()
+		self.read_thread = threading.Thread(target=self.read_state_process)
+		self.read_thread.start()
+
+	############################################################################
+	def notify_state_changed(self):
+		"""
+		PURPOSE: passes our state to the hub process
+		ARGS: none
+		RETURNS: none
+		NOTES: writes the frame to the shared memory from the calling thread,
+			   holding state_lock so there is only ever one writer. Whoever
+			   writes last copies the latest frame. Does nothing once stopped
+		"""
+		with self.state_lock:
+			if not self.keep_going.is_set():
+				return
+			self.des_block.write(bytes(self.frame[2:]))
+		self.des_changed.set()
+
+	############################################################################
+	def read_state_process(self):
+		"""
+		PURPOSE: reads the actual state of the hub and the stats from the hub
+				 process
+		ARGS: none
+		RETURNS: none
+		NOTES: should be run in a seperate thread. Calls the state callbacks
+			   whenever the actual state changes, like Rokenbok_Hub. Stops if
+			   the hub process dies
+		"""
+		while self.keep_going.is_set():
+			if self.cur_changed.wait(STATS_PERIOD):
+				self.cur_changed.clear()
+			if not self.process.is_alive() and not self.stop_process.is_set():
+				self.process_died("exit code %s" % self.process.exitcode)
+				return
+			try:
+				known, cur_time, state = self.cur_block.read()[:3]
+				stats = self.stats_block.read()
+			except RuntimeError as e:
+				self.process_died(e)
+				return
+			if known:
+				frame = bytes([SYNC_BYTE, SYNC_BYTE]) + state
+				with self.cur_lock:
+					changed = self.cur_frame is None or self.cur_frame[2:FRAME_LEN] != frame[2:FRAME_LEN]
+					self.cur_frame = frame
+					self.cur_sel = list(frame[SEL_IDX:FRAME_LEN])
+					self.cur_time = cur_time
+				self.check_divergence(cur_time)
+				if changed:
+					for cb in list(self.state_cbs):
+						cb()
+
+			#Follow the restart the hub process is doing
+			self.stats = stats
+			restarts, restart_state, streaming = self.stats[0], Restart_State(self.stats[1]) if self.stats[1] else None, self.stats[11]
+			if restarts == self.restarts and restart_state and restart_state != self.restart_status.state and not self.restart_status.done():
+				self.restart_status.set_state(restart_state)
+			if streaming:
+				self.streaming.set()
+			else:
+				self.streaming.clear()
+
+	############################################################################
+	def process_died(self, reason):
+		"""
+		PURPOSE: reports that the hub process died
+		ARGS:
+			reason (str): what gave it away
+		RETURNS: none
+		NOTES: nothing reaches the arduino anymore, so we stop streaming and
+			   cancel any restart in progress
+		"""
+		print("Hub process died (%s)" % reason)
+		self.dead = True
+		self.streaming.clear()
+		if not self.restart_status.done():
+			self.restart_status.set_state(Restart_State.CANCELLED)
+
+	############################################################################
+	def restart_arduino(self):
+		"""
+		PURPOSE: restarts the arduino in case it becomes out of sync with us or
+				 the hub and gets stuck
+		ARGS: none
+		RETURNS: (Restart_Status) progress of the restart
+		NOTES: returns right away and the hub process does the restart, if a
+			   restart is already in progress it returns the status of that
+			   one instead of starting another
+		"""
+		if not self.restart_status.done():
+			return self.restart_status
+		if not self.keep_going.is_set() or self.dead:
+			status = Restart_Status()
+			status.set_state(Restart_State.CANCELLED)
+			return status
+		self.restarts += 1
+		self.restart_status = Restart_Status()
+		self.restart.set()
+		return self.restart_status
+
+	############################################################################
+	def stop(self):
+		"""
+		PURPOSE: stops the hub process, used in preperation to delete object
+		ARGS: none
+		RETURNS: none
+		NOTES: the hub process releases all buttons and deselects before it
+			   closes the serial connection, like Rokenbok_Hub.stop
+		"""
+		if not self.keep_going.is_set():
+			return
+		self.stop_process.set()
+		self.process.join()
+		self.keep_going.clear()
+		self.read_thread.join()
+		if not self.restart_status.done():
+			self.restart_status.set_state(Restart_State.CANCELLED)
+		with self.state_lock:
+			self.shm.close()
+		self.shm.unlink()
+
+	############################################################################
+	def get_stats(self):
+		"""
+		PURPOSE: gets statistics about the link to the arduino
+		ARGS: none
+		RETURNS: (dict) the same keys as Rokenbok_Hub.get_stats, the locks of
+				 the hub in the hub process are named 'process_state' and
+				 'process_cur'
+		NOTES: the stats are at most STATS_PERIOD seconds old
+		"""
+		stats = self.stats or self.stats_block.read()
+		(restarts, restart_state, fps, frames, parse_errors, link_version, baudrate, tx_frames, tx_bytes, naks, retransmits, streaming) = stats[:STATS_HEAD_LEN]
+		buckets = len(WRITE_BUCKETS) + 1
+		latency = Histogram(WRITE_BUCKETS)
+		latency.counts = list(stats[STATS_HEAD_LEN:STATS_HEAD_LEN + buckets])
+		latency.sum, latency.count = stats[STATS_HEAD_LEN + buckets:STATS_HEAD_LEN + buckets + 2]
+		locks = stats[STATS_HEAD_LEN + buckets + 2:STATS_HEAD_LEN + buckets + 8]
+		diverged_since = self.diverged_since
+		return {
+			'frames' : frames,
+			'fps' : fps,
+			'parse_errors' : parse_errors,
+			'last_frame_time' : self.cur_time,
+			'diverged_fields' : len(self.get_divergence()),
+			'diverged_for' : 0.0 if diverged_since is None else time.time() - diverged_since,
+			'link_version' : link_version,
+			'baudrate' : baudrate or None,
+			'tx_frames' : tx_frames,
+			'tx_bytes' : tx_bytes,
+			'naks' : naks,
+			'retransmits' : retransmits,
+			'write_latency' : latency,
+			'locks' : {
+				'state' : (self.state_lock.acquisitions, self.state_lock.wait_time, self.state_lock.hold_time),
+				'cur' : (self.cur_lock.acquisitions, self.cur_lock.wait_time, self.cur_lock.hold_time),
+				'process_state' : tuple(locks[0:3]),
+				'process_cur' : tuple(locks[3:6])
+			}
+		}
+
+	############################################################################
+
+################################################################################
@@ -0,0 +1,502 @@
+#Imports
+from enum import Enum
+
+################################################################################
+#Layout of a frame sent between us and the arduino, each button's byte is at
+#index button.value + 1 (right after the two sync bytes). The arduino sends
+#back the actual state of the hub using the same layout
+SYNC_BYTE = 0b10101010
+PRIORITY_IDX = 12
+SEL_IDX = 13
+FRAME_LEN = 21
+NO_SEL = 0xFF
+
+#The state is everything in a frame after the sync bytes. Protocol version 1
+#sends the whole state in every frame. Protocol version 2 sends a bitmap of 
+#which state bytes changed (bit n is state byte n, least significant byte 
+#first) followed by the value of each changed byte. Protocol version 3 adds a 
+#sequence number before the bitmap and a CRC-8 of everything after the sync 
+#bytes at the end. See rokenbok/frame_parser.h
+STATE_LEN = FRAME_LEN - 2
+BITMAP_LEN = 3
+ALL_CHANGED = bytes([0xFF, 0xFF, 0x07])
+CRC_POLY = 0x07
+
+#In protocol version 3 the arduino adds the sequence number of the frame it 
+#applied and a CRC-8 of the state and sequence number to the end of the state
+#it sends back, so those frames are a little longer
+SEQ_IDX = FRAME_LEN
+FRAME_LEN_V3 = FRAME_LEN + 2
+
+#Control messages start with two control sync bytes followed by a command 
+#byte. The arduino sends HELLO with the highest protocol version it speaks 
+#when it boots and whenever it receives PROBE. We send VERSION with the 
+#version we want to speak and it answers with VERSION and the version it 
+#will speak (it starts out speaking version 1). In version 3 the arduino 
+#sends NAK with the sequence number it wants next when it rejects a frame. 
+#We send BAUD with the index of a baud rate in BAUD_RATES to speed up the 
+#serial port, the arduino answers with BAUD and the index it is switching to.
+#Once the new baud rate works we send the same BAUD again to keep it
+CTRL_SYNC_BYTE = 0b01010101
+CTRL_HELLO = ord('H')
+CTRL_PROBE = ord('?')
+CTRL_VERSION = ord('V')
+CTRL_NAK = ord('N')
+CTRL_BAUD = ord('B')
+PROTOCOL_VERSION = 3
+HELLO_MSG = bytes([CTRL_SYNC_BYTE, CTRL_SYNC_BYTE, CTRL_HELLO, PROTOCOL_VERSION])
+PROBE_MSG = bytes([CTRL_SYNC_BYTE, CTRL_SYNC_BYTE, CTRL_PROBE])
+
+#Length of each control message the arduino can send us
+CTRL_LENS = {
+	CTRL_HELLO : 4,
+	CTRL_VERSION : 4,
+	CTRL_NAK : 4,
+	CTRL_BAUD : 4
+}
+
+#Commands we send that are followed by an argument byte
+CTRL_ARG_CMDS = (CTRL_VERSION, CTRL_BAUD)
+
+#Baud rates the arduino can switch to, it always boots at the first one. The 
+#others divide evenly into the arduino's 16MHz clock. If we don't keep a new 
+#baud rate within BAUD_CONFIRM_TIME seconds of the arduino switching to it, it
+#goes back to the first one
+BAUD_RATES = (115200, 250000, 500000, 1000000)
+BAUD_CONFIRM_TIME = 0.5
+
+################################################################################
+def make_crc_table():
+	"""
+	PURPOSE: builds the lookup table for crc8
+	ARGS: none
+	RETURNS: (tuple) CRC-8 of each byte value
+	NOTES:
+	"""
+	table = []
+	for byte in range(256):
+		crc = byte
+		for ii in range(8):
+			crc = ((crc << 1) ^ CRC_POLY) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+		table.append(crc)
+	return tuple(table)
+
+CRC_TABLE = make_crc_table()
+
+################################################################################
+def crc8(data, crc=0):
+	"""
+	PURPOSE: computes the CRC-8 used by protocol version 3
+	ARGS:
+		data (bytes): bytes to compute the CRC of
+		crc (int): CRC of the bytes before data, to continue a CRC
+	RETURNS: (int) the CRC
+	NOTES: same as fp_crc8 in rokenbok/frame_parser.h
+	"""
+	for byte in data:
+		crc = CRC_TABLE[crc ^ byte]
+	return crc
+
+################################################################################
+def version_msg(version):
+	"""
+	PURPOSE: builds the control message asking the arduino to speak a 
+			 protocol version
+	ARGS:
+		version (int): protocol version
+	RETURNS: (bytes) the control message
+	NOTES:
+	"""
+	return bytes([CTRL_SYNC_BYTE, CTRL_SYNC_BYTE, CTRL_VERSION, version])
+
+################################################################################
+def baud_msg(baud_idx):
+	"""
+	PURPOSE: builds the control message asking the arduino to switch baud 
+			 rates
+	ARGS:
+		baud_idx (int): index of the baud rate in BAUD_RATES
+	RETURNS: (bytes) the control message
+	NOTES:
+	"""
+	return bytes([CTRL_SYNC_BYTE, CTRL_SYNC_BYTE, CTRL_BAUD, baud_idx])
+
+################################################################################
+class Decode_Event(Enum):
+	NONE = 0	#need more bytes
+	FRAME = 1	#a frame was applied to the state
+	CTRL = 2	#a control message was received
+	ERROR = 3	#a bad frame was thrown away
+	NAK = 4	#a version 3 frame was rejected
+
+################################################################################
+class Frame_Encoder:
+	"""
+	Builds the frames we send to the arduino from our state, in whichever 
+	protocol version we are speaking
+	"""
+	############################################################################
+	def __init__(self, version=1):
+		"""
+		PURPOSE: creates a new Frame_Encoder
+		ARGS:
+			version (int): protocol version to encode frames in
+		RETURNS: new instance of a Frame_Encoder
+		NOTES:
+		"""
+		self.version = int(version)
+		self.sync = bytes([SYNC_BYTE, SYNC_BYTE])
+		self.last_state = None
+		self.seq = 0xFF
+
+	############################################################################
+	def reset(self):
+		"""
+		PURPOSE: forgets the last state sent so the next frame is a keyframe
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		self.last_state = None
+
+	############################################################################
+	def encode(self, state, keyframe=False):
+		"""
+		PURPOSE: builds the next frame to send
+		ARGS:
+			state (bytes): the state to send, STATE_LEN bytes
+			keyframe (bool): True to send the whole state even if only part 
+							 of it changed
+		RETURNS: (bytes) the frame
+		NOTES: in version 2 and up only what changed since the last frame is 
+			   sent, unless it is a keyframe or the first frame since a reset.
+			   In version 3 each frame gets the next sequence number, which is
+			   left in seq
+		"""
+		if self.version < 2:
+			return self.sync + bytes(state)
+
+		last_state = self.last_state
+		self.last_state = bytes(state)
+		if keyframe or last_state is None:
+			body = ALL_CHANGED + self.last_state
+		else:
+			bitmap = 0
+			values = bytearray()
+			for idx in range(STATE_LEN):
+				if state[idx] != last_state[idx]:
+					bitmap |= 1 << idx
+					values.append(state[idx])
+			body = bitmap.to_bytes(BITMAP_LEN, 'little') + bytes(values)
+
+		if self.version < 3:
+			return self.sync + body
+		self.seq = (self.seq + 1) & 0xFF
+		body = bytes([self.seq]) + body
+		return self.sync + body + bytes([crc8(body)])
+
+	############################################################################
+
+################################################################################
+class Frame_Decoder:
+	"""
+	Decodes the frames and control messages we send to the arduino one byte 
+	at a time. This is the python version of rokenbok/frame_parser.h which 
+	runs on the arduino, and the two must stay the same
+	"""
+	############################################################################
+	def __init__(self):
+		"""
+		PURPOSE: creates a new Frame_Decoder
+		ARGS: none
+		RETURNS: new instance of a Frame_Decoder
+		NOTES:
+		"""
+		self.version = 1
+		self.state = bytearray(STATE_LEN)
+		self.state[SEL_IDX - 2:] = bytes([NO_SEL] * 8)
+		self.cmd = 0
+		self.arg = 0
+		self.seq = 0
+		self.expected_seq = 0
+		self.synced = False
+
+		#Parser state
+		self.mode = 'hunt'
+		self.sync_count = 0
+		self.ctrl_count = 0
+		self.bitmap = bytearray()
+		self.buf = bytearray()
+		self.need = 0
+		self.crc = 0
+
+	############################################################################
+	def set_version(self, version):
+		"""
+		PURPOSE: switches protocol versions
+		ARGS:
+			version (int): the protocol version, ignored if we don't speak it
+		RETURNS: none
+		NOTES: version 3 needs a keyframe before it will apply anything
+		"""
+		if version >= 1 and version <= PROTOCOL_VERSION:
+			self.version = version
+			self.synced = False
+
+	############################################################################
+	def feed_byte(self, byte):
+		"""
+		PURPOSE: handles one byte we sent to the arduino
+		ARGS:
+			byte (int): the byte
+		RETURNS: (Decode_Event) what the byte produced, state holds the 
+				 latest state after FRAME and cmd and arg hold the control 
+				 message after CTRL
+		NOTES:
+		"""
+		if self.mode == 'hunt':
+			if self.ctrl_count == 2:
+				self.ctrl_count = 0
+				self.cmd = byte
+				if byte in CTRL_ARG_CMDS:
+					self.mode = 'ctrl_arg'
+					return Decode_Event.NONE
+				self.arg = 0
+				return Decode_Event.CTRL
+			elif byte == SYNC_BYTE:
+				self.ctrl_count = 0
+				self.sync_count += 1
+				if self.sync_count == 2:
+					self.sync_count = 0
+					self.buf = bytearray()
+					self.bitmap = bytearray()
+					self.crc = 0
+					if self.version >= 3:
+						self.mode = 'seq'
+					elif self.version == 2:
+						self.mode = 'bitmap'
+					else:
+						self.mode = 'body'
+			elif byte == CTRL_SYNC_BYTE:
+				self.sync_count = 0
+				self.ctrl_count += 1
+			else:
+				self.sync_count = 0
+				self.ctrl_count = 0
+			return Decode_Event.NONE
+		elif self.mode == 'ctrl_arg':
+			self.arg = byte
+			self.mode = 'hunt'
+			return Decode_Event.CTRL
+		elif self.mode == 'body':
+			self.buf.append(byte)
+			if len(self.buf) < STATE_LEN:
+				return Decode_Event.NONE
+			self.state[:] = self.buf
+			self.mode = 'hunt'
+			return Decode_Event.FRAME
+		elif self.mode == 'seq':
+			self.seq = byte
+			self.crc = CRC_TABLE[self.crc ^ byte]
+			self.mode = 'bitmap'
+			return Decode_Event.NONE
+		elif self.mode == 'bitmap':
+			self.bitmap.append(byte)
+			self.crc = CRC_TABLE[self.crc ^ byte]
+			if len(self.bitmap) < BITMAP_LEN:
+				return Decode_Event.NONE
+			#Only the low 3 bits of the last bitmap byte are used, anything 
+			#else means we synced on data
+			if self.bitmap[-1] & 0xF8:
+				self.mode = 'hunt'
+				return Decode_Event.NAK if self.version >= 3 else Decode_Event.ERROR
+			self.need = bin(int.from_bytes(self.bitmap, 'little')).count('1')
+			if self.need == 0:
+				#Nothing changed, the host pc is just checking in
+				if self.version >= 3:
+					self.mode = 'crc'
+					return Decode_Event.NONE
+				self.mode = 'hunt'
+				return Decode_Event.FRAME
+			self.mode = 'delta'
+			return Decode_Event.NONE
+		elif self.mode == 'delta':
+			self.buf.append(byte)
+			self.crc = CRC_TABLE[self.crc ^ byte]
+			if len(self.buf) < self.need:
+				return Decode_Event.NONE
+			if self.version >= 3:
+				self.mode = 'crc'
+				return Decode_Event.NONE
+			self.apply_delta()
+			self.mode = 'hunt'
+			return Decode_Event.FRAME
+		else:
+			#Check the CRC, and only apply a delta on top of the frame it 
+			#follows. A keyframe can always be applied
+			self.mode = 'hunt'
+			if byte != self.crc:
+				return Decode_Event.NAK
+			keyframe = self.need == STATE_LEN
+			if not keyframe and (not self.synced or self.seq != self.expected_seq):
+				return Decode_Event.NAK
+			self.apply_delta()
+			self.synced = True
+			self.expected_seq = (self.seq + 1) & 0xFF
+			return Decode_Event.FRAME
+
+	############################################################################
+	def apply_delta(self):
+		"""
+		PURPOSE: copies the changed values into the state
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		bitmap = int.from_bytes(self.bitmap, 'little')
+		values = iter(self.buf)
+		for idx in range(STATE_LEN):
+			if bitmap & (1 << idx):
+				self.state[idx] = next(values)
+
+	############################################################################
+
+
+################################################################################
+class Frame_Parser:
+	"""
+	Incrementally parses the state frames and control messages the arduino 
+	sends back to us. Bytes can be fed in as they arrive in chunks of any size 
+	and complete frames come out. Garbage and frames that don't make sense are 
+	thrown away and the parser resyncs on the next pair of sync bytes
+	"""
+	############################################################################
+	def __init__(self):
+		"""
+		PURPOSE: creates a new Frame_Parser
+		ARGS: none
+		RETURNS: new instance of a Frame_Parser
+		NOTES:
+		"""
+		self.buf = bytearray()
+		self.sync = bytes([SYNC_BYTE, SYNC_BYTE])
+		self.ctrl_sync = bytes([CTRL_SYNC_BYTE, CTRL_SYNC_BYTE])
+
+		#Protocol version the arduino is speaking, follows the VERSION 
+		#messages it sends
+		self.version = 1
+
+		#Statistics
+		self.frames = 0
+		self.parse_errors = 0
+
+	############################################################################
+	def feed(self, data):
+		"""
+		PURPOSE: adds received bytes to the parser
+		ARGS:
+			data (bytes): bytes received from the arduino
+		RETURNS: (list) list of complete frames and control messages (bytes)
+				 found, control messages start with CTRL_SYNC_BYTE
+		NOTES:
+		"""
+		self.buf += data
+		frames = []
+		start = 0
+		while True:
+			idx = self.find_sync(start)
+			if idx < 0:
+				#No sync bytes, throw away everything except a trailing sync 
+				#byte since it could be the start of the next frame
+				end = len(self.buf)
+				if end > start and self.buf[-1] in (SYNC_BYTE, CTRL_SYNC_BYTE):
+					end -= 1
+				if end > start:
+					self.parse_errors += 1
+					start = end
+				break
+			if idx > start:
+				#Skipped over garbage to get to the sync bytes
+				self.parse_errors += 1
+				start = idx
+
+			#Figure out how long the frame or control message is
+			if self.buf[start] == SYNC_BYTE:
+				msg_len = FRAME_LEN_V3 if self.version >= 3 else FRAME_LEN
+			else:
+				if len(self.buf) - start < 3:
+					break
+				msg_len = CTRL_LENS.get(self.buf[start + 2])
+				if msg_len is None:
+					#Unknown command, try again starting at the next byte
+					self.parse_errors += 1
+					start += 1
+					continue
+			if len(self.buf) - start < msg_len:
+				break
+
+			frame = bytes(self.buf[start:start + msg_len])
+			if self.is_valid(frame):
+				frames.append(frame)
+				if frame[0] == SYNC_BYTE:
+					self.frames += 1
+				elif frame[2] == CTRL_VERSION:
+					self.version = frame[3]
+				start += msg_len
+			else:
+				#False sync, try again starting at the next byte
+				self.parse_errors += 1
+				start += 1
+
+		del self.buf[:start]
+		return frames
+
+	############################################################################
+	def find_sync(self, start):
+		"""
+		PURPOSE: finds the next pair of sync bytes of either kind
+		ARGS:
+			start (int): index in the buffer to start looking at
+		RETURNS: (int) index of the first sync byte or -1 if not found
+		NOTES:
+		"""
+		idx = self.buf.find(self.sync, start)
+		ctrl_idx = self.buf.find(self.ctrl_sync, start)
+		if idx < 0 or (ctrl_idx >= 0 and ctrl_idx < idx):
+			return ctrl_idx
+		return idx
+
+	############################################################################
+	def is_valid(self, frame):
+		"""
+		PURPOSE: checks if a frame makes sense
+		ARGS:
+			frame (bytes): frame to check, starting at the sync bytes
+		RETURNS: (bool) True if the frame is valid, False if not
+		NOTES: every selection must be a car (0-7) or no selection and in 
+			   version 3 the CRC must match, control messages are always valid
+		"""
+		if frame[0] == CTRL_SYNC_BYTE:
+			return True
+		if len(frame) == FRAME_LEN_V3 and crc8(frame[2:-1]) != frame[-1]:
+			return False
+		for sel in frame[SEL_IDX:FRAME_LEN]:
+			if sel > 7 and sel != NO_SEL:
+				return False
+		return True
+
+	############################################################################
+	def reset(self):
+		"""
+		PURPOSE: throws away any partially received frame and goes back to 
+				 protocol version 1
+		ARGS: none
+		RETURNS: none
+		NOTES: statistics are kept
+		"""
+		self.buf = bytearray()
+		self.version = 1
+
+	############################################################################
+
+################################################################################
@@ -0,0 +1,644 @@
+#Imports
+import serial
+import serial.tools.list_ports as list_ports
+import os
+import socket
+import threading
+import time
+from Arduino_Emulator import Arduino_Emulator
+from Hub_Protocol import BAUD_RATES
+
+################################################################################
+#File where the serial port the arduino was last found on is remembered
+PORT_CACHE = os.path.join(os.path.expanduser('~'), '.rokenbok_port')
+
+#USB vendor ids of arduino boards, anything else has to call itself an arduino
+#in its description or manufacturer
+ARDUINO_VIDS = (0x2341, 0x2A03)
+
+#Bits it takes to send a byte over a serial port (start bit, 8 data bits and 
+#a stop bit)
+BITS_PER_BYTE = 10
+
+################################################################################
+class Hub_Transport:
+	"""
+	The link between Rokenbok_Hub and the arduino. Subclasses carry the bytes
+	over a serial port, a pseudo-terminal, a TCP socket or straight into an
+	emulated arduino in memory so the same hub code can run with or without a
+	real arduino
+	"""
+	############################################################################
+	def __init__(self, boot_time=0, timeout=0.1):
+		"""
+		PURPOSE: creates a new Hub_Transport
+		ARGS:
+			boot_time (float): max seconds the arduino needs after the link 
+							   is opened before it can receive frames
+			timeout (float): max seconds a read will block for
+		RETURNS: new instance of a Hub_Transport
+		NOTES: the hub normally starts sending frames as soon as the arduino 
+			   says it is ready, boot_time is only how long to wait for that
+			   before giving up and assuming it is ready
+		"""
+		self.boot_time = float(boot_time)
+		self.timeout = float(timeout)
+		self.name = self.__class__.__name__
+
+		#Baud rate of the link, None if it doesn't have one
+		self.baudrate = None
+
+	############################################################################
+	def open(self):
+		"""
+		PURPOSE: opens the link to the arduino
+		ARGS: none
+		RETURNS: none
+		NOTES: raises an OSError if it can't be opened
+		"""
+		raise NotImplementedError
+
+	############################################################################
+	def close(self):
+		"""
+		PURPOSE: closes the link to the arduino if it is open
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		raise NotImplementedError
+
+	############################################################################
+	def is_open(self):
+		"""
+		PURPOSE: checks if the link to the arduino is open
+		ARGS: none
+		RETURNS: (bool) True if open, False if not
+		NOTES:
+		"""
+		raise NotImplementedError
+
+	############################################################################
+	def write(self, data):
+		"""
+		PURPOSE: writes bytes to the arduino
+		ARGS:
+			data (bytes): bytes to write
+		RETURNS: none
+		NOTES: raises an OSError if the link breaks
+		"""
+		raise NotImplementedError
+
+	############################################################################
+	def read(self, size=4096):
+		"""
+		PURPOSE: reads bytes sent by the arduino
+		ARGS:
+			size (int): max number of bytes to read
+		RETURNS: (bytes) bytes read, empty if nothing arrived before the
+				 timeout
+		NOTES: raises an OSError if the link breaks
+		"""
+		raise NotImplementedError
+
+	############################################################################
+	def flush(self):
+		"""
+		PURPOSE: waits until everything written has been sent
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		pass
+
+	############################################################################
+	def set_baudrate(self, baudrate):
+		"""
+		PURPOSE: changes the baud rate of the link
+		ARGS:
+			baudrate (int): the new baud rate
+		RETURNS: none
+		NOTES: ignored by links without a baud rate. Opening the link again
+			   goes back to the baud rate the arduino boots at
+		"""
+		pass
+
+	############################################################################
+	def handshake_failed(self):
+		"""
+		PURPOSE: tells the link the arduino never said it was ready after
+				 the link was opened
+		ARGS: none
+		RETURNS: (bool) True if the link now leads somewhere else and should
+				 be opened again, False if not
+		NOTES: older firmware never says it is ready, so most links ignore
+			   this
+		"""
+		return False
+
+	############################################################################
+
+################################################################################
+def is_arduino(port):
+	"""
+	PURPOSE: checks if a serial port looks like an arduino
+	ARGS:
+		port (ListPortInfo): the serial port, from list_ports.comports
+	RETURNS: (bool) True if it looks like an arduino, False if not
+	NOTES:
+	"""
+	if port.vid in ARDUINO_VIDS:
+		return True
+	description = (port.description or '').lower()
+	manufacturer = (port.manufacturer or '').lower()
+	return 'arduino' in description or 'arduino' in manufacturer
+
+################################################################################
+class Serial_Transport(Hub_Transport):
+	"""
+	Talks to the arduino over a serial port (normally the arduino's USB port)
+	"""
+	############################################################################
+	def __init__(self, port=None, baudrate=115200, boot_time=5, timeout=0.1):
+		"""
+		PURPOSE: creates a new Serial_Transport
+		ARGS:
+			port (str): name of the serial port to communicate to the arduino
+						with. If left at 'None' then it will try to find the
+						correct serial port itself.
+			baudrate (int): baudrate to communicate to the arduino with
+			boot_time (float): max seconds the arduino needs to reboot after 
+							   the serial port is opened
+			timeout (float): max seconds a read will block for
+		RETURNS: new instance of a Serial_Transport
+		NOTES: raises a ValueError if it can't find the serial port
+		"""
+		Hub_Transport.__init__(self, boot_time, timeout)
+		self.boot_baudrate = int(baudrate)
+		self.baudrate = self.boot_baudrate
+		self.ser = None
+
+		#Find serial port if needed. cached is True while the port is the one
+		#the arduino was found on last time and hasn't been proven right yet
+		self.port = None
+		self.cached = False
+		if port is None:
+			self.port = self.find_port()
+			if self.port is None:
+				raise ValueError("Can't find serial port for arduino!")
+		else:
+			self.port = str(port)
+		self.name = self.port
+
+	############################################################################
+	def find_port(self, skip=()):
+		"""
+		PURPOSE: looks for the serial port the arduino is plugged into
+		ARGS:
+			skip (tuple): names of serial ports to leave out
+		RETURNS: (str) name of the serial port or None if not found
+		NOTES: prefers the port the arduino was found on last time if it
+			   still looks like an arduino, so the same one is picked when
+			   there are several
+		"""
+		ports = [port.device for port in list_ports.comports() if is_arduino(port) and port.device not in skip]
+
+		#Try the cached port
+		self.cached = False
+		try:
+			with open(PORT_CACHE) as f:
+				port = f.read().strip()
+			if port in ports:
+				self.cached = True
+				return port
+		except OSError:
+			pass
+
+		#Use the first arduino found and remember it for next time
+		if not ports:
+			return None
+		try:
+			with open(PORT_CACHE, 'w') as f:
+				f.write(ports[0])
+		except OSError:
+			pass
+		return ports[0]
+
+	############################################################################
+	def rescan(self):
+		"""
+		PURPOSE: moves to another arduino if the cached port turned out to be
+				 wrong
+		ARGS: none
+		RETURNS: (bool) True if it moved to another port, False if not
+		NOTES: only rescans once, and only if the port came from the cache
+		"""
+		if not self.cached:
+			return False
+		port = self.find_port(skip=(self.port,))
+		self.cached = False
+		if port is None:
+			return False
+		print("No arduino on '%s', trying '%s'..." % (self.port, port))
+		self.port = port
+		self.name = port
+		return True
+
+	############################################################################
+	def open(self):
+		"""
+		PURPOSE: opens the serial port
+		ARGS: none
+		RETURNS: none
+		NOTES: opening the serial port restarts the arduino, raises an
+			   OSError if it can't be opened
+		"""
+		self.close()
+		self.baudrate = self.boot_baudrate
+		try:
+			self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=self.timeout)
+		except OSError:
+			if not self.rescan():
+				raise
+			self.ser = serial.Serial(port=self.port, baudrate=self.baudrate, timeout=self.timeout)
+
+	############################################################################
+	def close(self):
+		"""
+		PURPOSE: closes the serial port if it is open
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		if self.ser and self.ser.isOpen():
+			self.ser.close()
+		self.ser = None
+
+	############################################################################
+	def is_open(self):
+		"""
+		PURPOSE: checks if the serial port is open
+		ARGS: none
+		RETURNS: (bool) True if open, False if not
+		NOTES:
+		"""
+		return bool(self.ser and self.ser.isOpen())
+
+	############################################################################
+	def write(self, data):
+		"""
+		PURPOSE: writes bytes to the arduino
+		ARGS:
+			data (bytes): bytes to write
+		RETURNS: none
+		NOTES:
+		"""
+		self.ser.write(data)
+
+	############################################################################
+	def read(self, size=4096):
+		"""
+		PURPOSE: reads bytes sent by the arduino
+		ARGS:
+			size (int): max number of bytes to read
+		RETURNS: (bytes) bytes read, empty if nothing arrived before the
+				 timeout
+		NOTES: returns everything already waiting (up to size) without
+			   waiting for more
+		"""
+		return self.ser.read(min(size, self.ser.in_waiting) or 1)
+
+	############################################################################
+	def flush(self):
+		"""
+		PURPOSE: waits until everything written has been sent
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		self.ser.flush()
+
+	############################################################################
+	def set_baudrate(self, baudrate):
+		"""
+		PURPOSE: changes the baud rate of the serial port
+		ARGS:
+			baudrate (int): the new baud rate
+		RETURNS: none
+		NOTES: raises a ValueError if the serial port can't use the baud rate
+		"""
+		self.baudrate = int(baudrate)
+		if self.ser:
+			self.ser.baudrate = self.baudrate
+
+	############################################################################
+	def handshake_failed(self):
+		"""
+		PURPOSE: tells the link the arduino never said it was ready after
+				 the serial port was opened
+		ARGS: none
+		RETURNS: (bool) True if it moved to another serial port and should
+				 be opened again, False if not
+		NOTES: the cached port may now be something else, so it scans for
+			   another arduino
+		"""
+		return self.rescan()
+
+	############################################################################
+
+################################################################################
+class Pty_Transport(Serial_Transport):
+	"""
+	Talks to an emulated arduino through a pseudo-terminal, so bytes go
+	through the same serial port code and kernel tty layer as a real arduino
+	"""
+	############################################################################
+	def __init__(self, emulator=None, baudrate=115200, timeout=0.1):
+		"""
+		PURPOSE: creates a new Pty_Transport
+		ARGS:
+			emulator (Arduino_Emulator): emulator on the other end of the
+										 pseudo-terminal, if None then
+										 creates one
+			baudrate (int): baudrate to set on the pseudo-terminal
+			timeout (float): max seconds a read will block for
+		RETURNS: new instance of a Pty_Transport
+		NOTES: baudrate has no effect on how fast bytes move through a
+			   pseudo-terminal, but the emulator garbles bytes if it is 
+			   listening at a different baud rate. Only works on platforms 
+			   with pseudo-terminals (not windows)
+		"""
+		#Imported here so the rest of the module still works on windows
+		import pty
+		import tty
+
+		self.emulator = emulator if emulator else Arduino_Emulator()
+		self.master, self.slave = pty.openpty()
+		tty.setraw(self.slave)
+		Serial_Transport.__init__(self, os.ttyname(self.slave), baudrate, 1, timeout)
+
+		#Run the emulator on the other end of the pseudo-terminal
+		self.emulator_thread = threading.Thread(target=self.run_emulator, daemon=True)
+		self.emulator_thread.start()
+
+	############################################################################
+	def run_emulator(self):
+		"""
+		PURPOSE: feeds everything written to the pseudo-terminal through the
+				 emulator and writes back its responses
+		ARGS: none
+		RETURNS: none
+		NOTES: runs in a seperate thread until the pseudo-terminal is deleted
+		"""
+		try:
+			while True:
+				data = os.read(self.master, 4096)
+				if not data:
+					break
+				resp = self.emulator.feed(data, self.baudrate)
+				if resp:
+					os.write(self.master, resp)
+		except OSError:
+			pass
+
+	############################################################################
+	def open(self):
+		"""
+		PURPOSE: opens the pseudo-terminal
+		ARGS: none
+		RETURNS: none
+		NOTES: resets the emulator like a real arduino restarting
+		"""
+		Serial_Transport.open(self)
+		os.write(self.master, self.emulator.reset())
+
+	############################################################################
+	def __del__(self):
+		"""
+		PURPOSE: performs any necessary cleanup
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		self.close()
+		for fd in (self.slave, self.master):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+	############################################################################
+
+################################################################################
+class TCP_Transport(Hub_Transport):
+	"""
+	Talks to an arduino over a TCP socket, such as a serial to network bridge
+	or Rokenbok_Hub_Emulator.py running on another machine
+	"""
+	############################################################################
+	def __init__(self, host='127.0.0.1', port=9000, boot_time=2, timeout=0.1):
+		"""
+		PURPOSE: creates a new TCP_Transport
+		ARGS:
+			host (str): host name or ip address to connect to
+			port (int): port to connect to
+			boot_time (float): max seconds the arduino needs after 
+							   connecting before it can receive frames
+			timeout (float): max seconds a read will block for
+		RETURNS: new instance of a TCP_Transport
+		NOTES:
+		"""
+		Hub_Transport.__init__(self, boot_time, timeout)
+		self.host = str(host)
+		self.port = int(port)
+		self.sock = None
+		self.name = "%s:%d" % (self.host, self.port)
+
+	############################################################################
+	def open(self):
+		"""
+		PURPOSE: connects to the socket
+		ARGS: none
+		RETURNS: none
+		NOTES: raises an OSError if it can't connect
+		"""
+		self.close()
+		sock = socket.create_connection((self.host, self.port), timeout=5)
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		sock.settimeout(self.timeout)
+		self.sock = sock
+
+	############################################################################
+	def close(self):
+		"""
+		PURPOSE: closes the socket if it is open
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		if self.sock:
+			self.sock.close()
+		self.sock = None
+
+	############################################################################
+	def is_open(self):
+		"""
+		PURPOSE: checks if the socket is open
+		ARGS: none
+		RETURNS: (bool) True if open, False if not
+		NOTES:
+		"""
+		return self.sock is not None
+
+	############################################################################
+	def write(self, data):
+		"""
+		PURPOSE: writes bytes to the arduino
+		ARGS:
+			data (bytes): bytes to write
+		RETURNS: none
+		NOTES:
+		"""
+		self.sock.sendall(data)
+
+	############################################################################
+	def read(self, size=4096):
+		"""
+		PURPOSE: reads bytes sent by the arduino
+		ARGS:
+			size (int): max number of bytes to read
+		RETURNS: (bytes) bytes read, empty if nothing arrived before the
+				 timeout
+		NOTES: raises a ConnectionError if the other end closes the socket
+		"""
+		try:
+			data = self.sock.recv(size)
+		except socket.timeout:
+			return b''
+		if data == b'':
+			raise ConnectionError("Socket broken")
+		return data
+
+	############################################################################
+
+################################################################################
+class Loopback_Transport(Hub_Transport):
+	"""
+	Sends bytes straight into an emulated arduino in memory, no operating
+	system I/O involved. Useful for testing and benchmarking the hub code
+	"""
+	############################################################################
+	def __init__(self, emulator=None, timeout=0.1, paced=False):
+		"""
+		PURPOSE: creates a new Loopback_Transport
+		ARGS:
+			emulator (Arduino_Emulator): emulator to send bytes to, if None
+										 then creates one
+			timeout (float): max seconds a read will block for
+			paced (bool): if True then bytes take as long to get to the 
+						  emulator and back as they would over a serial port
+						  at the current baud rate
+		RETURNS: new instance of a Loopback_Transport
+		NOTES:
+		"""
+		Hub_Transport.__init__(self, 1, timeout)
+		self.baudrate = BAUD_RATES[0]
+		self.paced = bool(paced)
+		self.emulator = emulator if emulator else Arduino_Emulator()
+		self.rx_buf = bytearray()
+		self.rx_cond = threading.Condition()
+		self.opened = False
+
+	############################################################################
+	def open(self):
+		"""
+		PURPOSE: opens the link to the emulator
+		ARGS: none
+		RETURNS: none
+		NOTES: resets the emulator like a real arduino restarting
+		"""
+		with self.rx_cond:
+			self.baudrate = BAUD_RATES[0]
+			self.rx_buf = bytearray(self.emulator.reset())
+			self.opened = True
+			self.rx_cond.notify_all()
+
+	############################################################################
+	def close(self):
+		"""
+		PURPOSE: closes the link to the emulator
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		with self.rx_cond:
+			self.opened = False
+			self.rx_cond.notify_all()
+
+	############################################################################
+	def is_open(self):
+		"""
+		PURPOSE: checks if the link to the emulator is open
+		ARGS: none
+		RETURNS: (bool) True if open, False if not
+		NOTES:
+		"""
+		return self.opened
+
+	############################################################################
+	def write(self, data):
+		"""
+		PURPOSE: feeds bytes to the emulator and queues up its response
+		ARGS:
+			data (bytes): bytes to write
+		RETURNS: none
+		NOTES: raises a ConnectionError if the link is closed. When paced this
+			   blocks until the bytes would have been sent, and the response 
+			   shows up once it would have been received
+		"""
+		with self.rx_cond:
+			if not self.opened:
+				raise ConnectionError("Loopback closed")
+			resp = self.emulator.feed(data, self.baudrate)
+		if self.paced:
+			#The serial port is full duplex so the response is sent while we
+			#are still sending
+			time.sleep(max(len(data), len(resp)) * BITS_PER_BYTE / self.baudrate)
+		with self.rx_cond:
+			if resp:
+				self.rx_buf += resp
+				self.rx_cond.notify_all()
+
+	############################################################################
+	def read(self, size=4096):
+		"""
+		PURPOSE: reads bytes sent back by the emulator
+		ARGS:
+			size (int): max number of bytes to read
+		RETURNS: (bytes) bytes read, empty if nothing arrived before the
+				 timeout
+		NOTES: raises a ConnectionError if the link is closed
+		"""
+		with self.rx_cond:
+			if not self.rx_buf and self.opened:
+				self.rx_cond.wait(self.timeout)
+			if not self.opened:
+				raise ConnectionError("Loopback closed")
+			data = bytes(self.rx_buf[:size])
+			del self.rx_buf[:size]
+		return data
+
+	############################################################################
+	def set_baudrate(self, baudrate):
+		"""
+		PURPOSE: changes the baud rate we talk to the emulator at
+		ARGS:
+			baudrate (int): the new baud rate
+		RETURNS: none
+		NOTES:
+		"""
+		self.baudrate = int(baudrate)
+
+	############################################################################
+
+################################################################################
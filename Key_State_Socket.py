@@ -0,0 +1,386 @@
+#Imports
+import random
+import socket
+import struct
+import sys
+import time
+
+################################################################################
+#Each packet is the session token the server gave the client in its START
+#message, a sequence number and a bitmap of every key that is held down (bit
+#n of the bitmap is ascii code n, lowest ascii codes first)
+KEY_STATE_FMT = '>HI32s'
+KEY_STATE_LEN = struct.calcsize(KEY_STATE_FMT)
+SEQ_MOD = 1 << 32
+
+#After the keys change the new state is sent this many extra times, one tick
+#apart, so a lost packet is made up for quickly. After that the state is
+#resent every KEEPALIVE seconds so a change is never lost for good
+REPEATS = 3
+KEEPALIVE = 0.25
+
+################################################################################
+def seq_newer(seq, last):
+	"""
+	PURPOSE: checks if a sequence number is newer than another
+	ARGS:
+		seq (int): the sequence number to check
+		last (int): the sequence number to compare it to, or None if nothing
+					has been received yet
+	RETURNS: (bool) True if seq is newer than last
+	NOTES: sequence numbers wrap, anything up to half way around ahead of
+		   last is newer
+	"""
+	if last is None:
+		return True
+	diff = (seq - last) % SEQ_MOD
+	return 0 < diff < SEQ_MOD // 2
+
+################################################################################
+def pack_key_state(token, seq, keys):
+	"""
+	PURPOSE: builds a key state packet
+	ARGS:
+		token (int): the session token
+		seq (int): the sequence number
+		keys (bytes): the 32 byte bitmap of keys held down
+	RETURNS: (bytes) the packet
+	NOTES:
+	"""
+	return struct.pack(KEY_STATE_FMT, token, seq % SEQ_MOD, bytes(keys))
+
+################################################################################
+def unpack_key_state(data):
+	"""
+	PURPOSE: reads a key state packet
+	ARGS:
+		data (bytes): the packet
+	RETURNS: (tuple) the session token, sequence number and 32 byte bitmap of
+			 keys held down, or None if the packet is the wrong length
+	NOTES:
+	"""
+	if len(data) != KEY_STATE_LEN:
+		return None
+	return struct.unpack(KEY_STATE_FMT, data)
+
+################################################################################
+class Key_State_Tracker:
+	"""
+	Keeps track of the newest key state received from a client and turns each
+	newer state into key presses and releases. Older and repeated states are
+	dropped
+	"""
+	############################################################################
+	def __init__(self):
+		"""
+		PURPOSE: creates a new Key_State_Tracker
+		ARGS: none
+		RETURNS: new instance of a Key_State_Tracker
+		NOTES: starts with no keys held down
+		"""
+		self.seq = None
+		self.keys = bytes(32)
+		self.stale = 0
+
+	############################################################################
+	def update(self, seq, keys):
+		"""
+		PURPOSE: applies a key state
+		ARGS:
+			seq (int): the sequence number of the state
+			keys (bytes): the 32 byte bitmap of keys held down
+		RETURNS: (list) a (ascii code, pressed) tuple for each key that
+				 changed, or None if the state is not newer than the last one
+		NOTES:
+		"""
+		if not seq_newer(seq, self.seq):
+			self.stale += 1
+			return None
+		changes = []
+		for ii in range(32):
+			diff = keys[ii] ^ self.keys[ii]
+			if not diff:
+				continue
+			for bit in range(8):
+				if diff & (1 << bit):
+					changes.append((ii * 8 + bit, bool(keys[ii] & (1 << bit))))
+		self.seq = seq
+		self.keys = bytes(keys)
+		return changes
+
+	############################################################################
+
+################################################################################
+class Key_State_Socket:
+	"""
+	Sends the state of every key to the server over UDP, so a lost packet
+	doesn't hold up the key presses after it like it would over TCP
+	"""
+	############################################################################
+	def __init__(self, token, sock=None):
+		"""
+		PURPOSE: creates a new Key_State_Socket
+		ARGS:
+			token (int): the session token the server sent in its START
+						 message
+			sock (socket): socket to use, if None then creates one
+		RETURNS: new instance of a Key_State_Socket
+		NOTES:
+		"""
+		#Save arguments
+		self.token = int(token)
+		if sock:
+			self.sock = sock
+		else:
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+		#The keys held down, the sequence number of that state, how many more
+		#times to repeat it and when it was last sent
+		self.keys = bytearray(32)
+		self.seq = 0
+		self.repeats = 0
+		self.sent_time = None
+
+	############################################################################
+	def __del__(self):
+		"""
+		PURPOSE: performs any necessary cleanup
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		self.close()
+
+	############################################################################
+	def connect(self, ip, port):
+		"""
+		PURPOSE: sets where the key states are sent
+		ARGS:
+			ip (str): ip address of the server
+			port (int): the udp port of the server
+		RETURNS: none
+		NOTES:
+		"""
+		self.sock.connect((ip, port))
+
+	############################################################################
+	def set_key(self, ascii_code, pressed):
+		"""
+		PURPOSE: presses or releases a key
+		ARGS:
+			ascii_code (int): the ascii code of the key
+			pressed (bool): True if the key was pressed, False if released
+		RETURNS: (bool) True if the state of the keys changed
+		NOTES: the new state isn't sent until the next call to send
+		"""
+		ascii_code = int(ascii_code) & 0xFF
+		byte = self.keys[ascii_code >> 3]
+		if pressed:
+			self.keys[ascii_code >> 3] |= 1 << (ascii_code & 7)
+		else:
+			self.keys[ascii_code >> 3] &= ~(1 << (ascii_code & 7)) & 0xFF
+		if self.keys[ascii_code >> 3] == byte:
+			return False
+		self.seq = (self.seq + 1) % SEQ_MOD
+		self.repeats = REPEATS + 1
+		return True
+
+	############################################################################
+	def send(self):
+		"""
+		PURPOSE: sends the state of the keys if it is due to be sent
+		ARGS: none
+		RETURNS: (bool) True if a packet was sent
+		NOTES: should be called regularly, a new state is sent straight away
+			   and then repeated on the next few calls
+		"""
+		now = time.time()
+		if self.repeats:
+			self.repeats -= 1
+		elif self.sent_time is not None and now - self.sent_time < KEEPALIVE:
+			return False
+		self.sent_time = now
+		self.sock.send(pack_key_state(self.token, self.seq, self.keys))
+		return True
+
+	############################################################################
+	def setblocking(self, blocking):
+		"""
+		PURPOSE: switches between blocking and non-blocking mode
+		ARGS:
+			blocking (bool): if False then send never waits
+		RETURNS: none
+		NOTES: sending in non-blocking mode raises a BlockingIOError if the 
+			   socket's send buffer is full
+		"""
+		self.sock.setblocking(blocking)
+
+	############################################################################
+	def close(self):
+		"""
+		PURPOSE: closes the socket
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		self.sock.close()
+
+	############################################################################
+
+################################################################################
+class Lossy_Socket:
+	"""
+	Wraps a UDP socket and drops and reorders the packets sent through it, to
+	test Key_State_Socket over a bad network
+	"""
+	############################################################################
+	def __init__(self, sock, loss_rate, reorder_rate, rng):
+		"""
+		PURPOSE: creates a new Lossy_Socket
+		ARGS:
+			sock (socket): the socket to send through
+			loss_rate (float): chance of any packet being dropped
+			reorder_rate (float): chance of any packet being held back and
+								  sent after the next one
+			rng (random.Random): random number generator to use
+		RETURNS: new instance of a Lossy_Socket
+		NOTES:
+		"""
+		self.sock = sock
+		self.loss_rate = loss_rate
+		self.reorder_rate = reorder_rate
+		self.rng = rng
+		self.held = []
+		self.dropped = 0
+		self.reordered = 0
+
+	############################################################################
+	def connect(self, addr):
+		"""
+		PURPOSE: sets where packets are sent
+		ARGS:
+			addr (tuple): ip address and port to send to
+		RETURNS: none
+		NOTES:
+		"""
+		self.sock.connect(addr)
+
+	############################################################################
+	def send(self, data):
+		"""
+		PURPOSE: sends a packet, unless it gets dropped or held back
+		ARGS:
+			data (bytes): the packet
+		RETURNS: (int) number of bytes "sent"
+		NOTES: held back packets are sent after the next packet that isn't
+		"""
+		if self.rng.random() < self.loss_rate:
+			self.dropped += 1
+			return len(data)
+		if self.rng.random() < self.reorder_rate:
+			self.reordered += 1
+			self.held.append(data)
+			return len(data)
+		self.sock.send(data)
+		while self.held:
+			self.sock.send(self.held.pop(0))
+		return len(data)
+
+	############################################################################
+	def close(self):
+		"""
+		PURPOSE: closes the socket
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		self.sock.close()
+
+	############################################################################
+
+################################################################################
+def loopback_test(presses=2000, loss_rate=0.2, reorder_rate=0.2, seed=None):
+	"""
+	PURPOSE: sends random key presses over a lossy loopback UDP link and
+			 checks the receiver ends up with the same keys held down
+	ARGS:
+		presses (int): number of key presses and releases to send
+		loss_rate (float): chance of any packet being dropped
+		reorder_rate (float): chance of any packet being sent out of order
+		seed (int): seed for the random numbers, if None then a random seed
+	RETURNS: (dict) results with the keys 'ok', 'sent', 'dropped',
+			 'reordered', 'stale' and 'changes'
+	NOTES: 'ok' is False if a stale state was ever applied or the keys held
+		   down don't match at the end
+	"""
+	rng = random.Random(seed)
+	recv_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	recv_sock.bind(('127.0.0.1', 0))
+	recv_sock.settimeout(0.5)
+	lossy = Lossy_Socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), loss_rate, reorder_rate, rng)
+	sender = Key_State_Socket(0x1234, lossy)
+	sender.connect(*recv_sock.getsockname())
+	tracker = Key_State_Tracker()
+	held = set()
+	ok = True
+	sent = 0
+	changes = 0
+
+	def receive(wait):
+		#Apply everything that has arrived
+		nonlocal ok, changes
+		recv_sock.settimeout(wait)
+		while True:
+			try:
+				data = recv_sock.recv(64)
+			except (socket.timeout, BlockingIOError) as e:
+				return
+			recv_sock.settimeout(0)
+			token, seq, keys = unpack_key_state(data)
+			last = tracker.seq
+			result = tracker.update(seq, keys)
+			if result is None:
+				continue
+			if last is not None and seq <= last:
+				ok = False
+			for ascii_code, pressed in result:
+				changes += 1
+				if pressed:
+					held.add(ascii_code)
+				else:
+					held.discard(ascii_code)
+
+	keys = [24, 25, 26, 27] + [ord(c) for c in 'swadq12']
+	for ii in range(presses):
+		sender.set_key(rng.choice(keys), rng.random() < 0.5)
+		sent += sender.send()
+		receive(0)
+	#Let the repeats and keepalives get the last state through
+	end_time = time.time() + 20 * KEEPALIVE
+	while tracker.seq != sender.seq and time.time() < end_time:
+		sent += sender.send()
+		receive(0.001)
+
+	want = set(ii for ii in range(256) if sender.keys[ii >> 3] & (1 << (ii & 7)))
+	ok = ok and held == want and tracker.seq == sender.seq
+	sender.close()
+	recv_sock.close()
+	return {
+		'ok' : ok,
+		'sent' : sent,
+		'dropped' : lossy.dropped,
+		'reordered' : lossy.reordered,
+		'stale' : tracker.stale,
+		'changes' : changes
+	}
+
+################################################################################
+if __name__ == "__main__":
+	#[loss rate] [reorder rate] [seed]
+	loss_rate = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+	reorder_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+	seed = int(sys.argv[3]) if len(sys.argv) > 3 else None
+	result = loopback_test(loss_rate=loss_rate, reorder_rate=reorder_rate, seed=seed)
+	print("Sent %d packets, dropped %d, reordered %d, %d stale packets ignored, %d key changes applied" % (result['sent'], result['dropped'], result['reordered'], result['stale'], result['changes']))
+	print("PASS" if result['ok'] else "FAIL")
+	sys.exit(0 if result['ok'] else 1)
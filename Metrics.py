@@ -0,0 +1,165 @@
+#Imports
+import bisect
+import math
+import threading
+import time
+
+################################################################################
+#Upper bounds in seconds of the buckets of the histograms we keep
+RTT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+WRITE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025)
+
+################################################################################
+class Histogram:
+	"""
+	Counts values in buckets the way a prometheus histogram does, cheap
+	enough to observe a value on every frame or message
+	"""
+	############################################################################
+	def __init__(self, buckets):
+		"""
+		PURPOSE: creates a new Histogram
+		ARGS:
+			buckets (tuple): upper bound of each bucket, smallest first
+		RETURNS: new instance of a Histogram
+		NOTES: values bigger than the last bucket only show up in the count
+			   and sum
+		"""
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	############################################################################
+	def observe(self, value):
+		"""
+		PURPOSE: adds a value to the histogram
+		ARGS:
+			value (float): the value
+		RETURNS: none
+		NOTES: should only be called from one thread
+		"""
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	############################################################################
+	def render(self, name, labels=''):
+		"""
+		PURPOSE: formats the histogram as prometheus text
+		ARGS:
+			name (str): name of the metric
+			labels (str): labels to add to each sample, like 'player="1"'
+		RETURNS: (list) a line for each sample
+		NOTES: the HELP and TYPE lines are left to the caller
+		"""
+		sep = ',' if labels else ''
+		lines = []
+		total = 0
+		for bound, count in zip(self.buckets, self.counts):
+			total += count
+			lines.append('%s_bucket{%s%sle="%g"} %d' % (name, labels, sep, bound, total))
+		lines.append('%s_bucket{%s%sle="+Inf"} %d' % (name, labels, sep, self.count))
+		braces = '{%s}' % labels if labels else ''
+		lines.append('%s_sum%s %s' % (name, braces, format_value(self.sum)))
+		lines.append('%s_count%s %d' % (name, braces, self.count))
+		return lines
+
+	############################################################################
+
+################################################################################
+class Timed_Lock:
+	"""
+	A lock that keeps track of how long threads spend waiting for it and
+	holding it. Used like a threading.Lock in a with statement
+	"""
+	############################################################################
+	def __init__(self):
+		"""
+		PURPOSE: creates a new Timed_Lock
+		ARGS: none
+		RETURNS: new instance of a Timed_Lock
+		NOTES:
+		"""
+		self.lock = threading.Lock()
+		self.acquisitions = 0
+		self.wait_time = 0.0
+		self.hold_time = 0.0
+		self.acquired_time = 0.0
+
+	############################################################################
+	def __enter__(self):
+		"""
+		PURPOSE: acquires the lock
+		ARGS: none
+		RETURNS: none
+		NOTES: the totals are only changed while holding the lock so they
+			   don't need a lock of their own
+		"""
+		start = time.perf_counter()
+		self.lock.acquire()
+		self.acquired_time = time.perf_counter()
+		self.wait_time += self.acquired_time - start
+		self.acquisitions += 1
+
+	############################################################################
+	def __exit__(self, exc_type, exc_value, traceback):
+		"""
+		PURPOSE: releases the lock
+		ARGS:
+			exc_type (type): type of the exception raised while holding the
+							 lock, if any
+			exc_value (Exception): the exception, if any
+			traceback (traceback): traceback of the exception, if any
+		RETURNS: (bool) False so exceptions are raised
+		NOTES:
+		"""
+		self.hold_time += time.perf_counter() - self.acquired_time
+		self.lock.release()
+		return False
+
+	############################################################################
+
+################################################################################
+def format_value(value):
+	"""
+	PURPOSE: formats the value of a sample as prometheus text
+	ARGS:
+		value (int or float): the value
+	RETURNS: (str) the value
+	NOTES: integers are written out exactly and floats with every digit they
+		   have, so counters never look like they stopped or went backwards
+	"""
+	if isinstance(value, int):
+		return '%d' % value
+	if math.isnan(value):
+		return 'NaN'
+	if math.isinf(value):
+		return '+Inf' if value > 0 else '-Inf'
+	return repr(float(value))
+
+################################################################################
+def format_metric(name, metric_type, help_text, samples):
+	"""
+	PURPOSE: formats a metric as prometheus text
+	ARGS:
+		name (str): name of the metric
+		metric_type (str): 'counter', 'gauge' or 'histogram'
+		help_text (str): what the metric means
+		samples (list): a (labels, value) tuple for each sample, labels is a
+						string like 'player="1"' or '' for no labels. For
+						histograms value is a Histogram
+	RETURNS: (list) the lines for the metric
+	NOTES:
+	"""
+	lines = ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, metric_type)]
+	for labels, value in samples:
+		if metric_type == 'histogram':
+			lines.extend(value.render(name, labels))
+		elif labels:
+			lines.append('%s{%s} %s' % (name, labels, format_value(value)))
+		else:
+			lines.append('%s %s' % (name, format_value(value)))
+	return lines
+
+################################################################################
@@ -0,0 +1,487 @@
+#Imports
+from Rokenbok_Hub import Rokenbok_Hub, BUTTON_IDX
+from Rokenbok_Server import Rokenbok_Server
+from Rokenbok_Controller import KEY_MAP
+from Client_Protocol import Message_Type, MSG_LEN, PROTOCOL_VERSION, FRAME_HEADER_LEN, encode_msg, decode_frame, frame_len
+from Hub_Transport import Loopback_Transport
+from Arduino_Emulator import Arduino_Emulator
+from Fixed_Len_Socket import Fixed_Len_Socket
+from Key_State_Socket import Key_State_Socket
+import json
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+################################################################################
+#Key presses each pattern cycles through, every event toggles one key. 'tap'
+#taps one button, 'drive' holds forward while steering, 'burst' toggles all
+#four arrows at once and 'random' toggles any mapped key
+PATTERNS = {
+	'tap' : [[24]],
+	'drive' : [[24], [26], [26], [27], [27]],
+	'burst' : [[24, 25, 26, 27]],
+	'random' : None
+}
+
+################################################################################
+class Recording_Emulator(Arduino_Emulator):
+	"""
+	An Arduino_Emulator that tells the benchmark whenever a frame from the
+	host pc changes its state
+	"""
+	############################################################################
+	def __init__(self, frame_cb, **kwargs):
+		"""
+		PURPOSE: creates a new Recording_Emulator
+		ARGS:
+			frame_cb (function): called with the new state (bytes) and the
+								 time it was applied whenever a frame
+								 changes the state
+			**kwargs: passed on to Arduino_Emulator
+		RETURNS: new instance of a Recording_Emulator
+		NOTES:
+		"""
+		self.frame_cb = frame_cb
+		Arduino_Emulator.__init__(self, **kwargs)
+
+	############################################################################
+	def update_hub(self):
+		"""
+		PURPOSE: models the hub reading our desired state over SPI
+		ARGS: none
+		RETURNS: none
+		NOTES: the state is compared before calling the callback so
+			   heartbeat frames cost next to nothing
+		"""
+		if self.cur_state != self.decoder.state:
+			Arduino_Emulator.update_hub(self)
+			self.frame_cb(bytes(self.cur_state), time.perf_counter())
+
+	############################################################################
+
+################################################################################
+class Synthetic_Client:
+	"""
+	A client that speaks the same protocol as Rokenbok_Client but presses keys
+	from a pattern instead of the keyboard, and records when it sent each one
+	"""
+	############################################################################
+	def __init__(self, bench, ip, port, pattern, rate, udp_port=None, seed=None, version=1):
+		"""
+		PURPOSE: creates a new Synthetic_Client
+		ARGS:
+			bench (Load_Benchmark): the benchmark to record sent keys with
+			ip (str): ip address of the server
+			port (int): port of the server
+			pattern (str): name of the key pattern to press, see PATTERNS
+			rate (float): number of times per second to step the pattern
+			udp_port (int): port to send key states over UDP on, if None then
+							key presses are sent over TCP
+			seed (int): seed for the 'random' pattern
+			version (int): highest protocol version to speak to the server
+		RETURNS: new instance of a Synthetic_Client
+		NOTES: call run in a seperate thread to start pressing keys
+		"""
+		self.bench = bench
+		self.ip = ip
+		self.port = port
+		self.pattern = pattern
+		self.period = 1.0 / float(rate)
+		self.udp_port = udp_port
+		self.rng = random.Random(seed)
+		self.max_version = int(version)
+		self.version = 1
+		self.player = None
+		self.held = set()
+		self.sent = 0
+		self.sock = None
+		self.key_sock = None
+		self.send_lock = threading.Lock()
+
+	############################################################################
+	def connect(self):
+		"""
+		PURPOSE: connects to the server and waits for a controller
+		ARGS: none
+		RETURNS: (bool) True if we got a controller
+		NOTES:
+		"""
+		self.sock = Fixed_Len_Socket(MSG_LEN)
+		self.sock.connect(self.ip, self.port)
+		msg = self.sock.recv()
+		while msg[0] == Message_Type.WAIT.value:
+			msg = self.sock.recv()
+		if msg[0] != Message_Type.START.value:
+			return False
+		token = (msg[1] << 8) | msg[2]
+		if self.udp_port is not None and token:
+			self.key_sock = Key_State_Socket(token)
+			self.key_sock.connect(self.ip, self.udp_port)
+		if self.max_version >= 2:
+			self.sock.send(encode_msg(1, Message_Type.VERSION, bytes([self.max_version])))
+			msg = self.sock.recv()
+			while msg[0] != Message_Type.VERSION.value:
+				msg = self.sock.recv()
+			self.version = msg[1]
+		return True
+
+	############################################################################
+	def listen(self, stop):
+		"""
+		PURPOSE: echoes heartbeats so the server keeps our controller
+		ARGS:
+			stop (threading.Event): set when the benchmark is over
+		RETURNS: none
+		NOTES: should be run in a seperate thread
+		"""
+		try:
+			while not stop.is_set():
+				if self.version >= 2:
+					records = decode_frame(self.sock.recv(frame_len(self.sock.recv(FRAME_HEADER_LEN))))
+				else:
+					records = [(msg[0], msg[1:]) for msg in self.sock.recv_many()]
+				for msg_type, data in records:
+					if msg_type == Message_Type.HEARTBEAT.value:
+						with self.send_lock:
+							self.sock.send(encode_msg(self.version, Message_Type.HEARTBEAT, data[:1]))
+					elif msg_type == Message_Type.END.value:
+						return
+		except Exception as e:
+			pass
+
+	############################################################################
+	def run(self, player, start_time, end_time):
+		"""
+		PURPOSE: presses keys from our pattern until the benchmark is over
+		ARGS:
+			player (int): our player number (1-8)
+			start_time (float): perf_counter time to start pressing keys
+			end_time (float): perf_counter time to stop pressing keys
+		RETURNS: none
+		NOTES: should be run in a seperate thread. Each step is scheduled
+			   from the start time so a slow step doesn't slow the rate down
+		"""
+		self.player = player
+		steps = PATTERNS[self.pattern]
+		step = 0
+		next_time = start_time + self.rng.random() * self.period
+		try:
+			while True:
+				delay = next_time - time.perf_counter()
+				if delay > 0:
+					time.sleep(delay)
+				if next_time >= end_time:
+					break
+				if steps is None:
+					keys = [self.rng.choice(list(KEY_MAP))]
+				else:
+					keys = steps[step % len(steps)]
+				step += 1
+				events = bytearray()
+				msgs = []
+				for key in keys:
+					pressed = key not in self.held
+					if pressed:
+						self.held.add(key)
+					else:
+						self.held.discard(key)
+					self.bench.key_sent(player, key, pressed)
+					if self.key_sock:
+						self.key_sock.set_key(key, pressed)
+					elif self.version >= 2:
+						events += bytes([key, int(pressed)])
+					else:
+						msgs.append(encode_msg(1, Message_Type.KEY_PRESS, bytes([key, int(pressed)])))
+					self.sent += 1
+				if events:
+					#Every key of the step goes in one frame
+					msgs.append(encode_msg(self.version, Message_Type.KEY_PRESS, events))
+				if msgs:
+					with self.send_lock:
+						self.sock.send_many(msgs)
+				if self.key_sock:
+					self.key_sock.send()
+				next_time += self.period
+		except Exception as e:
+			print("Client for player %d stopped: %s" % (player, e))
+
+	############################################################################
+	def stop(self):
+		"""
+		PURPOSE: ends the connection to the server
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		try:
+			with self.send_lock:
+				self.sock.send(encode_msg(self.version, Message_Type.END))
+		except Exception as e:
+			pass
+		self.sock.close()
+		if self.key_sock:
+			self.key_sock.close()
+
+	############################################################################
+
+################################################################################
+class Load_Benchmark:
+	"""
+	Runs a Rokenbok_Server on an emulated arduino with synthetic clients
+	pressing keys, and measures the time from a client sending a key to the
+	frame with that change reaching the arduino
+	"""
+	############################################################################
+	def __init__(self, clients=8, seconds=5.0, pattern='drive', rate=20.0, udp=False, paced=True, port=8090, seed=None, version=PROTOCOL_VERSION):
+		"""
+		PURPOSE: creates a new Load_Benchmark
+		ARGS:
+			clients (int): number of synthetic clients, at most 8 since 
+						   that is how many controllers there are
+			seconds (float): seconds to press keys for
+			pattern (str): key pattern each client presses, see PATTERNS
+			rate (float): times per second each client steps its pattern
+			udp (bool): if True clients send key states over UDP
+			paced (bool): if True bytes to the emulated arduino take as long
+						  as they would over a serial port
+			port (int): port to run the server on, the UDP port is the next
+						one
+			seed (int): seed for the 'random' pattern and start times
+			version (int): protocol version the clients speak over TCP
+		RETURNS: new instance of a Load_Benchmark
+		NOTES: call run to run the benchmark
+		"""
+		if pattern not in PATTERNS:
+			raise ValueError("Argument 'pattern' must be one of %s!" % ', '.join(PATTERNS))
+		self.clients = min(int(clients), 8)
+		self.seconds = float(seconds)
+		self.pattern = pattern
+		self.rate = float(rate)
+		self.udp = bool(udp)
+		self.paced = bool(paced)
+		self.port = int(port)
+		self.seed = seed
+		self.version = int(version)
+
+		#The last key sent that changed each button of each player and when
+		#it was sent, keyed by (player - 1, state index of the button). Keys
+		#sent again before their frame reaches the arduino replace the
+		#earlier one, which is counted as coalesced
+		self.pending = {}
+		self.pending_lock = threading.Lock()
+		self.latencies = []
+		self.coalesced = 0
+		self.last_state = None
+
+	############################################################################
+	def key_sent(self, player, key, pressed):
+		"""
+		PURPOSE: records a key a client is about to send
+		ARGS:
+			player (int): player of the client (1-8)
+			key (int): ascii code of the key
+			pressed (bool): True if pressed, False if released
+		RETURNS: none
+		NOTES: called from the client threads
+		"""
+		button = KEY_MAP.get(key)
+		if button is None:
+			return
+		bit = (player - 1, BUTTON_IDX[button] - 2)
+		now = time.perf_counter()
+		with self.pending_lock:
+			if bit in self.pending:
+				self.coalesced += 1
+			self.pending[bit] = (now, pressed)
+
+	############################################################################
+	def frame_applied(self, state, applied_time):
+		"""
+		PURPOSE: matches the buttons a frame changed to the keys that were sent
+		ARGS:
+			state (bytes): the new state of the emulated arduino
+			applied_time (float): perf_counter time the frame was applied
+		RETURNS: none
+		NOTES: called from the thread writing to the emulated arduino
+		"""
+		last_state = self.last_state
+		self.last_state = state
+		if last_state is None:
+			return
+		with self.pending_lock:
+			for idx, (old, new) in enumerate(zip(last_state, state)):
+				diff = old ^ new
+				if not diff:
+					continue
+				for player_idx in range(8):
+					if not diff & (1 << player_idx):
+						continue
+					sent = self.pending.get((player_idx, idx))
+					if sent and sent[1] == bool(new & (1 << player_idx)):
+						del self.pending[(player_idx, idx)]
+						self.latencies.append(applied_time - sent[0])
+
+	############################################################################
+	def run(self):
+		"""
+		PURPOSE: runs the benchmark
+		ARGS: none
+		RETURNS: (dict) the settings and results of the benchmark, see
+				 summarize
+		NOTES: cpu time covers the whole process, the clients included
+		"""
+		emulator = Recording_Emulator(self.frame_applied)
+		link = Loopback_Transport(emulator, paced=self.paced)
+		rh = Rokenbok_Hub(heartbeat=0.05, transport=link)
+		rh.restart_status.wait()
+		rh.streaming.wait()
+		udp_port = self.port + 1 if self.udp else None
+		server = Rokenbok_Server('127.0.0.1', self.port, hub=rh, spectator_port=None, udp_port=udp_port, metrics_port=None)
+
+		#Connect every client, the server hands out controllers starting with
+		#player 1
+		stop = threading.Event()
+		clients = []
+		threads = []
+		rng = random.Random(self.seed)
+		for ii in range(self.clients):
+			client = Synthetic_Client(self, '127.0.0.1', self.port, self.pattern, self.rate, udp_port, rng.getrandbits(32), self.version)
+			if not client.connect():
+				client.sock.close()
+				continue
+			clients.append(client)
+			listen = threading.Thread(target=client.listen, args=(stop,))
+			listen.start()
+			threads.append(listen)
+
+		#Press keys
+		start_stats = rh.get_stats()
+		start_cpu = time.process_time()
+		start_time = time.perf_counter() + 0.1
+		end_time = start_time + self.seconds
+		runners = []
+		for ii, client in enumerate(clients):
+			runner = threading.Thread(target=client.run, args=(ii + 1, start_time, end_time))
+			runner.start()
+			runners.append(runner)
+		for runner in runners:
+			runner.join()
+		#Give the last frames time to get through
+		time.sleep(0.2)
+		elapsed = time.perf_counter() - start_time
+		cpu = time.process_time() - start_cpu
+		end_stats = rh.get_stats()
+
+		stop.set()
+		for client in clients:
+			client.stop()
+		for thread in threads:
+			thread.join()
+		server.stop()
+
+		return self.summarize(clients, elapsed, cpu, start_stats, end_stats)
+
+	############################################################################
+	def summarize(self, clients, elapsed, cpu, start_stats, end_stats):
+		"""
+		PURPOSE: builds the results of a benchmark
+		ARGS:
+			clients (list): the clients that pressed keys
+			elapsed (float): seconds the benchmark ran for
+			cpu (float): cpu seconds used while it ran
+			start_stats (dict): hub stats at the start
+			end_stats (dict): hub stats at the end
+		RETURNS: (dict) with the keys 'settings', 'environment' and
+				 'results', latencies are in milliseconds
+		NOTES:
+		"""
+		latencies = sorted(self.latencies)
+		def percentile(p):
+			if not latencies:
+				return None
+			return 1000 * latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+		sent = sum(client.sent for client in clients)
+		tx_frames = end_stats['tx_frames'] - start_stats['tx_frames']
+		return {
+			'settings' : {
+				'clients' : self.clients,
+				'seconds' : self.seconds,
+				'pattern' : self.pattern,
+				'rate' : self.rate,
+				'udp' : self.udp,
+				'version' : self.version,
+				'paced' : self.paced,
+				'seed' : self.seed
+			},
+			'environment' : {
+				'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+				'commit' : git_commit(),
+				'python' : platform.python_version(),
+				'platform' : platform.platform()
+			},
+			'results' : {
+				'active_clients' : len(clients),
+				'keys_sent' : sent,
+				'keys_applied' : len(latencies),
+				'keys_coalesced' : self.coalesced,
+				'keys_per_second' : sent / elapsed,
+				'tx_frames_per_second' : tx_frames / elapsed,
+				'latency_ms' : {
+					'min' : 1000 * latencies[0] if latencies else None,
+					'p50' : percentile(0.5),
+					'p99' : percentile(0.99),
+					'p999' : percentile(0.999),
+					'max' : 1000 * latencies[-1] if latencies else None,
+					'mean' : 1000 * sum(latencies) / len(latencies) if latencies else None
+				},
+				'cpu_percent' : 100 * cpu / elapsed,
+				'naks' : end_stats['naks'] - start_stats['naks'],
+				'parse_errors' : end_stats['parse_errors'] - start_stats['parse_errors']
+			}
+		}
+
+	############################################################################
+
+################################################################################
+def git_commit():
+	"""
+	PURPOSE: gets the commit the code being benchmarked is at
+	ARGS: none
+	RETURNS: (str) the commit hash, or None if it can't be found
+	NOTES:
+	"""
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, cwd=sys.path[0] or None).decode().strip()
+	except Exception as e:
+		return None
+
+################################################################################
+if __name__ == "__main__":
+	#[clients] [seconds] [pattern] [rate] [tcp|tcp1|udp] [output json], tcp 
+	#speaks the newest client protocol and tcp1 speaks version 1
+	clients = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+	seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+	pattern = sys.argv[3] if len(sys.argv) > 3 else 'drive'
+	rate = float(sys.argv[4]) if len(sys.argv) > 4 else 20.0
+	link = sys.argv[5] if len(sys.argv) > 5 else 'tcp'
+	udp = link == 'udp'
+	version = 1 if link == 'tcp1' else PROTOCOL_VERSION
+	output = sys.argv[6] if len(sys.argv) > 6 else None
+
+	result = Load_Benchmark(clients, seconds, pattern, rate, udp, version=version).run()
+	res = result['results']
+	lat = res['latency_ms']
+	print("")
+	print("%d clients pressing '%s' at %.1f/s over %s for %.1f second(s)" % (res['active_clients'], pattern, rate, link, seconds))
+	print("Keys sent %d (%.1f/s), applied %d, coalesced %d, %.1f frames/s" % (res['keys_sent'], res['keys_per_second'], res['keys_applied'], res['keys_coalesced'], res['tx_frames_per_second']))
+	if lat['p50'] is not None:
+		print("Latency ms: p50 %.3f  p99 %.3f  p999 %.3f  max %.3f" % (lat['p50'], lat['p99'], lat['p999'], lat['max']))
+	print("CPU %.1f%%" % res['cpu_percent'])
+	if output:
+		with open(output, 'w') as f:
+			json.dump(result, f, indent=4)
+		print("Saved results to %s" % output)
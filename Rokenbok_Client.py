@@ -1,22 +1,57 @@
 #Imports
-from enum import Enum
-from Keyboard_Listener import Keyboard_Listener
+try:
+	from Keyboard_Listener import Keyboard_Listener
+except ImportError as e:
+	#keyboard package isn't installed, only headless clients can be made
+	Keyboard_Listener = None
+import asyncio
 import threading
 import time
-from Fixed_Len_Socket import Fixed_Len_Socket
+from Fixed_Len_Socket import Fixed_Len_Socket, Async_Fixed_Len_Socket
+from Key_State_Socket import Key_State_Socket, KEEPALIVE
+from Client_Protocol import Message_Type, MSG_LEN, STATE_LEN, SPECTATE_MSG_LEN, PROTOCOL_VERSION, FRAME_HEADER_LEN, encode_msg, decode_frame, frame_len
 import sys
-import queue
 
 ################################################################################
-MSG_LEN = 3	#bytes per message
+#Seconds to wait for the server to answer VERSION before assuming it only 
+#speaks protocol version 1
+VERSION_TIMEOUT = 1.0
+
+#Seconds to wait for the server to answer END before closing the connection
+END_TIMEOUT = 1.0
+
+#Seconds between the repeats of a new state of the keys sent over UDP
+REPEAT_PERIOD = 0.01
+
+#Ascii codes Keyboard_Listener gives the keys without a character of their own
+KEY_NAMES = {
+	'up' : 24,
+	'down' : 25,
+	'right' : 26,
+	'left' : 27
+}
 
 ################################################################################
-class Message_Type(Enum):
-	START = 1	#server sends at the beginning of a connection if a controller is available
-	FULL = 2	#server sends at the beginning of a conneciton (right before closing the connection) if a controller is unavailable
-	KEY_PRESS = 3	#client sends to indicate they pressed a key
-	TRUE_SEL = 4	#server sends to update client on their selected value
-	END = 5	#client or server sends to indicate connection is closing
+def key_code(key):
+	"""
+	PURPOSE: gets the ascii code the server expects for a key
+	ARGS:
+		key (int or str): an ascii code, a single character or the name of 
+						  an arrow key ('up', 'down', 'right' or 'left')
+	RETURNS: (int) the ascii code
+	NOTES: raises a ValueError for anything else
+	"""
+	if isinstance(key, int):
+		code = key
+	elif key in KEY_NAMES:
+		code = KEY_NAMES[key]
+	elif len(key) == 1:
+		code = ord(key)
+	else:
+		raise ValueError("Unknown key '%s'!" % key)
+	if code < 0 or code > 255:
+		raise ValueError("Unknown key '%s'!" % key)
+	return code
 
 ################################################################################
 class Rokenbok_Client:
@@ -24,105 +59,291 @@ class Rokenbok_Client:
 	The client that connects to a server to control the cars
 	"""
 	############################################################################
-	def __init__(self, ip='127.0.0.1', port=8080):
+	def __init__(self, ip='127.0.0.1', port=8080, udp_port=None, keyboard=True):
 		"""
 		PURPOSE: creates a new Rokenbok_Client
 		ARGS:
 			ip (str): ip address of server to connect to
 			port (int): the port to connect to the server on
+			udp_port (int): the port to send the state of our keys to the 
+							server over UDP on, if None (or the server 
+							doesn't allow it) then key presses are sent over
+							TCP
+			keyboard (bool): if True then the keys pressed on this computer 
+							 are sent to the server (which needs the 
+							 keyboard package and root access), if False 
+							 then the client is headless and only press, 
+							 release and select send anything
 		RETURNS: new instance of a Rokenbok_Client
-		NOTES:
+		NOTES: over UDP a lost packet doesn't hold up the key presses after 
+			   it, the connection is still used for everything else. All of
+			   the sending and receiving happens on one asyncio event loop 
+			   running in a seperate thread. Raises an OSError if we can't 
+			   connect and a RuntimeError if we don't get a controller
 		"""
 		#Save arguments
 		self.ip = str(ip)
 		self.port = int(port)
+		self.udp_port = None if udp_port is None else int(udp_port)
 
-		#Connect to server and receive opening message
-		self.sock = Fixed_Len_Socket(MSG_LEN)
-		try:
-			self.sock.connect(self.ip, self.port)
-			msg = self.sock.recv()
-			if msg[0] == Message_Type.FULL.value:
-				print("Server is full, try again later...")
-				self.sock.send(bytes([Message_Type.END.value, 0, 0]))
-				self.sock.close()
-				sys.exit()
-			elif msg[0] != Message_Type.START.value:
-				print("Received unknown message from server, closing connection...")
-				self.sock.send(bytes[Message_Type.END.value, 0, 0])
-				self.sock.close()
-				sys.exit()
-		except Exception as e:
-			print("Could not connect to server...")
-			sys.exit()
+		if keyboard and Keyboard_Listener is None:
+			raise RuntimeError("The keyboard package is needed to send key presses, use keyboard=False for a headless client")
 
-		#We have a controller allocated to us on the server so start the 
-		#communication threads
+		#Set while we are connected to the server
 		self.keep_going = threading.Event()
-		self.keep_going.set()
-		self.key_q = queue.Queue()
-		self.update_time = 1
-		self.listen_thread = threading.Thread(target=self.listen)
-		self.transmit_thread = threading.Thread(target=self.transmit)
-		self.listen_thread.start()
-		self.transmit_thread.start()
+
+		#Our selection as last told by the server (0 if nothing is selected, 
+		#None if it hasn't told us yet) and a condition notified whenever it
+		#changes or the connection ends
+		self.sel = None
+		self.sel_changed = threading.Condition()
+
+		#Key events waiting to be sent and whether sending them is scheduled,
+		#every key event that happens before the event loop gets to them is
+		#sent at once
+		self.key_events = []
+		self.flush_pending = False
+
+		#Timer for resending the state of the keys over UDP
+		self.key_timer = None
+
+		#Start the event loop and connect to the server on it, its thread is
+		#a daemon so an exception that escapes the caller can't keep the 
+		#program running
+		self.sock = None
+		self.key_sock = None
+		self.version = 1
+		self.listen_task = None
+		self.loop = asyncio.new_event_loop()
+		self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+		self.loop_thread.start()
+		try:
+			msg_type = asyncio.run_coroutine_threadsafe(self.connect(), self.loop).result()
+		except Exception as e:
+			self.close_loop()
+			raise
+		if msg_type == Message_Type.FULL.value:
+			self.close_loop()
+			raise RuntimeError("Server is full, try again later...")
+		elif msg_type != Message_Type.START.value:
+			self.close_loop()
+			raise RuntimeError("Received unknown message from server, closing connection...")
 
 		#Start keyboard listener
-		self.kl = Keyboard_Listener()
-		self.kl.set_press_cb(self.key_pressed)
-		self.kl.set_release_cb(self.key_released)
-		self.kl.start()
+		self.kl = None
+		if keyboard:
+			self.kl = Keyboard_Listener()
+			self.kl.set_press_cb(self.key_pressed)
+			self.kl.set_release_cb(self.key_released)
+			self.kl.start()
 
 	############################################################################
-	def listen(self):
+	async def connect(self):
+		"""
+		PURPOSE: connects to the server, waits for a controller and starts 
+				 listening to the server
+		ARGS: none
+		RETURNS: (int) type value of the message that ended the wait, we have
+				 a controller if it is START
+		NOTES: runs on the event loop. Raises an exception if we can't 
+			   connect
+		"""
+		#Connect to server and receive opening message
+		self.sock = Async_Fixed_Len_Socket(MSG_LEN)
+		await self.sock.connect(self.ip, self.port)
+		msg = await self.sock.recv()
+		while msg[0] == Message_Type.WAIT.value:
+			print("Waiting for a controller, number %d in line..." % msg[1])
+			msg = await self.sock.recv()
+		if msg[0] != Message_Type.START.value:
+			await self.sock.send(bytes([Message_Type.END.value, 0, 0]))
+			await self.sock.close()
+			return msg[0]
+
+		#Send key states over UDP if we can
+		token = (msg[1] << 8) | msg[2]
+		if self.udp_port is not None and token:
+			self.key_sock = Key_State_Socket(token)
+			self.key_sock.connect(self.ip, self.udp_port)
+			self.key_sock.setblocking(False)
+
+		#Agree on a protocol version with the server, then listen for 
+		#everything else it sends
+		early_msgs = await self.negotiate_version()
+		self.keep_going.set()
+		for msg_type, data in early_msgs:
+			self.handle_msg(msg_type, data)
+		self.listen_task = asyncio.ensure_future(self.listen())
+		if self.key_sock:
+			self.send_key_state()
+		return msg[0]
+
+	############################################################################
+	async def listen(self):
 		"""
 		PURPOSE: listens for updates from the server
 		ARGS: none
 		RETURNS: none
-		NOTES: should be called in a seperate thread
+		NOTES: runs on the event loop until the server ends the connection.
+			   Each message is handled as soon as it arrives and heartbeats 
+			   are echoed straight back
 		"""
-		print("DEBUG: listen thread starting...")
-		read_time = 0
-
 		try:
 			while self.keep_going.is_set():
-				cur_time = time.time()
-				if (cur_time - read_time) > self.update_time:
-					msg = self.sock.recv()
-					if msg[0] == Message_Type.TRUE_SEL.value:
-						print("Selected = %d" % msg[1])
-					elif msg[0] == Message_Type.END.value:
-						self.keep_going.clear()
-					read_time = cur_time
-				time.sleep(0.2)
+				for msg_type, data in await self.recv_msgs():
+					self.handle_msg(msg_type, data)
+		except asyncio.CancelledError as e:
+			#We are stopping
+			pass
 		except Exception as e:
-			print("DEBUG: exception '%s' in listen thread!" % type(e))
+			print("DEBUG: exception '%s' while listening!" % type(e))
 			print(e)
 
 		self.keep_going.clear()
-		print("DEBUG: listen thread ending...")
+		with self.sel_changed:
+			self.sel_changed.notify_all()
 
 	############################################################################
-	def transmit(self):
+	async def negotiate_version(self):
 		"""
-		PURPOSE: sends key presses to the server
+		PURPOSE: agrees on a protocol version with the server
 		ARGS: none
-		RETURNS: none
-		NOTES:
+		RETURNS: (list) a (message type value, bytes) tuple for each other 
+				 message the server sent while we were waiting for its answer
+		NOTES: we can't send anything else (even heartbeats) until the server
+			   answers since it switches versions as soon as it reads our
+			   VERSION. An older server never answers so we give up after 
+			   VERSION_TIMEOUT and keep speaking version 1
 		"""
-		print("DEUBG: transmit thread starting...")
+		early_msgs = []
+		self.send_msg(Message_Type.VERSION, bytes([PROTOCOL_VERSION]))
+		deadline = time.monotonic() + VERSION_TIMEOUT
 		try:
-			while self.keep_going.is_set():
-				while self.key_q.qsize():
-					k = self.key_q.get()
-					self.sock.send(bytes([Message_Type.KEY_PRESS.value, k[0], k[1]]))
-				time.sleep(0.01)
-		except Exception as e:
-			print("DEBUG: exception '%s' in transmit thread!" % type(e))
-			print(e)
+			while True:
+				msg = await self.sock.recv(timeout=max(deadline - time.monotonic(), 0))
+				if msg[0] == Message_Type.VERSION.value:
+					self.version = min(msg[1], PROTOCOL_VERSION)
+					break
+				early_msgs.append((msg[0], msg[1:]))
+		except TimeoutError as e:
+			print("Server doesn't answer VERSION, speaking protocol version 1")
+		return early_msgs
 
-		self.keep_going.clear()
-		print("DEBUG: transmit thread ending...")
+	############################################################################
+	def send_msg(self, msg_type, data=b''):
+		"""
+		PURPOSE: sends a message to the server in the protocol version we 
+				 agreed on
+		ARGS:
+			msg_type (Message_Type): type of the message
+			data (bytes): arguments of the message
+		RETURNS: none
+		NOTES: runs on the event loop
+		"""
+		self.sock.write(encode_msg(self.version, msg_type, data))
+
+	############################################################################
+	async def recv_msgs(self):
+		"""
+		PURPOSE: receives the next messages from the server
+		ARGS: none
+		RETURNS: (list) a (message type value, bytes) tuple for each message
+		NOTES: waits until a message (or in protocol version 2 a frame of 
+			   messages) arrives. In version 1 every message that has already
+			   arrived is returned
+		"""
+		if self.version >= 2:
+			payload_len = frame_len(await self.sock.recv(FRAME_HEADER_LEN))
+			return decode_frame(await self.sock.recv(payload_len) if payload_len else b'')
+		return [(msg[0], msg[1:]) for msg in await self.sock.recv_many()]
+
+	############################################################################
+	def handle_msg(self, msg_type, data):
+		"""
+		PURPOSE: reacts to a message from the server
+		ARGS:
+			msg_type (int): the message type value
+			data (bytes): arguments of the message
+		RETURNS: none
+		NOTES: runs on the event loop
+		"""
+		if msg_type == Message_Type.TRUE_SEL.value:
+			print("Selected = %d" % data[0])
+			with self.sel_changed:
+				self.sel = data[0]
+				self.sel_changed.notify_all()
+		elif msg_type == Message_Type.HEARTBEAT.value:
+			#Let the server know we are still here
+			self.send_msg(Message_Type.HEARTBEAT, data[:1])
+		elif msg_type == Message_Type.END.value:
+			self.keep_going.clear()
+
+	############################################################################
+	def key_event(self, ascii_code, pressed):
+		"""
+		PURPOSE: sends a key press or release to the server
+		ARGS:
+			ascii_code (int): the ascii code of the key
+			pressed (int): 1 if the key was pressed, 0 if released
+		RETURNS: none
+		NOTES: runs on the event loop. Over UDP the state of every key is 
+			   sent straight away instead of each key press. Over TCP the 
+			   key press is sent along with every other one that happens 
+			   before the event loop gets to sending them, in protocol 
+			   version 2 in one frame
+		"""
+		if not self.keep_going.is_set():
+			return
+		if self.key_sock:
+			if self.key_sock.set_key(ascii_code, pressed):
+				self.send_key_state()
+			return
+		self.key_events.append(bytes([ascii_code, pressed]))
+		if not self.flush_pending:
+			self.flush_pending = True
+			self.loop.call_soon(self.flush_keys)
+
+	############################################################################
+	def flush_keys(self):
+		"""
+		PURPOSE: sends every key event waiting to be sent
+		ARGS: none
+		RETURNS: none
+		NOTES: runs on the event loop
+		"""
+		self.flush_pending = False
+		if not self.key_events or not self.keep_going.is_set():
+			return
+		if self.version >= 2:
+			msgs = [encode_msg(self.version, Message_Type.KEY_PRESS, b''.join(self.key_events))]
+		else:
+			msgs = [encode_msg(self.version, Message_Type.KEY_PRESS, event) for event in self.key_events]
+		self.key_events = []
+		self.sock.write_many(msgs)
+
+	############################################################################
+	def send_key_state(self):
+		"""
+		PURPOSE: sends the state of the keys over UDP if it is due, and 
+				 schedules the next time it is
+		ARGS: none
+		RETURNS: none
+		NOTES: runs on the event loop. A new state is repeated every 
+			   REPEAT_PERIOD seconds a few times, after that it is resent 
+			   every KEEPALIVE seconds
+		"""
+		if self.key_timer:
+			self.key_timer.cancel()
+		try:
+			self.key_sock.send()
+		except BlockingIOError as e:
+			#Socket buffer is full, the next one will make up for it
+			pass
+		if self.key_sock.repeats:
+			delay = REPEAT_PERIOD
+		else:
+			delay = max(KEEPALIVE - (time.time() - self.key_sock.sent_time), REPEAT_PERIOD)
+		self.key_timer = self.loop.call_later(delay, self.send_key_state)
 
 	############################################################################
 	def key_pressed(self, ascii_code):
@@ -131,9 +352,14 @@ class Rokenbok_Client:
 		ARGS:
 			ascii_code (int): the ascii code representing the pressed key
 		RETURNS: none
-		NOTES:
+		NOTES: can be called from any thread, wakes up the event loop to 
+			   send it right away
 		"""
-		self.key_q.put((ascii_code, 1))
+		try:
+			self.loop.call_soon_threadsafe(self.key_event, ascii_code, 1)
+		except RuntimeError as e:
+			#Event loop has been closed
+			pass
 
 	############################################################################
 	def key_released(self, ascii_code):
@@ -142,9 +368,161 @@ class Rokenbok_Client:
 		ARGS:
 			ascii_code (int): the ascii code representing the released key
 		RETURNS: none
+		NOTES: can be called from any thread, see key_pressed
+		"""
+		try:
+			self.loop.call_soon_threadsafe(self.key_event, ascii_code, 0)
+		except RuntimeError as e:
+			#Event loop has been closed
+			pass
+
+	############################################################################
+	def press(self, key):
+		"""
+		PURPOSE: presses a key
+		ARGS:
+			key (int or str): the key, see key_code
+		RETURNS: none
+		NOTES: can be called from any thread, the key stays pressed until 
+			   release is called
+		"""
+		self.key_pressed(key_code(key))
+
+	############################################################################
+	def release(self, key):
+		"""
+		PURPOSE: releases a key
+		ARGS:
+			key (int or str): the key, see key_code
+		RETURNS: none
+		NOTES: can be called from any thread
+		"""
+		self.key_released(key_code(key))
+
+	############################################################################
+	def select(self, car):
+		"""
+		PURPOSE: asks to select a car
+		ARGS:
+			car (int): the car to select (1-8), 0 to deselect
+		RETURNS: none
+		NOTES: can be called from any thread. The selection only changes 
+			   once the hub has it, see await_selection
+		"""
+		if car < 0 or car > 8:
+			raise ValueError("Argument 'car' must be between 0 and 8!")
+		self.press(str(car))
+		self.release(str(car))
+
+	############################################################################
+	def await_selection(self, car, timeout=None):
+		"""
+		PURPOSE: waits for the server to tell us a car is selected
+		ARGS:
+			car (int): the car (1-8), 0 to wait for nothing to be selected
+			timeout (float): max seconds to wait, None to wait forever
+		RETURNS: (bool) True if the car is selected, False if timed out or 
+				 the connection ended first
+		NOTES: can be called from any thread
+		"""
+		with self.sel_changed:
+			self.sel_changed.wait_for(lambda: self.sel == car or not self.keep_going.is_set(), timeout)
+			return self.sel == car
+
+	############################################################################
+	async def disconnect(self):
+		"""
+		PURPOSE: ends the connection to the server
+		ARGS: none
+		RETURNS: none
+		NOTES: runs on the event loop. The server answers END with END which
+			   ends listen, the connection is closed anyway if it doesn't 
+			   answer within END_TIMEOUT
+		"""
+		if self.key_timer:
+			self.key_timer.cancel()
+			self.key_timer = None
+		if self.listen_task:
+			if self.keep_going.is_set():
+				self.flush_keys()
+				self.send_msg(Message_Type.END)
+				await asyncio.wait([self.listen_task], timeout=END_TIMEOUT)
+			self.listen_task.cancel()
+			await asyncio.gather(self.listen_task, return_exceptions=True)
+			self.listen_task = None
+		self.keep_going.clear()
+		if self.sock:
+			await self.sock.close()
+		if self.key_sock:
+			self.key_sock.close()
+
+	############################################################################
+	def close_loop(self):
+		"""
+		PURPOSE: stops the event loop and its thread
+		ARGS: none
+		RETURNS: none
 		NOTES:
 		"""
-		self.key_q.put((ascii_code, 0))
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.loop_thread.join()
+		self.loop.close()
+
+	############################################################################
+	def stop(self):
+		"""
+		PURPOSE: closes connection to the server
+		ARGS: none
+		RETURNS: none
+		NOTES:
+		"""
+		if self.kl:
+			self.kl.stop()
+		if self.loop.is_closed():
+			return
+		asyncio.run_coroutine_threadsafe(self.disconnect(), self.loop).result()
+		self.close_loop()
+
+	############################################################################
+
+################################################################################
+class Rokenbok_Spectator:
+	"""
+	Connects to a server's spectator port to watch the state of every 
+	controller without controlling anything
+	"""
+	############################################################################
+	def __init__(self, ip='127.0.0.1', port=8081):
+		"""
+		PURPOSE: creates a new Rokenbok_Spectator
+		ARGS:
+			ip (str): ip address of server to connect to
+			port (int): the spectator port of the server
+		RETURNS: new instance of a Rokenbok_Spectator
+		NOTES: raises an OSError if it can't connect
+		"""
+		self.ip = str(ip)
+		self.port = int(port)
+		self.sock = Fixed_Len_Socket(SPECTATE_MSG_LEN)
+		self.sock.connect(self.ip, self.port)
+
+	############################################################################
+	def get_state(self):
+		"""
+		PURPOSE: waits for the next state from the server
+		ARGS: none
+		RETURNS: (bytes, bytes) the state the controllers want and the actual 
+				 state of the hub (None if the server doesn't know it), or 
+				 None if the server is closing the connection
+		NOTES: the server only sends the state when it changes, and skips 
+			   states if we don't keep up
+		"""
+		msg = self.sock.recv()
+		if msg[0] != Message_Type.STATE.value:
+			return None
+		des_state = msg[2:2 + STATE_LEN]
+		cur_state = msg[2 + STATE_LEN:] if msg[1] else None
+		return (des_state, cur_state)
 
 	############################################################################
 	def stop(self):
@@ -154,25 +532,35 @@ class Rokenbok_Client:
 		RETURNS: none
 		NOTES:
 		"""
-		self.kl.stop()
-		self.keep_going.clear()
-		if self.listen_thread:
-			self.listen_thread.join()
-			self.listen_thread = None
-		if self.transmit_thread:
-			self.transmit_thread.join()
-			self.transmit_thread = None
-		try:
-			self.sock.send(bytes([Message_Type.END.value, 0, 0]))
-		except Exception as e:
-			pass
 		self.sock.close()
 
 	############################################################################
 
 ################################################################################
 if __name__ == "__main__":
-	client = Rokenbok_Client("192.168.1.198")
+	if len(sys.argv) > 1 and sys.argv[1] == 'spectate':
+		spectator = Rokenbok_Spectator("192.168.1.198")
+		try:
+			while True:
+				state = spectator.get_state()
+				if state is None:
+					break
+				#Selections are the last 8 bytes of the state
+				des_state, cur_state = state
+				print("Selections = %s" % list((cur_state or des_state)[-8:]))
+		except KeyboardInterrupt as e:
+			pass
+		spectator.stop()
+		sys.exit()
+
+	try:
+		client = Rokenbok_Client("192.168.1.198")
+	except OSError as e:
+		print("Could not connect to server...")
+		sys.exit()
+	except RuntimeError as e:
+		print(e)
+		sys.exit()
 	print("Connected to client")
 
 	try:
@@ -1,6 +1,20 @@
 #Imports
 from Rokenbok_Hub import Rokenbok_Hub, Button
 
+################################################################################
+#Default keymapping of a controller, ascii code to button
+KEY_MAP = {
+	24 : Button.FORWARD,	#up arrow
+	25 : Button.BACK,		#down arrow
+	26 : Button.RIGHT,		#right arrow
+	27 : Button.LEFT,		#left arrow
+	ord('s') : Button.A,
+	ord('w') : Button.B,
+	ord('a') : Button.X,
+	ord('d') : Button.Y,
+	ord('q') : Button.SLOW
+}
+
 ################################################################################
 class Rokenbok_Controller:
 	"""
@@ -25,18 +39,8 @@ class Rokenbok_Controller:
 		#Save hub
 		self.hub = hub
 
-		#Define default keymapping
-		self.key_map = {
-			24 : Button.FORWARD,	#up arrow
-			25 : Button.BACK,		#down arrow
-			26 : Button.RIGHT,		#right arrow
-			27 : Button.LEFT,		#left arrow
-			ord('s') : Button.A,
-			ord('w') : Button.B,
-			ord('a') : Button.X,
-			ord('d') : Button.Y,
-			ord('q') : Button.SLOW
-		}
+		#Start from the default keymapping
+		self.key_map = dict(KEY_MAP)
 
 	############################################################################
 	def get_sel(self):
@@ -44,10 +48,14 @@ class Rokenbok_Controller:
 		PURPOSE: gets the current selection of this controller
 		ARGS: none
 		RETURNS: (int) current selection (1-8) or 0 if nothing is selected
-		NOTES:
+		NOTES: uses the actual selection reported by the hub, or the desired 
+			   selection if the hub hasn't reported anything yet
 		"""
-		#TODO change to current selection rather than desired
-		cur_sel = self.hub.get_sels()[1][self.player - 1]
+		cur_sels, des_sels = self.hub.get_sels()
+		if self.hub.cur_time is None:
+			cur_sel = des_sels[self.player - 1]
+		else:
+			cur_sel = cur_sels[self.player - 1]
 		if cur_sel == 0xFF:
 			return 0
 		return cur_sel + 1
@@ -63,12 +71,12 @@ class Rokenbok_Controller:
 		"""
 		if ascii_code in self.key_map:
 			self.hub.cmd(self.key_map[ascii_code], self.player, True)
-		elif ascii_code >= 49 or ascii_code <= 56:
+		elif ascii_code >= 49 and ascii_code <= 56:
 			#number keys 1 - 8 were pressed
 			des_sel = ascii_code - 48
 			self.hub.change_sel(self.player, des_sel)
 		elif ascii_code == 114:
-			#r
+			#r, restarts in the background so it doesn't hold up this thread
 			self.hub.restart_arduino()
 		elif ascii_code == 48:
 			#0
@@ -86,6 +94,38 @@ class Rokenbok_Controller:
 		if ascii_code in self.key_map:
 			self.hub.cmd(self.key_map[ascii_code], self.player, False)
 
+	############################################################################
+	def apply_keys(self, events):
+		"""
+		PURPOSE: reacts to several key presses and releases at once
+		ARGS:
+			events (list): a (ascii code, pressed) tuple for each key event,
+						   in the order they happened
+		RETURNS: none
+		NOTES: does the same as calling press_key and release_key for each
+			   event, but every change goes to the hub in the same frame
+		"""
+		changes = []
+		restart = False
+		for ascii_code, pressed in events:
+			if ascii_code in self.key_map:
+				changes.append((self.key_map[ascii_code], self.player, bool(pressed)))
+			elif not pressed:
+				continue
+			elif ascii_code >= 49 and ascii_code <= 56:
+				#number keys 1 - 8 were pressed
+				changes.append((self.player, ascii_code - 48))
+			elif ascii_code == 114:
+				#r
+				restart = True
+			elif ascii_code == 48:
+				#0
+				changes.append((self.player, 0))
+		if changes:
+			self.hub.apply(changes)
+		if restart:
+			self.hub.restart_arduino()
+
 	############################################################################
 	def release_all(self):
 		"""
@@ -94,8 +134,7 @@ class Rokenbok_Controller:
 		RETURNS: none
 		NOTES:
 		"""
-		for key, button in self.key_map.items():
-			self.hub.cmd(button, self.player, False)
+		self.hub.apply([(button, self.player, False) for button in self.key_map.values()])
 
 	############################################################################
 	def deselect(self):
@@ -113,10 +152,11 @@ class Rokenbok_Controller:
 		PURPOSE: releases all the buttons and deselects from a car
 		ARGS: none
 		RETURNS: none
-		NOTES:
+		NOTES: both happen in the same frame sent to the arduino
 		"""
-		self.release_all()
-		self.deselect()
+		changes = [(button, self.player, False) for button in self.key_map.values()]
+		changes.append((self.player, 0))
+		self.hub.apply(changes)
 
 	############################################################################
 
@@ -1,9 +1,10 @@
 #Imports
-import serial
-import serial.tools.list_ports as list_ports
 import threading
 import time
 from enum import Enum
+from Hub_Protocol import SYNC_BYTE, PRIORITY_IDX, SEL_IDX, FRAME_LEN, SEQ_IDX, CTRL_SYNC_BYTE, CTRL_HELLO, CTRL_VERSION, CTRL_NAK, CTRL_BAUD, PROBE_MSG, PROTOCOL_VERSION, BAUD_RATES, BAUD_CONFIRM_TIME, version_msg, baud_msg, Frame_Parser, Frame_Encoder
+from Hub_Transport import Serial_Transport
+from Metrics import Histogram, Timed_Lock, WRITE_BUCKETS
 
 ################################################################################
 class Button(Enum):
@@ -18,6 +19,105 @@ class Button(Enum):
 	SLOW = 9
 	SHARING = 10
 
+################################################################################
+class Restart_State(Enum):
+	STOPPING = 1	#stopping the serial threads
+	OPENING = 2	#opening the serial port
+	BOOTING = 3	#waiting for the arduino to boot
+	RUNNING = 4	#sending our state to the arduino again
+	CANCELLED = 5	#the hub was stopped before the restart finished
+
+################################################################################
+class Restart_Status:
+	"""
+	Keeps track of the progress of a restart of the arduino happening in the 
+	background
+	"""
+	############################################################################
+	def __init__(self):
+		"""
+		PURPOSE: creates a new Restart_Status
+		ARGS: none
+		RETURNS: new instance of a Restart_Status
+		NOTES:
+		"""
+		self.state = Restart_State.STOPPING
+		self.start_time = time.time()
+		self.end_time = None
+		self.finished = threading.Event()
+
+	############################################################################
+	def set_state(self, state):
+		"""
+		PURPOSE: moves the restart on to its next state
+		ARGS:
+			state (Restart_State): the new state
+		RETURNS: none
+		NOTES:
+		"""
+		self.state = state
+		if state in (Restart_State.RUNNING, Restart_State.CANCELLED):
+			self.end_time = time.time()
+			self.finished.set()
+
+	############################################################################
+	def done(self):
+		"""
+		PURPOSE: checks if the restart is over
+		ARGS: none
+		RETURNS: (bool) True if finished or cancelled, False if not
+		NOTES:
+		"""
+		return self.finished.is_set()
+
+	############################################################################
+	def wait(self, timeout=None):
+		"""
+		PURPOSE: waits for the restart to be over
+		ARGS:
+			timeout (float): max seconds to wait, None to wait forever
+		RETURNS: (bool) True if the restart is over, False if timed out
+		NOTES:
+		"""
+		return self.finished.wait(timeout)
+
+	############################################################################
+	def elapsed(self):
+		"""
+		PURPOSE: gets how long the restart took or has taken so far
+		ARGS: none
+		RETURNS: (float) seconds
+		NOTES:
+		"""
+		end_time = self.end_time if self.end_time else time.time()
+		return end_time - self.start_time
+
+	############################################################################
+
+################################################################################
+#Index of each button's byte in a frame, see Hub_Protocol
+BUTTON_IDX = {button : button.value + 1 for button in Button}
+
+#Masks to OR in to press a button and to AND in to release a button, indexed by
+#player - 1
+PRESS_MASKS = tuple(1 << ii for ii in range(8))
+RELEASE_MASKS = tuple(~(1 << ii) & 0xFF for ii in range(8))
+
+#Seconds between probes while waiting for the arduino to say it is ready
+PROBE_PERIOD = 0.25
+
+#Seconds to wait for the arduino to agree to a protocol version
+VERSION_TIMEOUT = 0.5
+
+#Seconds to wait for the arduino to acknowledge a protocol version 3 frame 
+#before assuming it was lost and resyncing with a keyframe
+ACK_TIMEOUT = 0.05
+
+#Number of probes the arduino has to answer, and the seconds it has to answer 
+#them in, for a new baud rate to be reliable
+BAUD_CHECK_PROBES = 64
+BAUD_CHECK_TIME = 0.25
+
 ################################################################################
 class Rokenbok_Hub:
 	"""
@@ -26,7 +126,7 @@ class Rokenbok_Hub:
 	models that hub and interacts with the real hub via an arduino
 	"""
 	############################################################################
-	def __init__(self, arduino_port=None, baudrate=115200):
+	def __init__(self, arduino_port=None, baudrate=115200, heartbeat=0.5, max_fps=200, transport=None, protocol=PROTOCOL_VERSION, keyframe_period=1.0, max_baudrate=BAUD_RATES[-1]):
 		"""
 		PURPOSE: creates a new Rokenbok_Hub
 		ARGS:
@@ -34,68 +134,138 @@ class Rokenbok_Hub:
 								arduino with. If left at 'None' then it will 
 								try to find the correct serial port itself.
 			baudrate (int): baudrate to communicate to the arduino with
+			heartbeat (float): max number of seconds between frames sent to 
+							   the arduino when nothing changes
+			max_fps (float): max number of frames per second sent to the 
+							 arduino
+			transport (Hub_Transport): link to the arduino, if None then 
+									   talks to the arduino over the serial 
+									   port given by arduino_port and baudrate
+			protocol (int): highest protocol version to speak to the 
+							arduino, the version actually used is the highest
+							one both of us speak
+			keyframe_period (float): seconds between frames with our whole 
+									 state when speaking a protocol version 
+									 that only sends what changed
+			max_baudrate (int): fastest baud rate to try switching the link
+								to once the arduino is running, the fastest
+								one that works reliably is used
 		RETURNS: new instance of a Rokenbok_Hub
-		NOTES:
+		NOTES: a frame is sent as soon as our state changes (limited by 
+			   max_fps), otherwise a frame is sent every heartbeat seconds
 		"""
-		#Bytes represting state of controllers that we can change
-		self.ctrl_forward = 0
-		self.ctrl_back = 0
-		self.ctrl_left = 0
-		self.ctrl_right = 0
-		self.ctrl_a = 0
-		self.ctrl_b = 0
-		self.ctrl_x = 0
-		self.ctrl_y = 0
-		self.ctrl_slow = 0
-		self.ctrl_sharing = 0
-		self.ctrl_sel = [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
-
-		#Locks for state variables allowing for multithreading
-		self.ctrl_forward_lock = threading.Lock()
-		self.ctrl_back_lock = threading.Lock()
-		self.ctrl_left_lock = threading.Lock()
-		self.ctrl_right_lock = threading.Lock()
-		self.ctrl_a_lock = threading.Lock()
-		self.ctrl_b_lock = threading.Lock()
-		self.ctrl_x_lock = threading.Lock()
-		self.ctrl_y_lock = threading.Lock()
-		self.ctrl_slow_lock = threading.Lock()
-		self.ctrl_sharing_lock = threading.Lock()
-		self.ctrl_sel_lock = threading.Lock()
-
-		#Constants used for communicating with arduino and controlling hub
-		self.priority = 0
-		self.sync_byte = 0b10101010
-
-		#Used to keep track of the actual current selection and not just what
-		#we desire because they could possibly become unsynced
-		self.cur_sel = [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
-
-		#Save baudrate
-		self.baudrate = int(baudrate)
-
-		#Find serial port if needed
-		self.ser_port = None
-		if arduino_port is None:
-			for port in list_ports.comports():
-				if 'arduino' in port.description.lower() or 'arduino' in port.manufacturer.lower():
-					self.ser_port = port.device
-					break
-			if self.ser_port is None:
-				raise ValueError("Can't find serial port for arduino!")
-		else:
-			self.ser_port = str(arduino_port)
-
-		#Start the serial connection
-		self.ser = None
+		#Our state and the actual state of the hub
+		self.init_state()
+
+		#Set whenever our state changes to wake up the serial thread
+		self.state_changed = threading.Event()
+
+		#Frame timing for the serial thread
+		self.heartbeat = float(heartbeat)
+		self.min_frame_period = 1.0 / float(max_fps)
+		self.keyframe_period = float(keyframe_period)
+
+		#Protocol version we want to speak and the one we agreed on with the 
+		#arduino
+		self.protocol = int(protocol)
+		self.link_version = 1
+		self.version_agreed = threading.Event()
+
+		#Fastest baud rate we want to use and the answer to the last baud rate
+		#we asked the arduino to switch to. hellos counts the HELLOs the 
+		#arduino sends so we can tell if it answered our probes
+		self.max_baudrate = int(max_baudrate)
+		self.baud_agreed = threading.Event()
+		self.baud_ack = None
+		self.hellos = 0
+
+		#Statistics about the frames we send to the arduino and how long 
+		#writing each one takes
+		self.tx_frames = 0
+		self.tx_bytes = 0
+		self.write_latency = Histogram(WRITE_BUCKETS)
+
+		#In protocol version 3 the arduino tells us the sequence number of 
+		#each frame it applies and NAKs frames it can't apply. sent_seq is the 
+		#sequence number of the last frame we sent, frame_acked is set once 
+		#the arduino answers it and need_keyframe is set when we have to 
+		#resync the arduino with our whole state
+		self.sent_seq = None
+		self.frame_acked = threading.Event()
+		self.need_keyframe = threading.Event()
+		self.naks = 0
+		self.retransmits = 0
+
+		#Statistics about the frames the arduino sends back to us
+		self.parser = Frame_Parser()
+		self.rx_fps = 0.0
+
+		#Create link to the arduino if needed
+		if transport is None:
+			transport = Serial_Transport(arduino_port, baudrate)
+		self.transport = transport
+
+		#Set once the arduino tells us it is ready for frames and once we start
+		#sending it frames
+		self.arduino_ready = threading.Event()
+		self.streaming = threading.Event()
+		self.fw_version = None
 		self.ser_open_time = None
-		self.open_serial_con()
 
-		#Start the serial communication thread
+		#Set if the arduino never said it was ready and the transport moved
+		#to another serial port, so the restart opens that one instead
+		self.port_moved = threading.Event()
+
+		#Start the serial communication threads in the background
 		self.ser_thread = None
+		self.read_thread = None
 		self.keep_going = threading.Event()
+		self.stopping = threading.Event()
+		self.restart_thread = None
+		self.restart_status = None
+		self.restart_lock = threading.Lock()
 		self.restart_arduino()
 
+	############################################################################
+	def init_state(self):
+		"""
+		PURPOSE: sets up our state and the actual state of the hub
+		ARGS: none
+		RETURNS: none
+		NOTES: shared with Rokenbok_Hub_Process, which keeps the same state 
+			   but talks to the arduino from another process
+		"""
+		#Constants used for communicating with arduino and controlling hub
+		self.priority = 0
+		self.sync_byte = SYNC_BYTE
+
+		#Frame represting state of controllers that we can change, laid out 
+		#exactly as it is sent to the arduino: 2 sync bytes, a byte per button 
+		#with a bit per player, priority, and the selection of each player
+		self.frame = bytearray(FRAME_LEN)
+		self.frame[0] = self.sync_byte
+		self.frame[1] = self.sync_byte
+		self.frame[PRIORITY_IDX] = self.priority
+		self.frame[SEL_IDX:] = bytes([0xFF] * 8)
+
+		#Lock for the frame allowing for multithreading, it keeps track of how
+		#long it is waited for and held
+		self.state_lock = Timed_Lock()
+
+		#Used to keep track of the actual current state and not just what we 
+		#desire because they could possibly become unsynced. The arduino sends 
+		#the actual state back to us in the same layout as our frame. cur_time 
+		#is when we last heard from the arduino (None if we never have)
+		self.cur_frame = None
+		self.cur_sel = [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
+		self.cur_time = None
+		self.cur_lock = Timed_Lock()
+
+		#Functions to call whenever the actual state of the hub changes, and 
+		#when the actual state started differing from ours
+		self.state_cbs = []
+		self.diverged_since = None
+
 	############################################################################
 	def __del__(self):
 		"""
@@ -114,22 +284,19 @@ class Rokenbok_Hub:
 		RETURNS: none
 		NOTES: closes the serial port if it is already open and reopens it (this
 			   will restart the arduino), blocks until it can open the serial 
-			   port
+			   port or the hub is stopped
 		"""
 		#Close port if already opened
-		if self.ser and self.ser.isOpen():
-			self.ser.close()
+		self.transport.close()
 		#Open serial port
-		is_open = False
 		ser_delay = 2
-		while not is_open:
+		while not self.transport.is_open() and not self.stopping.is_set():
 			try:
-				self.ser = serial.Serial(port=self.ser_port, baudrate=self.baudrate)
-			except serial.serialutil.SerialException as e:
-				print("Unable to open serial port '%s'! Trying again in %d second(s)..." % (self.ser_port, ser_delay))
-				time.sleep(ser_delay)
+				self.transport.open()
+			except OSError as e:
+				print("Unable to open '%s'! Trying again in %d second(s)..." % (self.transport.name, ser_delay))
+				self.stopping.wait(ser_delay)
 			else:
-				is_open = self.ser.isOpen()
 				self.ser_open_time = time.time()
 
 	############################################################################
@@ -140,9 +307,7 @@ class Rokenbok_Hub:
 		RETURNS: none
 		NOTES:
 		"""
-		if self.ser and self.ser.isOpen():
-			self.ser.close()
-		self.ser = None
+		self.transport.close()
 
 	############################################################################
 	def sync_state_arduino(self):
@@ -151,36 +316,56 @@ class Rokenbok_Hub:
 				 to pass our state onto the hub, thereby controlling the hub
 		ARGS: none
 		RETURNS: none
-		NOTES: should be run in a seperate thread
+		NOTES: should be run in a seperate thread. In protocol version 3 we 
+			   wait for the arduino to answer each frame before sending the 
+			   next one and send a keyframe if it NAKs a frame or doesn't 
+			   answer in time
 		"""
-		#Wait at least 5 seconds for arduino to reboot after opening the serial
-		#port
-		while self.keep_going.is_set() and (time.time() - self.ser_open_time) < 5:
-			time.sleep(0.2)
+		self.wait_for_arduino()
+		if not self.keep_going.is_set():
+			return
+		encoder = Frame_Encoder(self.negotiate_version())
+		self.negotiate_baudrate()
 
-		#Have waited for arduino to reboot so we can start sending it our state
+		#Have waited for arduino to reboot so we can start sending it our state,
+		#the first frame replays our whole state since the arduino forgot it
+		self.streaming.set()
+		key_time = time.time()
 		try:
-			self.ser.flush()
+			self.transport.flush()
 			while self.keep_going.is_set():
-				to_write = [
-					self.sync_byte,
-					self.sync_byte,
-					self.ctrl_forward,
-					self.ctrl_back,
-					self.ctrl_left,
-					self.ctrl_right,
-					self.ctrl_a,
-					self.ctrl_b,
-					self.ctrl_x,
-					self.ctrl_y,
-					self.ctrl_slow,
-					self.ctrl_sharing,
-					self.priority
-				]
-				to_write = bytes(to_write + self.ctrl_sel)
-				self.ser.write(to_write)
-				#TODO read current selection
-				time.sleep(0.04)
+				#Clear before building the frame so a change that happens while
+				#we are writing will trigger another frame
+				self.state_changed.clear()
+				with self.state_lock:
+					state = self.frame[2:]
+				frame_time = time.time()
+				keyframe = (frame_time - key_time) >= self.keyframe_period
+				if self.need_keyframe.is_set():
+					self.need_keyframe.clear()
+					self.retransmits += 1
+					keyframe = True
+				if keyframe:
+					key_time = frame_time
+				to_write = encoder.encode(state, keyframe)
+				self.sent_seq = encoder.seq
+				self.frame_acked.clear()
+				write_start = time.perf_counter()
+				self.transport.write(to_write)
+				self.write_latency.observe(time.perf_counter() - write_start)
+				self.tx_frames += 1
+				self.tx_bytes += len(to_write)
+
+				#Sleep until our state changes or the heartbeat expires, but
+				#never send frames faster than max_fps. If the arduino never
+				#answers the frame it was lost (or its answer was) so resync
+				if encoder.version >= 3 and not self.frame_acked.wait(ACK_TIMEOUT):
+					self.need_keyframe.set()
+				else:
+					self.state_changed.wait(self.heartbeat)
+				delay = self.min_frame_period - (time.time() - frame_time)
+				if delay > 0:
+					time.sleep(delay)
 		except Exception as e:
 			print("'sync_state_arduino' encountered exception '%s': %s" % (type(e), str(e)))
 
@@ -188,26 +373,309 @@ class Rokenbok_Hub:
 		#case of exception exit, make sure keep_going flag is cleared
 		self.keep_going.clear()
 
+	############################################################################
+	def wait_for_arduino(self):
+		"""
+		PURPOSE: waits for arduino to reboot after opening the serial port
+		ARGS: none
+		RETURNS: none
+		NOTES: the arduino tells us when it is ready, and we probe it in case 
+			   it was already running. If it never answers (older firmware) 
+			   this waits the full boot time of the transport, unless the 
+			   transport moves to another serial port in which case it sets 
+			   port_moved and stops the serial threads
+		"""
+		probe_time = 0
+		while self.keep_going.is_set() and not self.arduino_ready.is_set():
+			cur_time = time.time()
+			if (cur_time - self.ser_open_time) >= self.transport.boot_time:
+				if self.transport.handshake_failed():
+					self.port_moved.set()
+					self.keep_going.clear()
+					return
+				print("No handshake from arduino, assuming it is ready...")
+				return
+			if (cur_time - probe_time) >= PROBE_PERIOD:
+				try:
+					self.transport.write(PROBE_MSG)
+				except Exception as e:
+					pass
+				probe_time = cur_time
+			self.arduino_ready.wait(0.05)
+		if self.arduino_ready.is_set():
+			print("Arduino ready after %.2f second(s)" % (time.time() - self.ser_open_time))
+
+	############################################################################
+	def negotiate_version(self):
+		"""
+		PURPOSE: agrees on a protocol version with the arduino
+		ARGS: none
+		RETURNS: (int) the protocol version to speak
+		NOTES: falls back to version 1 (which every arduino speaks) if the 
+			   arduino doesn't answer
+		"""
+		self.link_version = 1
+		version = min(self.protocol, self.fw_version or 1)
+		if version < 2:
+			return self.link_version
+
+		self.version_agreed.clear()
+		self.transport.write(version_msg(version))
+		if self.version_agreed.wait(VERSION_TIMEOUT):
+			print("Speaking protocol version %d to arduino" % self.link_version)
+		else:
+			print("Arduino didn't agree to protocol version %d, using version 1..." % version)
+			self.link_version = 1
+		return self.link_version
+
+	############################################################################
+	def negotiate_baudrate(self):
+		"""
+		PURPOSE: switches the link to the arduino to the fastest baud rate 
+				 that works reliably
+		ARGS: none
+		RETURNS: none
+		NOTES: tries each baud rate up to max_baudrate, fastest first, and 
+			   checks it with a burst of probes before telling the arduino to 
+			   keep it. Stays at the baud rate the arduino booted at if none 
+			   work or the arduino doesn't know how to switch (older firmware 
+			   doesn't answer BAUD)
+		"""
+		boot_baudrate = self.transport.baudrate
+		if boot_baudrate is None or self.fw_version is None:
+			return
+
+		for baudrate in reversed(BAUD_RATES):
+			if baudrate <= boot_baudrate or baudrate > self.max_baudrate:
+				continue
+			baud_idx = BAUD_RATES.index(baudrate)
+			self.baud_agreed.clear()
+			self.transport.write(baud_msg(baud_idx))
+			if not self.baud_agreed.wait(VERSION_TIMEOUT):
+				print("Arduino can't change baud rates, staying at %d baud" % boot_baudrate)
+				return
+			if self.baud_ack != baud_idx:
+				continue
+
+			try:
+				self.transport.set_baudrate(baudrate)
+			except (OSError, ValueError) as e:
+				print("Unable to switch to %d baud: %s" % (baudrate, str(e)))
+			else:
+				if self.check_link():
+					self.baud_agreed.clear()
+					self.transport.write(baud_msg(baud_idx))
+					if self.baud_agreed.wait(VERSION_TIMEOUT) and self.baud_ack == baud_idx:
+						print("Talking to arduino at %d baud" % baudrate)
+						return
+				print("Too many errors at %d baud..." % baudrate)
+
+			#The arduino goes back on its own since we didn't keep the new 
+			#baud rate
+			self.transport.set_baudrate(boot_baudrate)
+			self.stopping.wait(BAUD_CONFIRM_TIME)
+			if not self.check_link():
+				print("Lost the arduino going back to %d baud!" % boot_baudrate)
+				return
+
+	############################################################################
+	def check_link(self):
+		"""
+		PURPOSE: checks if the link to the arduino is reliable
+		ARGS: none
+		RETURNS: (bool) True if the arduino answered every probe, False if 
+				 not
+		NOTES: a corrupted byte in either direction loses a probe or its 
+			   answer. Parse errors aren't counted since they could be from
+			   garbage sent before the baud rate changed
+		"""
+		hellos = self.hellos
+		self.transport.write(PROBE_MSG * BAUD_CHECK_PROBES)
+		end_time = time.time() + BAUD_CHECK_TIME
+		while self.hellos - hellos < BAUD_CHECK_PROBES and time.time() < end_time:
+			time.sleep(0.005)
+		return self.hellos - hellos >= BAUD_CHECK_PROBES
+
+	############################################################################
+	def read_state_arduino(self):
+		"""
+		PURPOSE: reads the actual state of the hub that the arduino sends back
+				 to us and keeps cur_frame and cur_sel up to date
+		ARGS: none
+		RETURNS: none
+		NOTES: should be run in a seperate thread, only ever blocks on the 
+			   serial port (which releases the GIL) so it won't starve the 
+			   thread writing to the arduino
+		"""
+		self.parser.reset()
+		fps_time = time.time()
+		fps_frames = self.parser.frames
+
+		try:
+			while self.keep_going.is_set():
+				data = self.transport.read()
+				cur_time = time.time()
+				frame = None
+				for msg in self.parser.feed(data):
+					if msg[0] == CTRL_SYNC_BYTE:
+						self.handle_ctrl(msg)
+					else:
+						frame = msg
+				if frame:
+					#Only the latest state matters, and if the arduino is 
+					#sending state it must be ready
+					with self.cur_lock:
+						changed = self.cur_frame is None or self.cur_frame[2:FRAME_LEN] != frame[2:FRAME_LEN]
+						self.cur_frame = frame
+						self.cur_sel = list(frame[SEL_IDX:FRAME_LEN])
+						self.cur_time = cur_time
+					self.arduino_ready.set()
+					if len(frame) > SEQ_IDX and frame[SEQ_IDX] == self.sent_seq:
+						self.frame_acked.set()
+					self.check_divergence(cur_time)
+					if changed:
+						for cb in list(self.state_cbs):
+							cb()
+
+				#Update frames per second about once a second
+				if (cur_time - fps_time) >= 1:
+					self.rx_fps = (self.parser.frames - fps_frames) / (cur_time - fps_time)
+					fps_time = cur_time
+					fps_frames = self.parser.frames
+		except Exception as e:
+			print("'read_state_arduino' encountered exception '%s': %s" % (type(e), str(e)))
+
+	############################################################################
+	def handle_ctrl(self, msg):
+		"""
+		PURPOSE: handles a control message from the arduino
+		ARGS:
+			msg (bytes): the control message, starting at the sync bytes
+		RETURNS: none
+		NOTES:
+		"""
+		if msg[2] == CTRL_HELLO:
+			self.fw_version = msg[3]
+			self.hellos += 1
+			self.arduino_ready.set()
+		elif msg[2] == CTRL_VERSION:
+			self.link_version = msg[3]
+			self.version_agreed.set()
+		elif msg[2] == CTRL_BAUD:
+			self.baud_ack = msg[3]
+			self.baud_agreed.set()
+		elif msg[2] == CTRL_NAK:
+			#The arduino couldn't apply a frame, wake up the serial thread to
+			#send it a keyframe
+			self.naks += 1
+			self.need_keyframe.set()
+			self.frame_acked.set()
+
+	############################################################################
+	def check_divergence(self, cur_time):
+		"""
+		PURPOSE: keeps track of how long the actual state of the hub has been 
+				 different from the state we desire
+		ARGS:
+			cur_time (float): time the latest actual state was received
+		RETURNS: none
+		NOTES:
+		"""
+		if self.get_divergence():
+			if self.diverged_since is None:
+				self.diverged_since = cur_time
+		else:
+			self.diverged_since = None
+
 	############################################################################
 	def restart_arduino(self):
 		"""
 		PURPOSE: restarts the arduino in case it becomes out of sync with us or 
 				 the hub and gets stuck
 		ARGS: none
+		RETURNS: (Restart_Status) progress of the restart
+		NOTES: returns right away and restarts in a seperate thread, if a 
+			   restart is already in progress it returns the status of that
+			   one instead of starting another. Our state is kept and sent to
+			   the arduino as soon as it is back up
+		"""
+		with self.restart_lock:
+			if self.restart_status and not self.restart_status.done():
+				return self.restart_status
+			if self.stopping.is_set():
+				status = Restart_Status()
+				status.set_state(Restart_State.CANCELLED)
+				return status
+			print("Restarting arduino...")
+			self.restart_status = Restart_Status()
+			self.restart_thread = threading.Thread(target=self.do_restart, args=(self.restart_status,))
+			self.restart_thread.start()
+			return self.restart_status
+
+	############################################################################
+	def do_restart(self, status):
+		"""
+		PURPOSE: does the work of restarting the arduino
+		ARGS:
+			status (Restart_Status): where to report progress
 		RETURNS: none
-		NOTES: blocks until it can open the serial port
+		NOTES: should be run in a seperate thread, see restart_arduino
+		"""
+		#Stop the serial threads
+		self.stop_serial_threads()
+
+		while True:
+			#Reopen the serial port, which reboots the arduino
+			status.set_state(Restart_State.OPENING)
+			self.streaming.clear()
+			self.arduino_ready.clear()
+			self.port_moved.clear()
+			self.fw_version = None
+			self.sent_seq = None
+			self.need_keyframe.clear()
+			self.open_serial_con()
+			if self.stopping.is_set():
+				status.set_state(Restart_State.CANCELLED)
+				return
+
+			#Start the serial threads and wait for them to start sending frames
+			status.set_state(Restart_State.BOOTING)
+			self.ser_thread = threading.Thread(target=self.sync_state_arduino)
+			self.read_thread = threading.Thread(target=self.read_state_arduino)
+			self.keep_going.set()
+			self.ser_thread.start()
+			self.read_thread.start()
+			while not self.streaming.wait(0.1):
+				if self.stopping.is_set() or not self.keep_going.is_set():
+					break
+			if self.streaming.is_set():
+				break
+
+			#Try again on the serial port the transport moved to
+			if self.port_moved.is_set() and not self.stopping.is_set():
+				self.stop_serial_threads()
+				continue
+			status.set_state(Restart_State.CANCELLED)
+			return
+		status.set_state(Restart_State.RUNNING)
+		print("Arduino restarted in %.2f second(s)" % status.elapsed())
+
+	############################################################################
+	def stop_serial_threads(self):
+		"""
+		PURPOSE: stops the threads writing to and reading from the arduino
+		ARGS: none
+		RETURNS: none
+		NOTES: blocks until they have stopped
 		"""
-		print("Restarting arduino...")
 		self.keep_going.clear()
+		self.state_changed.set()
 		if self.ser_thread:
 			self.ser_thread.join()
-		self.ser_thread = threading.Thread(target=self.sync_state_arduino)
-		self.keep_going.set()
-
-		self.close_serial_con()
-		self.open_serial_con()
-
-		self.ser_thread.start()
+			self.ser_thread = None
+		if self.read_thread:
+			self.read_thread.join()
+			self.read_thread = None
 
 	############################################################################
 	def stop(self):
@@ -218,26 +686,22 @@ class Rokenbok_Hub:
 		RETURNS: none
 		NOTES:
 		"""
-		#Release all buttons
-		self.ctrl_forward = 0
-		self.ctrl_back = 0
-		self.ctrl_left = 0
-		self.ctrl_right = 0
-		self.ctrl_a = 0
-		self.ctrl_b = 0
-		self.ctrl_x = 0
-		self.ctrl_y = 0
-		self.ctrl_slow = 0
-		self.ctrl_sharing = 0
-		self.ctrl_sel = [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
+		#Release all buttons and deselect
+		with self.state_lock:
+			self.frame[2:PRIORITY_IDX] = bytes(PRIORITY_IDX - 2)
+			self.frame[SEL_IDX:] = bytes([0xFF] * 8)
+		self.state_changed.set()
 
 		#Give time for buttons to take effect
 		time.sleep(0.5)
 
-		#Stop thread
-		self.keep_going.clear()
-		if self.ser_thread:
-			self.ser_thread.join()
+		#Cancel any restart in progress and stop threads
+		self.stopping.set()
+		with self.restart_lock:
+			restart_thread = self.restart_thread
+		if restart_thread:
+			restart_thread.join()
+		self.stop_serial_threads()
 
 		#Close serial connection
 		self.close_serial_con()
@@ -256,99 +720,12 @@ class Rokenbok_Hub:
 			   will happen. If an invalid player is given it will be ignored 
 			   and nothing will happen
 		"""
-		if player < 1 or player > 8:
-			return
-		player -= 1
-
-		mask = 1 << player
-		if not press:
-			if player == 0:
-				mask = 0b11111110
-			elif player == 1:
-				mask = 0b11111101
-			elif player == 2:
-				mask = 0b11111011
-			elif player == 3:
-				mask = 0b11110111
-			elif player == 4:
-				mask = 0b11101111
-			elif player == 5:
-				mask = 0b11011111
-			elif player == 6:
-				mask = 0b10111111
-			else:
-				mask = 0b01111111
+		with self.state_lock:
+			changed = self.cmd_locked(button, player, press)
 
-		if button == Button.FORWARD:
-			self.ctrl_forward_lock.acquire()
-			if press:
-				self.ctrl_forward |= mask
-			else:
-				self.ctrl_forward &= mask
-			self.ctrl_forward_lock.release()
-		elif button == Button.BACK:
-			self.ctrl_back_lock.acquire()
-			if press:
-				self.ctrl_back |= mask
-			else:
-				self.ctrl_back &= mask
-			self.ctrl_back_lock.release()
-		elif button == Button.LEFT:
-			self.ctrl_left_lock.acquire()
-			if press:
-				self.ctrl_left |= mask
-			else:
-				self.ctrl_left &= mask
-			self.ctrl_left_lock.release()
-		elif button == Button.RIGHT:
-			self.ctrl_right_lock.acquire()
-			if press:
-				self.ctrl_right |= mask
-			else:
-				self.ctrl_right &= mask
-			self.ctrl_right_lock.release()
-		elif button == Button.A:
-			self.ctrl_a_lock.acquire()
-			if press:
-				self.ctrl_a |= mask
-			else:
-				self.ctrl_a &= mask
-			self.ctrl_a_lock.release()
-		elif button == Button.B:
-			self.ctrl_b_lock.acquire()
-			if press:
-				self.ctrl_b |= mask
-			else:
-				self.ctrl_b &= mask
-			self.ctrl_b_lock.release()
-		elif button == Button.X:
-			self.ctrl_x_lock.acquire()
-			if press:
-				self.ctrl_x |= mask
-			else:
-				self.ctrl_x &= mask
-			self.ctrl_x_lock.release()
-		elif button == Button.Y:
-			self.ctrl_y_lock.acquire()
-			if press:
-				self.ctrl_y |= mask
-			else:
-				self.ctrl_y &= mask
-			self.ctrl_y_lock.release()
-		elif button == Button.SLOW:
-			self.ctrl_slow_lock.acquire()
-			if press:
-				self.ctrl_slow |= mask
-			else:
-				self.ctrl_slow &= mask
-			self.ctrl_slow_lock.release()
-		elif button == Button.SHARING:
-			self.ctrl_sharing_lock.acquire()
-			if press:
-				self.ctrl_sharing |= mask
-			else:
-				self.ctrl_sharing &= mask
-			self.ctrl_sharing_lock.release()
+		#Wake up serial thread to send new state
+		if changed:
+			self.notify_state_changed()
 
 	############################################################################
 	def change_sel(self, player, des_sel):
@@ -364,25 +741,142 @@ class Rokenbok_Hub:
 			   number is given the that player will change its selection to 
 			   nothing giving up his current car
 		"""
+		with self.state_lock:
+			changed = self.change_sel_locked(player, des_sel)
+
+		#Wake up serial thread to send new state
+		if changed:
+			self.notify_state_changed()
+		return changed
+
+	############################################################################
+	def apply(self, changes):
+		"""
+		PURPOSE: performs many commands and selection changes at once so they 
+				 all show up together in the same frame sent to the arduino
+		ARGS:
+			changes (iterable): each change is either a tuple of 
+								(button, player, press) like the arguments to 
+								cmd, or a tuple of (player, des_sel) like the 
+								arguments to change_sel
+		RETURNS: (list) a bool for each change, True if it was applied and 
+				 False if it was ignored or the selection was unavailable
+		NOTES: changes are applied in order, so a later change can undo an 
+			   earlier one in the same batch
+		"""
+		results = []
+		with self.state_lock:
+			for change in changes:
+				if len(change) == 3:
+					results.append(self.cmd_locked(*change))
+				else:
+					results.append(self.change_sel_locked(*change))
+
+		#Wake up serial thread to send new state
+		if any(results):
+			self.notify_state_changed()
+		return results
+
+	############################################################################
+	def set_state(self, state):
+		"""
+		PURPOSE: replaces the whole state we desire
+		ARGS:
+			state (bytes): the new state, laid out like a frame without the
+						   sync bytes (see get_state)
+		RETURNS: none
+		NOTES:
+		"""
+		with self.state_lock:
+			if self.frame[2:] == state:
+				return
+			self.frame[2:] = state
+
+		#Wake up serial thread to send new state
+		self.notify_state_changed()
+
+	############################################################################
+	def notify_state_changed(self):
+		"""
+		PURPOSE: lets whatever sends our state to the arduino know it changed
+		ARGS: none
+		RETURNS: none
+		NOTES: called after the frame changes, without holding state_lock
+		"""
+		self.state_changed.set()
+
+	############################################################################
+	def cmd_locked(self, button, player, press):
+		"""
+		PURPOSE: presses or releases a button in our frame
+		ARGS:
+			button (Button): the button to press or release
+			player (int): the player to perform the command (1-8)
+			press (bool): True to press the button, False to release it
+		RETURNS: (bool) True if the command was valid, False if it was ignored
+		NOTES: state_lock must be held by the caller
+		"""
 		if player < 1 or player > 8:
 			return False
-		player -= 1
+		idx = BUTTON_IDX.get(button)
+		if idx is None:
+			return False
 
-		if des_sel < 1 or des_sel > 8:
-			self.ctrl_sel_lock.acquire()
-			self.ctrl_sel[player] = 0xFF
-			self.ctrl_sel_lock.release()
-			return True
+		if press:
+			self.frame[idx] |= PRESS_MASKS[player - 1]
+		else:
+			self.frame[idx] &= RELEASE_MASKS[player - 1]
+		return True
 
-		des_sel -= 1
-		if des_sel in self.ctrl_sel:
+	############################################################################
+	def change_sel_locked(self, player, des_sel):
+		"""
+		PURPOSE: changes the selection of a player in our frame
+		ARGS:
+			player (int): player to change selection of (1-8)
+			des_sel (int): car to select (1-8), anything else deselects
+		RETURNS: (bool) True if able to change, False if not
+		NOTES: state_lock must be held by the caller, see change_sel
+		"""
+		if player < 1 or player > 8:
 			return False
+
+		if des_sel < 1 or des_sel > 8:
+			des_sel = 0xFF
 		else:
-			self.ctrl_sel_lock.acquire()
-			self.ctrl_sel[player] = des_sel
-			self.ctrl_sel_lock.release()
+			des_sel -= 1
+			if des_sel in self.frame[SEL_IDX:]:
+				return False
+
+		self.frame[SEL_IDX + player - 1] = des_sel
 		return True
 
+	############################################################################
+	def add_state_cb(self, cb):
+		"""
+		PURPOSE: sets a function to call whenever the actual state of the hub
+				 changes
+		ARGS:
+			cb (function): function to call, takes no arguments
+		RETURNS: none
+		NOTES: cb is called from the thread reading from the arduino so it 
+			   should return quickly, and it isn't called when the arduino 
+			   sends the same state again
+		"""
+		self.state_cbs.append(cb)
+
+	############################################################################
+	def remove_state_cb(self, cb):
+		"""
+		PURPOSE: stops calling a function set with add_state_cb
+		ARGS:
+			cb (function): function to stop calling
+		RETURNS: none
+		NOTES:
+		"""
+		if cb in self.state_cbs:
+			self.state_cbs.remove(cb)
+
 	############################################################################
 	def get_sels(self):
 		"""
@@ -393,7 +887,103 @@ class Rokenbok_Hub:
 		NOTES: index n = player n + 1 and selection n is n + 1 on remote, 0xFF 
 			   is no selection
 		"""
-		return (self.cur_sel, self.ctrl_sel)
+		with self.state_lock:
+			ctrl_sel = list(self.frame[SEL_IDX:])
+		return (self.cur_sel, ctrl_sel)
+
+	############################################################################
+	def get_state(self):
+		"""
+		PURPOSE: gets the whole state of every controller
+		ARGS: none
+		RETURNS: (bytes, bytes) the state we desire and the actual state of 
+				 the hub, each laid out like a frame without the sync bytes. 
+				 The actual state is None if we haven't heard from the 
+				 arduino yet
+		NOTES:
+		"""
+		with self.state_lock:
+			des_state = bytes(self.frame[2:])
+		with self.cur_lock:
+			cur_frame = self.cur_frame
+		if cur_frame is None:
+			return (des_state, None)
+		return (des_state, bytes(cur_frame[2:FRAME_LEN]))
+
+	############################################################################
+	def get_divergence(self):
+		"""
+		PURPOSE: compares the actual state of the hub to the state we desire
+		ARGS: none
+		RETURNS: (dict) maps the index of each byte in the frame that differs 
+				 to a tuple of (desired, actual), empty if they are the same 
+				 or we haven't heard from the arduino yet
+		NOTES: a change always diverges for a short time until the hub catches
+			   up to it
+		"""
+		with self.cur_lock:
+			cur_frame = self.cur_frame
+		if cur_frame is None:
+			return {}
+		with self.state_lock:
+			des_frame = bytes(self.frame)
+		diff = {}
+		for idx in range(2, FRAME_LEN):
+			if des_frame[idx] != cur_frame[idx]:
+				diff[idx] = (des_frame[idx], cur_frame[idx])
+		return diff
+
+	############################################################################
+	def get_stats(self):
+		"""
+		PURPOSE: gets statistics about the state the arduino sends back to us
+		ARGS: none
+		RETURNS: (dict) with the following keys:
+					'frames' (int): frames received
+					'fps' (float): frames received per second
+					'parse_errors' (int): garbage or invalid frames thrown out
+					'last_frame_time' (float): time of the last frame, None if 
+											   we never received one
+					'diverged_fields' (int): number of bytes in the frame where
+											 the actual state differs from 
+											 the desired state
+					'diverged_for' (float): seconds the actual state has been 
+											different from the desired state
+					'link_version' (int): protocol version spoken to arduino
+					'baudrate' (int): baud rate of the link to the arduino, 
+									  None if it doesn't have one
+					'tx_frames' (int): frames sent to the arduino
+					'tx_bytes' (int): bytes sent to the arduino
+					'naks' (int): frames the arduino rejected
+					'retransmits' (int): keyframes sent to resync the arduino
+					'write_latency' (Histogram): seconds taken to write each 
+												 frame to the arduino
+					'locks' (dict): the number of times each lock was 
+									acquired, and the total seconds spent 
+									waiting for it and holding it, as a 
+									tuple keyed by the name of the lock
+		NOTES: write_latency is the histogram itself, not a copy
+		"""
+		diverged_since = self.diverged_since
+		return {
+			'frames' : self.parser.frames,
+			'fps' : self.rx_fps,
+			'parse_errors' : self.parser.parse_errors,
+			'last_frame_time' : self.cur_time,
+			'diverged_fields' : len(self.get_divergence()),
+			'diverged_for' : 0.0 if diverged_since is None else time.time() - diverged_since,
+			'link_version' : self.link_version,
+			'baudrate' : self.transport.baudrate,
+			'tx_frames' : self.tx_frames,
+			'tx_bytes' : self.tx_bytes,
+			'naks' : self.naks,
+			'retransmits' : self.retransmits,
+			'write_latency' : self.write_latency,
+			'locks' : {
+				'state' : (self.state_lock.acquisitions, self.state_lock.wait_time, self.state_lock.hold_time),
+				'cur' : (self.cur_lock.acquisitions, self.cur_lock.wait_time, self.cur_lock.hold_time)
+			}
+		}
 
 	############################################################################
 
@@ -401,17 +991,15 @@ class Rokenbok_Hub:
 if __name__ == "__main__":
 	print("Waiting for arduino to reboot")
 	rh = Rokenbok_Hub()
-	time.sleep(6)
+	rh.restart_status.wait()
 	print("Should be running...")
 
 	try:
 		while True:
 			rh.change_sel(1, 3)
-			rh.cmd(Button.BACK, 1, False)
-			rh.cmd(Button.FORWARD, 1, True)
+			rh.apply([(Button.BACK, 1, False), (Button.FORWARD, 1, True)])
 			time.sleep(5)
-			rh.cmd(Button.FORWARD, 1, False)
-			rh.cmd(Button.BACK, 1, True)
+			rh.apply([(Button.FORWARD, 1, False), (Button.BACK, 1, True)])
 			time.sleep(5)
 	except KeyboardInterrupt as e:
 		pass
@@ -1,361 +1,158 @@
 #Imports
-import serial
-import serial.tools.list_ports as list_ports
-import threading
+from Rokenbok_Hub import Rokenbok_Hub, Button
+from Hub_Transport import Loopback_Transport, Pty_Transport
+from Hub_Protocol import BAUD_RATES
+from Arduino_Emulator import Arduino_Emulator
+import socket
+import sys
 import time
-from enum import Enum
 
 ################################################################################
-class Button(Enum):
-	FORWARD = 1
-	BACK = 2
-	LEFT = 3
-	RIGHT = 4
-	A = 5
-	B = 6
-	X = 7
-	Y = 8
-	SLOW = 9
-	SHARING = 10
-
-################################################################################
-class Rokenbok_Hub:
+class Rokenbok_Hub_Emulator(Rokenbok_Hub):
 	"""
-	Represents the white hub that the controllers connect to and controls all 
-	the trucks and devices. Keeps track of the state of everything. This class
-	models that hub and interacts with the real hub via an arduino
+	A Rokenbok_Hub that talks to an emulated arduino in memory instead of a
+	real one, so everything above the hub can run without any hardware
 	"""
 	############################################################################
-	def __init__(self, arduino_port=None, baudrate=115200):
+	def __init__(self, heartbeat=0.5, max_fps=200, emulator=None):
 		"""
-		PURPOSE: creates a new Rokenbok_Hub
+		PURPOSE: creates a new Rokenbok_Hub_Emulator
 		ARGS:
-			arduino_port (str): name of the serial port to communicate to the 
-								arduino with. If left at 'None' then it will 
-								try to find the correct serial port itself.
-			baudrate (int): baudrate to communicate to the arduino with
-		RETURNS: new instance of a Rokenbok_Hub
-		NOTES:
-		"""
-		#Bytes represting state of controllers that we can change
-		self.ctrl_forward = 0
-		self.ctrl_back = 0
-		self.ctrl_left = 0
-		self.ctrl_right = 0
-		self.ctrl_a = 0
-		self.ctrl_b = 0
-		self.ctrl_x = 0
-		self.ctrl_y = 0
-		self.ctrl_slow = 0
-		self.ctrl_sharing = 0
-		self.ctrl_sel = [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
-
-		#Locks for state variables allowing for multithreading
-		self.ctrl_forward_lock = threading.Lock()
-		self.ctrl_back_lock = threading.Lock()
-		self.ctrl_left_lock = threading.Lock()
-		self.ctrl_right_lock = threading.Lock()
-		self.ctrl_a_lock = threading.Lock()
-		self.ctrl_b_lock = threading.Lock()
-		self.ctrl_x_lock = threading.Lock()
-		self.ctrl_y_lock = threading.Lock()
-		self.ctrl_slow_lock = threading.Lock()
-		self.ctrl_sharing_lock = threading.Lock()
-		self.ctrl_sel_lock = threading.Lock()
-
-		#Constants used for communicating with arduino and controlling hub
-		self.priority = 0
-		self.sync_byte = 0b10101010
-
-		#Used to keep track of the actual current selection and not just what
-		#we desire because they could possibly become unsynced
-		self.cur_sel = [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
-
-		#Save baudrate
-		self.baudrate = int(baudrate)
-
-		#Start the serial connection
-		self.ser = None
-		self.ser_open_time = None
-		self.open_serial_con()
-
-		#Start the serial communication thread
-		self.ser_thread = None
-		self.keep_going = threading.Event()
-		self.restart_arduino()
-
-	############################################################################
-	def __del__(self):
-		"""
-		PURPOSE: perform any necessary cleanup
-		ARGS: none
-		RETURNS: none
-		NOTES:
-		"""
-		self.stop()
-
-	############################################################################
-	def open_serial_con(self):
-		"""
-		PURPOSE: opens the serial connection with the arduino
-		ARGS: none
-		RETURNS: none
-		NOTES: closes the serial port if it is already open and reopens it (this
-			   will restart the arduino), blocks until it can open the serial 
-			   port
-		"""
-		pass
-
-	############################################################################
-	def close_serial_con(self):
-		"""
-		PURPOSE: closes the serial connection to the arduino
-		ARGS: none
-		RETURNS: none
+			heartbeat (float): max number of seconds between frames sent to 
+							   the arduino when nothing changes
+			max_fps (float): max number of frames per second sent to the 
+							 arduino
+			emulator (Arduino_Emulator): emulated arduino to talk to, if None 
+										 then creates one
+		RETURNS: new instance of a Rokenbok_Hub_Emulator
 		NOTES:
 		"""
-		if self.ser and self.ser.isOpen():
-			self.ser.close()
-		self.ser = None
-
-	############################################################################
-	def sync_state_arduino(self):
-		"""
-		PURPOSE: keeps the arduino state and our state in sync which allows us 
-				 to pass our state onto the hub, thereby controlling the hub
-		ARGS: none
-		RETURNS: none
-		NOTES: should be run in a seperate thread
-		"""
-		pass
+		transport = Loopback_Transport(emulator)
+		Rokenbok_Hub.__init__(self, heartbeat=heartbeat, max_fps=max_fps, transport=transport)
 
 	############################################################################
-	def restart_arduino(self):
-		"""
-		PURPOSE: restarts the arduino in case it becomes out of sync with us or 
-				 the hub and gets stuck
-		ARGS: none
-		RETURNS: none
-		NOTES: blocks until it can open the serial port
-		"""
-		print("Restarting arduino...")
-		self.keep_going.clear()
-		self.keep_going.set()
-
-		self.close_serial_con()
-		self.open_serial_con()
-
-	############################################################################
-	def stop(self):
-		"""
-		PURPOSE: stops the thread and closes the serial conneciton, used in 
-				 preperation to delete object
-		ARGS: none
-		RETURNS: none
-		NOTES:
-		"""
-		#Release all buttons
-		self.ctrl_forward = 0
-		self.ctrl_back = 0
-		self.ctrl_left = 0
-		self.ctrl_right = 0
-		self.ctrl_a = 0
-		self.ctrl_b = 0
-		self.ctrl_x = 0
-		self.ctrl_y = 0
-		self.ctrl_slow = 0
-		self.ctrl_sharing = 0
-		self.ctrl_sel = [0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
 
-		#Give time for buttons to take effect
-		time.sleep(0.5)
-
-		#Stop thread
-		self.keep_going.clear()
-
-		#Close serial connection
-		self.close_serial_con()
-
-	############################################################################
-	def cmd(self, button, player, press=True):
-		"""
-		PURPOSE: performs a command such as pressing or releasing a button on 
-				 controller
-		ARGS:
-			button (Button): the button to press or release
-			player (int): the player to perform the command (1-8)
-			press (bool): True to press the button, False to release it
-		RETURNS: none
-		NOTES: if an invalid button is given it will be ignored and nothing 
-			   will happen. If an invalid player is given it will be ignored 
-			   and nothing will happen
-		"""
-		if player < 1 or player > 8:
-			return
-		player -= 1
-
-		mask = 1 << player
-		if not press:
-			if player == 0:
-				mask = 0b11111110
-			elif player == 1:
-				mask = 0b11111101
-			elif player == 2:
-				mask = 0b11111011
-			elif player == 3:
-				mask = 0b11110111
-			elif player == 4:
-				mask = 0b11101111
-			elif player == 5:
-				mask = 0b11011111
-			elif player == 6:
-				mask = 0b10111111
-			else:
-				mask = 0b01111111
-
-		if button == Button.FORWARD:
-			self.ctrl_forward_lock.acquire()
-			if press:
-				self.ctrl_forward |= mask
-			else:
-				self.ctrl_forward &= mask
-			self.ctrl_forward_lock.release()
-		elif button == Button.BACK:
-			self.ctrl_back_lock.acquire()
-			if press:
-				self.ctrl_back |= mask
-			else:
-				self.ctrl_back &= mask
-			self.ctrl_back_lock.release()
-		elif button == Button.LEFT:
-			self.ctrl_left_lock.acquire()
-			if press:
-				self.ctrl_left |= mask
-			else:
-				self.ctrl_left &= mask
-			self.ctrl_left_lock.release()
-		elif button == Button.RIGHT:
-			self.ctrl_right_lock.acquire()
-			if press:
-				self.ctrl_right |= mask
-			else:
-				self.ctrl_right &= mask
-			self.ctrl_right_lock.release()
-		elif button == Button.A:
-			self.ctrl_a_lock.acquire()
-			if press:
-				self.ctrl_a |= mask
-			else:
-				self.ctrl_a &= mask
-			self.ctrl_a_lock.release()
-		elif button == Button.B:
-			self.ctrl_b_lock.acquire()
-			if press:
-				self.ctrl_b |= mask
-			else:
-				self.ctrl_b &= mask
-			self.ctrl_b_lock.release()
-		elif button == Button.X:
-			self.ctrl_x_lock.acquire()
-			if press:
-				self.ctrl_x |= mask
-			else:
-				self.ctrl_x &= mask
-			self.ctrl_x_lock.release()
-		elif button == Button.Y:
-			self.ctrl_y_lock.acquire()
-			if press:
-				self.ctrl_y |= mask
-			else:
-				self.ctrl_y &= mask
-			self.ctrl_y_lock.release()
-		elif button == Button.SLOW:
-			self.ctrl_slow_lock.acquire()
-			if press:
-				self.ctrl_slow |= mask
-			else:
-				self.ctrl_slow &= mask
-			self.ctrl_slow_lock.release()
-		elif button == Button.SHARING:
-			self.ctrl_sharing_lock.acquire()
-			if press:
-				self.ctrl_sharing |= mask
-			else:
-				self.ctrl_sharing &= mask
-			self.ctrl_sharing_lock.release()
-
-	############################################################################
-	def change_sel(self, player, des_sel):
-		"""
-		PURPOSE: changes the selection of a player
-		ARGS:
-			player (int): player to change selection of (1-8)
-			des_sel (int): car to select (1-8)
-		RETURNS: (bool) True if able to change, False if not
-		NOTES: will return False someone already has that car selected 
-			   (including the current player), if an invalid player number is 
-			   given it will ignore it and return False, if an invalid selection 
-			   number is given the that player will change its selection to 
-			   nothing giving up his current car
-		"""
-		if player < 1 or player > 8:
-			return False
-		player -= 1
-
-		if des_sel < 1 or des_sel > 8:
-			self.ctrl_sel_lock.acquire()
-			self.ctrl_sel[player] = 0xFF
-			self.ctrl_sel_lock.release()
-			return True
+################################################################################
+def serve_tcp(port):
+	"""
+	PURPOSE: serves an emulated arduino over TCP so a Rokenbok_Hub using a 
+			 TCP_Transport can connect to it
+	ARGS:
+		port (int): port to listen on
+	RETURNS: none
+	NOTES: handles one connection at a time, each new connection restarts the
+		   emulated arduino like opening the serial port would
+	"""
+	listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	listen_socket.bind(('0.0.0.0', port))
+	listen_socket.listen(1)
+	emulator = Arduino_Emulator()
+	print("Emulated arduino listening on port %d..." % port)
+	while True:
+		conn, addr = listen_socket.accept()
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		print("Got connection from %s" % addr[0])
+		try:
+			conn.sendall(emulator.reset())
+			while True:
+				data = conn.recv(4096)
+				if data == b'':
+					break
+				resp = emulator.feed(data)
+				if resp:
+					conn.sendall(resp)
+		except OSError as e:
+			print(e)
+		conn.close()
+		print("Closing connection %s (%d frames)" % (addr[0], emulator.frames))
 
-		des_sel -= 1
-		if des_sel in self.ctrl_sel:
-			return False
+################################################################################
+def benchmark(transport='loopback', seconds=2.0, error_rate=0.0):
+	"""
+	PURPOSE: measures how many frames per second get through the link to an 
+			 emulated arduino, and how many of them get corrupted, at each 
+			 baud rate
+	ARGS:
+		transport (str): 'loopback' to talk to the emulator in memory with 
+						 bytes taking as long as they would over a serial 
+						 port, or 'pty' to talk to it through a 
+						 pseudo-terminal
+		seconds (float): seconds to send frames for at each baud rate
+		error_rate (float): chance of any byte being corrupted
+	RETURNS: (list) a dict of results for each baud rate with the keys 
+			 'baudrate', 'tx_fps', 'rx_fps' and 'error_rate'
+	NOTES: changes our state as fast as possible so the link is the 
+		   bottleneck. A pseudo-terminal moves bytes at the same speed 
+		   whatever the baud rate is, so it only measures our own overhead
+	"""
+	results = []
+	for baudrate in BAUD_RATES:
+		emulator = Arduino_Emulator(error_rate=error_rate)
+		if transport == 'pty':
+			link = Pty_Transport(emulator)
 		else:
-			self.ctrl_sel_lock.acquire()
-			self.ctrl_sel[player] = des_sel
-			self.ctrl_sel_lock.release()
-		return True
-
-	############################################################################
-	def get_sels(self):
-		"""
-		PURPOSE: gets the current selection for all players
-		ARGS: none
-		RETURNS: (list, list) list of current selections according to the 
-				 hub and list of desired selections according to us
-		NOTES: index n = player n + 1 and selection n is n + 1 on remote, 0xFF 
-			   is no selection
-		"""
-		return (self.cur_sel, self.ctrl_sel)
-
-	############################################################################
+			link = Loopback_Transport(emulator, paced=True)
+		rh = Rokenbok_Hub(heartbeat=0.05, max_fps=100000, transport=link, max_baudrate=baudrate)
+		rh.restart_status.wait()
+		rh.streaming.wait()
+
+		#Press and release every button as fast as we can
+		start = rh.get_stats()
+		start_time = time.time()
+		end_time = start_time + seconds
+		press = True
+		while time.time() < end_time:
+			for button in Button:
+				rh.cmd(button, 1, press)
+			press = not press
+			time.sleep(0.0001)
+		end = rh.get_stats()
+		elapsed = time.time() - start_time
+		rh.stop()
+
+		tx_frames = end['tx_frames'] - start['tx_frames']
+		errors = (end['naks'] - start['naks']) + (end['parse_errors'] - start['parse_errors'])
+		results.append({
+			'baudrate' : end['baudrate'],
+			'tx_fps' : tx_frames / elapsed,
+			'rx_fps' : (end['frames'] - start['frames']) / elapsed,
+			'error_rate' : errors / float(tx_frames) if tx_frames else 0.0
+		})
+	return results
 
 ################################################################################
 if __name__ == "__main__":
-	print("Waiting for arduino to reboot")
-	rh = Rokenbok_Hub()
-	time.sleep(6)
-	print("Should be running...")
-
+	if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+		#bench [loopback|pty] [seconds] [error rate]
+		transport = sys.argv[2] if len(sys.argv) > 2 else 'loopback'
+		seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0
+		error_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+		results = benchmark(transport, seconds, error_rate)
+		print("")
+		print("%10s %10s %10s %10s" % ("baud", "sent fps", "recv fps", "errors"))
+		for result in results:
+			print("%10d %10.1f %10.1f %9.2f%%" % (result['baudrate'], result['tx_fps'], result['rx_fps'], 100 * result['error_rate']))
+		sys.exit()
+
+	if len(sys.argv) > 1:
+		try:
+			serve_tcp(int(sys.argv[1]))
+		except KeyboardInterrupt as e:
+			pass
+		sys.exit()
+
+	rh = Rokenbok_Hub_Emulator()
 	try:
 		while True:
 			rh.change_sel(1, 3)
-			rh.cmd(Button.BACK, 1, False)
-			rh.cmd(Button.FORWARD, 1, True)
-			time.sleep(5)
-			rh.cmd(Button.FORWARD, 1, False)
-			rh.cmd(Button.BACK, 1, True)
-			time.sleep(5)
+			rh.apply([(Button.BACK, 1, False), (Button.FORWARD, 1, True)])
+			time.sleep(1)
+			print(rh.get_sels(), rh.get_stats())
+			rh.apply([(Button.FORWARD, 1, False), (Button.BACK, 1, True)])
+			time.sleep(1)
 	except KeyboardInterrupt as e:
 		pass
 
 	print("Stopping...")
 	rh.stop()
-
-
-
-
-
-
-
@@ -0,0 +1,135 @@
+#Imports
+from Rokenbok_Client import Rokenbok_Client, key_code
+import sys
+import time
+
+################################################################################
+#A macro is a text file with an input on each line: the seconds since the
+#start of the macro it happens at, what it does and its argument, for example
+#
+#	#Drive car 1 forward for half a second
+#	0.000 select 1
+#	0.000 expect 1 2.0
+#	0.100 press up
+#	0.600 release up
+#
+#press and release take a key (see key_code), select takes a car (1-8, 0 to
+#deselect) and expect waits up to a number of seconds (1 if left out) for a
+#car to be selected, failing the macro if it isn't. Blank lines and anything
+#after a # are ignored
+ACTIONS = ('press', 'release', 'select', 'expect')
+EXPECT_TIMEOUT = 1.0
+
+#Inputs are slept for until this many seconds before they are due and then
+#the clock is watched until they are, since sleeping can overshoot by a
+#millisecond or more
+SPIN_TIME = 0.002
+
+################################################################################
+def load_macro(path):
+	"""
+	PURPOSE: reads a macro file
+	ARGS:
+		path (str): the file
+	RETURNS: (list) a (seconds, action, args) tuple for each input, in order
+	NOTES: raises a ValueError naming the line if the file isn't a valid
+		   macro
+	"""
+	macro = []
+	with open(path) as f:
+		for line_num, line in enumerate(f, 1):
+			fields = line.split('#', 1)[0].split()
+			if not fields:
+				continue
+			try:
+				if len(fields) < 3 or fields[1] not in ACTIONS:
+					raise ValueError("expected '<seconds> <%s> <argument>'" % '|'.join(ACTIONS))
+				when = float(fields[0])
+				action = fields[1]
+				if action in ('press', 'release'):
+					args = (key_code(fields[2]),)
+				elif action == 'select':
+					args = (int(fields[2]),)
+				else:
+					args = (int(fields[2]), float(fields[3]) if len(fields) > 3 else EXPECT_TIMEOUT)
+				if action in ('select', 'expect') and (args[0] < 0 or args[0] > 8):
+					raise ValueError("car must be between 0 and 8")
+				if macro and when < macro[-1][0]:
+					raise ValueError("inputs must be in order")
+			except ValueError as e:
+				raise ValueError("%s line %d: %s" % (path, line_num, e))
+			macro.append((when, action, args))
+	return macro
+
+################################################################################
+def wait_until(when):
+	"""
+	PURPOSE: waits until a time
+	ARGS:
+		when (float): the time.perf_counter() time to wait until
+	RETURNS: none
+	NOTES: sleeps for most of it and spins for the last SPIN_TIME seconds
+	"""
+	while True:
+		left = when - time.perf_counter()
+		if left <= 0:
+			return
+		if left > SPIN_TIME:
+			time.sleep(left - SPIN_TIME)
+
+################################################################################
+def play_macro(client, macro, speed=1.0):
+	"""
+	PURPOSE: plays a macro on a client
+	ARGS:
+		client (Rokenbok_Client): the client, usually a headless one
+		macro (list): the inputs, see load_macro
+		speed (float): how much faster than recorded to play the macro
+	RETURNS: (list) how many seconds late each input was
+	NOTES: raises a RuntimeError if an expect fails. Time spent waiting on
+		   an expect doesn't delay the inputs after it, they keep to the
+		   schedule from the start of the macro
+	"""
+	late = []
+	start_time = time.perf_counter()
+	for when, action, args in macro:
+		due = start_time + when / speed
+		wait_until(due)
+		late.append(time.perf_counter() - due)
+		if action == 'press':
+			client.press(args[0])
+		elif action == 'release':
+			client.release(args[0])
+		elif action == 'select':
+			client.select(args[0])
+		elif not client.await_selection(args[0], args[1]):
+			raise RuntimeError("Car %d wasn't selected within %.3f second(s) of %.3f second(s) into the macro" % (args[0], args[1], when))
+	return late
+
+################################################################################
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print("Usage: Rokenbok_Macro.py <macro file> [ip] [port] [udp port] [speed]")
+		sys.exit(2)
+	macro = load_macro(sys.argv[1])
+	ip = sys.argv[2] if len(sys.argv) > 2 else "192.168.1.198"
+	port = int(sys.argv[3]) if len(sys.argv) > 3 else 8080
+	udp_port = int(sys.argv[4]) if len(sys.argv) > 4 else None
+	speed = float(sys.argv[5]) if len(sys.argv) > 5 else 1.0
+
+	client = Rokenbok_Client(ip, port, udp_port, keyboard=False)
+	failed = False
+	try:
+		late = play_macro(client, macro, speed)
+		if late:
+			late.sort()
+			print("Played %d input(s), late ms: median %.3f  max %.3f" % (len(late), late[len(late) // 2] * 1000, late[-1] * 1000))
+	except RuntimeError as e:
+		print(e)
+		failed = True
+	except KeyboardInterrupt as e:
+		failed = True
+	finally:
+		#The server lets go of every key we still hold when we leave
+		client.stop()
+	sys.exit(1 if failed else 0)
@@ -1,63 +1,222 @@
 #Imports
 #from Rokenbok_Hub import Rokenbok_Hub
 from Rokenbok_Hub import Rokenbok_Hub
+from Hub_Process import Rokenbok_Hub_Process
 from Rokenbok_Controller import Rokenbok_Controller
+import asyncio
+import collections
 import queue
+import random
 import socket
 import time
 import threading
-import sys
-from Rokenbok_Client import Message_Type
+from Client_Protocol import Message_Type, MSG_LEN, SPECTATE_MSG_LEN, PROTOCOL_VERSION, encode_msg, read_records, key_events
+from Key_State_Socket import Key_State_Tracker, unpack_key_state
+from Metrics import Histogram, RTT_BUCKETS, format_metric
 
 ################################################################################
-MSG_LEN = 3	#bytes per message
-UPDATE_TIME = 1
+#Max bytes waiting to be sent to a client before we stop sending it updates,
+#it gets the latest one once it catches up
+MAX_WRITE_BUFFER = 1024
+
+#Max bytes read from a client at once, every whole message in them is handled
+#before reading again
+RECV_SIZE = 4096
+
+#Number of heartbeat round trip times kept for each client
+RTT_HISTORY = 100
+
+################################################################################
+class Key_State_Protocol(asyncio.DatagramProtocol):
+	"""
+	Passes the key states clients send over UDP to the server
+	"""
+	############################################################################
+	def __init__(self, server):
+		"""
+		PURPOSE: creates a new Key_State_Protocol
+		ARGS:
+			server (Rokenbok_Server): the server to pass key states to
+		RETURNS: new instance of a Key_State_Protocol
+		NOTES:
+		"""
+		self.server = server
+
+	############################################################################
+	def datagram_received(self, data, addr):
+		"""
+		PURPOSE: called by the event loop when a packet arrives
+		ARGS:
+			data (bytes): the packet
+			addr (tuple): ip address and port the packet came from
+		RETURNS: none
+		NOTES:
+		"""
+		self.server.key_state_received(data, addr)
+
+	############################################################################
 
 ################################################################################
 class Rokenbok_Server:
 	"""
-	The server that accepts client connections and lets them control the cars 
+	The server that accepts client connections and lets them control the cars
 	remotely
 	"""
 	############################################################################
-	def __init__(self, ip='127.0.0.1', port=8080):
+	def __init__(self, ip='127.0.0.1', port=8080, hub=None, spectator_port=8081, spectator_fps=20, max_waiting=64, session_time=None, udp_port=8082, heartbeat_period=0.1, heartbeat_timeout=0.4, metrics_port=8083, hub_process=False):
 		"""
 		PURPOSE: creates a new Rokenbok_Server
 		ARGS:
 			ip (str): ip address of server
 			port (int): port of server
+			hub (Rokenbok_Hub): hub to control, if None then creates one
+			spectator_port (int): port for spectators to watch the state of 
+								  every controller on, if None then 
+								  spectators aren't allowed
+			spectator_fps (float): max number of states per second sent to 
+								   spectators
+			max_waiting (int): max number of clients waiting in line for a 
+							   controller, clients past this are told the 
+							   server is full
+			session_time (float): seconds a client gets to keep its 
+								  controller once someone is waiting for 
+								  one, if None then clients keep their 
+								  controller until they leave
+			udp_port (int): port clients can send the state of their keys 
+							to over UDP on instead of sending key presses 
+							over TCP, if None then clients can only use TCP
+			heartbeat_period (float): seconds between heartbeats sent to 
+									  each client, if None then clients 
+									  aren't sent heartbeats and keep their
+									  controller until their connection 
+									  closes
+			heartbeat_timeout (float): seconds a client that echoes 
+									   heartbeats can go without sending 
+									   anything before it loses its 
+									   controller
+			metrics_port (int): port to serve metrics in the prometheus 
+								text format on, only to this computer. If 
+								None then metrics aren't served
+			hub_process (bool): if True and hub is None then the hub talks 
+								to the arduino from a process of its own 
+								(see Hub_Process)
 		RETURNS: new instance of a Rokenbok_Server
-		NOTES:
+		NOTES: every client is handled on one asyncio event loop running in
+			   a seperate thread
 		"""
 		#Save arguments
 		self.ip = str(ip)
 		self.port = int(port)
+		self.spectator_port = None if spectator_port is None else int(spectator_port)
+		self.spectator_period = 1.0 / float(spectator_fps)
+		self.max_waiting = int(max_waiting)
+		self.session_time = None if session_time is None else float(session_time)
+		self.udp_port = None if udp_port is None else int(udp_port)
+		self.heartbeat_period = None if heartbeat_period is None else float(heartbeat_period)
+		self.heartbeat_timeout = float(heartbeat_timeout)
+		self.metrics_port = None if metrics_port is None else int(metrics_port)
 
 		#Create hub
-		self.rh = Rokenbok_Hub()
-		
+		if hub:
+			self.rh = hub
+		elif hub_process:
+			self.rh = Rokenbok_Hub_Process()
+		else:
+			self.rh = Rokenbok_Hub()
+
 		#Create controllers
 		self.avail_controllers = queue.LifoQueue()
 		for ii in range(8):
 			rc = Rokenbok_Controller(8 - ii, self.rh)
 			self.avail_controllers.put(rc)
-		
+
 		#Create listener socket
 		self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		self.listen_socket.bind((self.ip, self.port))
 		#Start listening for connections
 		self.listen_socket.listen(8)
 
-		#Create variables for handler threads
-		self.run_threads = threading.Event()
-		self.run_threads.set()
-		self.threads = [None] * 8
-		self.thread_times = [0] * 8
+		#Tasks handling each client, the stream and controller of each client
+		#and the selection each client was last told about, indexed by 
+		#player - 1
+		self.clients = [None] * 8
+		self.client_writers = [None] * 8
+		self.client_controllers = [None] * 8
+		self.client_sels = [None] * 8
+		self.client_versions = [1] * 8
 
-		#Thread for accepting connections
-		self.listen_thread = threading.Thread(target=self.accept_connections)
+		#Session token of each client mapped to its player - 1, and the ip 
+		#address and tracker of the key states of each client sent over UDP,
+		#indexed by player - 1
+		self.tokens = {}
+		self.client_addrs = [None] * 8
+		self.key_trackers = [None] * 8
+
+		#When we last heard from each client, whether each client is known 
+		#to echo heartbeats (only those can time out, older clients that 
+		#never echo keep their controller until they leave), whether each 
+		#client was ended for not being heard from, when each heartbeat sent
+		#to each client was sent (indexed by the heartbeat's id) and the most
+		#recent heartbeat round trip times of each client, indexed by 
+		#player - 1
+		self.last_heard = [None] * 8
+		self.echoes = [False] * 8
+		self.timed_out = [False] * 8
+		self.heartbeat_times = [None] * 8
+		self.heartbeat_rtts = [collections.deque(maxlen=RTT_HISTORY) for ii in range(8)]
+		self.heartbeat_id = 0
+
+		#Number of key presses and releases from each client and a histogram
+		#of the heartbeat round trip times of each client, indexed by 
+		#player - 1. Unlike the above these cover every session
+		self.client_events = [0] * 8
+		self.rtt_histograms = [Histogram(RTT_BUCKETS) for ii in range(8)]
+
+		#Clients waiting in line for a controller, each is a list of a future
+		#that gets the controller, the stream to send to the client on and
+		#the task handling the client. Timers ending each client's session, 
+		#whether each client has used up its session time and whether each 
+		#client's session is being ended, indexed by player - 1
+		self.waiting = collections.deque()
+		self.session_timers = [None] * 8
+		self.overtime = [False] * 8
+		self.ending = [False] * 8
+
+		#Set while updates are waiting to be pushed to the clients, so any 
+		#number of changes to the hub only push one round of updates
+		self.push_pending = False
+
+		#Stream of each spectator mapped to the last state sent to it, the 
+		#tasks handling each spectator and how many states were skipped 
+		#because a spectator wasn't keeping up
+		self.spectators = {}
+		self.spectator_tasks = set()
+		self.spectator_drops = 0
+
+		#Set whenever the state of the controllers or the hub might have 
+		#changed, so states are only built for spectators when they have
+		self.state_dirty = asyncio.Event()
+
+		#Event loop for accepting connections and handling clients
+		self.loop = asyncio.new_event_loop()
+		self.listen_socket.setblocking(False)
+		self.server = self.loop.run_until_complete(asyncio.start_server(self.handle_connection, sock=self.listen_socket))
+		self.spectator_server = None
+		if self.spectator_port is not None:
+			self.spectator_server = self.loop.run_until_complete(asyncio.start_server(self.handle_spectator, self.ip, self.spectator_port, reuse_address=True))
+		self.udp_transport = None
+		if self.udp_port is not None:
+			self.udp_transport, protocol = self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: Key_State_Protocol(self), local_addr=(self.ip, self.udp_port)))
+		self.metrics_server = None
+		if self.metrics_port is not None:
+			self.metrics_server = self.loop.run_until_complete(asyncio.start_server(self.handle_metrics, '127.0.0.1', self.metrics_port, reuse_address=True))
+		self.listen_thread = threading.Thread(target=self.run_loop)
 		self.listen_thread.start()
 
+		#Push updates to clients whenever the hub changes
+		self.rh.add_state_cb(self.hub_changed)
+
 		print("Starting server at ip %s on port %d..." % (self.ip, self.port))
 
 	############################################################################
@@ -72,122 +231,627 @@ class Rokenbok_Server:
 			self.stop()
 
 	############################################################################
-	def sock_send(self, sock, msg):
+	def run_loop(self):
 		"""
-		PURPOSE: sends an entire fixed length message
-		ARGS:
-			sock (socket): socket to send on
-			msg (bytes): message to send
+		PURPOSE: runs the event loop until the server is stopped
+		ARGS: none
 		RETURNS: none
-		NOTES: raises a RuntimeError if socket connection breaks
+		NOTES: should be run in a seperate thread
 		"""
-		bytes_sent = 0
-		while bytes_sent < MSG_LEN:
-			sent = sock.send(msg[bytes_sent:])
-			if sent == 0:
-				raise RuntimeError("Socket broken")
-			bytes_sent += sent
+		asyncio.set_event_loop(self.loop)
+		try:
+			self.loop.run_until_complete(self.accept_connections())
+		finally:
+			self.loop.close()
 
 	############################################################################
-	def sock_recv(self, sock):
+	def hub_changed(self):
 		"""
-		PURPOSE: receives an entire fixed length message
-		ARGS:
-			sock (socket): socket to receive on
-		RETURNS (bytes): array of bytes representing message
-		NOTES: riases a RuntimeError is socket conneciton breaks
+		PURPOSE: schedules updates to the clients when the hub changes
+		ARGS: none
+		RETURNS: none
+		NOTES: called from the thread reading from the arduino
 		"""
-		chunks = bytes()
-		bytes_recvd = 0
-		while bytes_recvd < MSG_LEN:
-			chunk = sock.recv(MSG_LEN)
-			if chunk == b'':
-				raise RuntimeError("Socket broken")
-			chunks += chunk
-			bytes_recvd += len(chunk)
-		return chunks
+		if self.push_pending:
+			return
+		self.push_pending = True
+		try:
+			self.loop.call_soon_threadsafe(self.push_updates)
+		except RuntimeError as e:
+			#Event loop has been closed
+			pass
 
 	############################################################################
-	def handle_client(self, conn, addr, rc):
+	def push_updates(self):
+		"""
+		PURPOSE: tells each client its selection if it changed since the last
+				 time we told it
+		ARGS: none
+		RETURNS: none
+		NOTES: runs on the event loop. Clients that aren't keeping up are 
+			   skipped and get the latest selection on a later update
+		"""
+		self.push_pending = False
+		self.state_dirty.set()
+		for idx in range(8):
+			writer = self.client_writers[idx]
+			if writer is None or writer.is_closing():
+				continue
+			sel = self.client_controllers[idx].get_sel()
+			if sel == self.client_sels[idx]:
+				continue
+			if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+				continue
+			writer.write(encode_msg(self.client_versions[idx], Message_Type.TRUE_SEL, bytes([sel])))
+			self.client_sels[idx] = sel
+
+	############################################################################
+	async def handle_client(self, reader, writer, addr, rc):
 		"""
 		PURPOSE: handles a client who gets a controller
 		ARGS:
-			conn (socket): the socket to communicate to the client on
+			reader (asyncio.StreamReader): stream to receive from the client on
+			writer (asyncio.StreamWriter): stream to send to the client on
 			addr (str): the ip address of the client
 			rc (Rokenbok_Controller): the controller the client gets
 		RETURNS: none
-		NOTES: should be run in a seperate thread
+		NOTES: every message that has arrived is read at once and their key 
+			   events are passed on to the hub together, the client is told 
+			   about changes to its selection by push_updates and is ended by 
+			   send_heartbeats if we stop hearing from it
 		"""
 		my_idx = rc.player - 1
-		conn_alive = True
+		self.client_versions[my_idx] = 1
+		self.client_controllers[my_idx] = rc
+		self.client_sels[my_idx] = None
+		self.client_writers[my_idx] = writer
+		self.client_addrs[my_idx] = addr
+		self.key_trackers[my_idx] = Key_State_Tracker()
+		self.last_heard[my_idx] = self.loop.time()
+		self.echoes[my_idx] = False
+		self.timed_out[my_idx] = False
+		self.heartbeat_times[my_idx] = [None] * 256
+		self.heartbeat_rtts[my_idx].clear()
+		self.push_updates()
+		self.overtime[my_idx] = False
+		if self.session_time is not None:
+			self.session_timers[my_idx] = self.loop.call_later(self.session_time, self.session_over, my_idx)
 
 		#Send and receive to and from client
-		while conn_alive and self.run_threads.is_set():
-			try:
-				#Handle message from client
-				msg = self.sock_recv(conn)
-				if msg[0] == Message_Type.KEY_PRESS.value:
-					#Handle key press
-					if msg[2]:
-						rc.press_key(msg[1])
-					else:
-						rc.release_key(msg[1])
-				elif msg[0] == Message_Type.END.value:
-					#Handle end of connection
-					self.sock_send(conn, bytes([Message_Type.END.value, 0, 0]))
-					conn_alive = False
-				#Send update to client if needed
-				cur_time = time.time()
-				if (cur_time - self.thread_times[my_idx]) > UPDATE_TIME:
-					msg = bytes([Message_Type.TRUE_SEL.value, rc.get_sel(), 0])
-					self.sock_send(conn, msg)
-					self.thread_times[my_idx] = cur_time
-			except Exception as e:
-				conn_alive = False
-				print("Exception in %s" % addr)
-				print(e)
-			time.sleep(0.01)
+		try:
+			done = False
+			pending = bytearray()
+			while not done:
+				#Read everything the client has sent so far and handle every
+				#whole message in it, the rest waits for the next read. The
+				#key events of all of them go to the hub at once
+				data = await reader.read(RECV_SIZE)
+				if not data:
+					raise asyncio.IncompleteReadError(bytes(pending), None)
+				pending += data
+				self.last_heard[my_idx] = self.loop.time()
+				events = []
+				idx = 0
+				while not done:
+					msg = read_records(pending, idx, self.client_versions[my_idx])
+					if msg is None:
+						break
+					records, idx = msg
+					for msg_type, data in records:
+						if msg_type == Message_Type.KEY_PRESS.value:
+							if self.client_versions[my_idx] >= 2:
+								events += key_events(data)
+							else:
+								events.append((data[0], data[1]))
+						elif msg_type == Message_Type.HEARTBEAT.value and data:
+							#Client echoed a heartbeat
+							self.echoes[my_idx] = True
+							sent_time = self.heartbeat_times[my_idx][data[0]]
+							if sent_time is not None:
+								self.heartbeat_times[my_idx][data[0]] = None
+								rtt = self.last_heard[my_idx] - sent_time
+								self.heartbeat_rtts[my_idx].append(rtt)
+								self.rtt_histograms[my_idx].observe(rtt)
+						elif msg_type == Message_Type.VERSION.value and data:
+							#Answer in the version we are speaking now, then
+							#switch to the one we agreed on
+							version = max(1, min(data[0], PROTOCOL_VERSION))
+							writer.write(encode_msg(self.client_versions[my_idx], Message_Type.VERSION, bytes([version])))
+							self.client_versions[my_idx] = version
+							if version >= 2:
+								#Every client speaking version 2 echoes 
+								#heartbeats
+								self.echoes[my_idx] = True
+						elif msg_type == Message_Type.END.value:
+							#Handle end of connection
+							done = True
+							break
+				del pending[:idx]
+				if events:
+					self.apply_client_keys(my_idx, events)
+		except asyncio.CancelledError as e:
+			#Server is shutting down
+			pass
+		except Exception as e:
+			print("Exception in %s" % addr)
+			print(e)
 
 		#Connection is no longer alive
+		self.client_writers[my_idx] = None
+		self.client_addrs[my_idx] = None
+		self.key_trackers[my_idx] = None
+		for token, idx in list(self.tokens.items()):
+			if idx == my_idx:
+				del self.tokens[token]
+		if self.session_timers[my_idx]:
+			self.session_timers[my_idx].cancel()
+			self.session_timers[my_idx] = None
 		try:
-			self.sock_send(conn, bytes([Message_Type.END.value, 0, 0]))
+			if self.timed_out[my_idx]:
+				#Don't wait on a client that isn't there
+				writer.transport.abort()
+			else:
+				writer.write(encode_msg(self.client_versions[my_idx], Message_Type.END))
+				writer.close()
+				await writer.wait_closed()
 		except:
 			pass
-		conn.close()
 		rc.release_all_and_deselect()
-		self.avail_controllers.put(rc)
+		self.state_dirty.set()
+		self.clients[my_idx] = None
+		self.ending[my_idx] = False
+		self.release_controller(rc)
 		print("Closing connection %s" % addr)
-		#Kill thread
-		sys.exit()
 
 	############################################################################
-	def accept_connections(self):
+	async def handle_connection(self, reader, writer):
 		"""
-		PURPOSE: waits for and accepts connections
+		PURPOSE: gives a new connection a controller if one is available
+		ARGS:
+			reader (asyncio.StreamReader): stream to receive from the client on
+			writer (asyncio.StreamWriter): stream to send to the client on
+		RETURNS: none
+		NOTES: called by the event loop for each new connection
+		"""
+		addr = writer.get_extra_info('peername')[0]
+		sock = writer.get_extra_info('socket')
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		print("Got connection from %s" % addr)
+		if self.avail_controllers.empty():
+			rc = await self.wait_for_controller(reader, writer, addr)
+			if rc is None:
+				return
+		else:
+			rc = self.avail_controllers.get()
+		idx = rc.player - 1
+		self.clients[idx] = asyncio.current_task()
+		token = self.new_token(idx)
+		writer.write(bytes([Message_Type.START.value, token >> 8, token & 0xFF]))
+		await self.handle_client(reader, writer, addr, rc)
+
+	############################################################################
+	def new_token(self, idx):
+		"""
+		PURPOSE: makes a session token for a client to send key states over 
+				 UDP with
+		ARGS:
+			idx (int): player - 1 of the client
+		RETURNS: (int) the token, or 0 if clients can't use UDP
+		NOTES: runs on the event loop. Tokens are never 0 and never shared by
+			   two clients
+		"""
+		if self.udp_transport is None:
+			return 0
+		token = 0
+		while token == 0 or token in self.tokens:
+			token = random.getrandbits(16)
+		self.tokens[token] = idx
+		return token
+
+	############################################################################
+	def key_state_received(self, data, addr):
+		"""
+		PURPOSE: presses and releases the keys that changed in a key state 
+				 a client sent over UDP
+		ARGS:
+			data (bytes): the packet
+			addr (tuple): ip address and port the packet came from
+		RETURNS: none
+		NOTES: runs on the event loop. Packets that are older than the last 
+			   one applied, or that don't come from the client the token 
+			   belongs to, are dropped
+		"""
+		packet = unpack_key_state(data)
+		if packet is None:
+			return
+		token, seq, keys = packet
+		idx = self.tokens.get(token)
+		if idx is None or self.client_addrs[idx] != addr[0]:
+			return
+		changes = self.key_trackers[idx].update(seq, keys)
+		if not changes:
+			return
+		self.apply_client_keys(idx, changes)
+
+	############################################################################
+	def apply_client_keys(self, idx, events):
+		"""
+		PURPOSE: passes key events from a client on to the hub
+		ARGS:
+			idx (int): index of the client (player - 1)
+			events (list): a (ascii code, pressed) tuple for each key event
+		RETURNS: none
+		NOTES: runs on the event loop. If the selection we want for the 
+			   client changes it is told right away, instead of waiting for
+			   the arduino to report it back (which some firmware never 
+			   does)
+		"""
+		des_sel = self.rh.get_sels()[1][idx]
+		self.client_events[idx] += len(events)
+		self.client_controllers[idx].apply_keys(events)
+		self.state_dirty.set()
+		if self.rh.get_sels()[1][idx] != des_sel:
+			self.push_updates()
+
+	############################################################################
+	async def wait_for_controller(self, reader, writer, addr):
+		"""
+		PURPOSE: puts a client in line for a controller
+		ARGS:
+			reader (asyncio.StreamReader): stream to receive from the client on
+			writer (asyncio.StreamWriter): stream to send to the client on
+			addr (str): the ip address of the client
+		RETURNS: (Rokenbok_Controller) the controller the client gets, or None
+				 if the client left or the line is full
+		NOTES: the client is told its place in line whenever it changes.
+			   Anything it sends while waiting is ignored, except END
+		"""
+		if len(self.waiting) >= self.max_waiting:
+			print("No available controllers. Closing connection %s" % addr)
+			writer.write(bytes([Message_Type.FULL.value, 0, 0]))
+			writer.close()
+			return None
+
+		got_controller = self.loop.create_future()
+		entry = [got_controller, writer, asyncio.current_task()]
+		self.waiting.append(entry)
+		print("No available controllers. %s is number %d in line" % (addr, len(self.waiting)))
+		writer.write(bytes([Message_Type.WAIT.value, min(len(self.waiting), 255), 0]))
+		self.end_overtime()
+
+		read = None
+		shutting_down = False
+		try:
+			while not got_controller.done():
+				read = asyncio.ensure_future(reader.readexactly(MSG_LEN))
+				await asyncio.wait((got_controller, read), return_when=asyncio.FIRST_COMPLETED)
+				if not read.done():
+					continue
+				if read.result()[0] == Message_Type.END.value:
+					break
+		except asyncio.CancelledError as e:
+			#Server is shutting down
+			shutting_down = True
+		except Exception as e:
+			#Client left
+			pass
+
+		#Stop reading before anything else reads from the client
+		if read and not read.done():
+			read.cancel()
+			try:
+				await read
+			except BaseException as e:
+				pass
+		if got_controller.done() and not shutting_down:
+			return got_controller.result()
+
+		#Client is leaving the line, pass on the controller if it got one
+		if got_controller.done():
+			self.release_controller(got_controller.result())
+		got_controller.cancel()
+		if entry in self.waiting:
+			self.waiting.remove(entry)
+			self.update_waiting()
+		try:
+			writer.write(bytes([Message_Type.END.value, 0, 0]))
+			writer.close()
+			await writer.wait_closed()
+		except:
+			pass
+		print("%s left the line" % addr)
+		return None
+
+	############################################################################
+	def release_controller(self, rc):
+		"""
+		PURPOSE: gives a controller to the next client in line, or makes it 
+				 available if no one is waiting
+		ARGS:
+			rc (Rokenbok_Controller): the controller
+		RETURNS: none
+		NOTES: runs on the event loop
+		"""
+		while self.waiting:
+			got_controller = self.waiting.popleft()[0]
+			if not got_controller.done():
+				got_controller.set_result(rc)
+				self.update_waiting()
+				return
+		self.avail_controllers.put(rc)
+
+	############################################################################
+	def update_waiting(self):
+		"""
+		PURPOSE: tells every client in line its place in line
 		ARGS: none
 		RETURNS: none
-		NOTES: runs in an infinite loop, may want to wrap in try catch and 
-			   catch keyboard interrupt to kill it
+		NOTES: runs on the event loop
+		"""
+		for pos, (got_controller, writer, task) in enumerate(self.waiting, 1):
+			if writer.is_closing() or writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+				continue
+			writer.write(bytes([Message_Type.WAIT.value, min(pos, 255), 0]))
+
+	############################################################################
+	def session_over(self, idx):
+		"""
+		PURPOSE: ends a client's session if someone is waiting for a 
+				 controller
+		ARGS:
+			idx (int): player - 1 of the client
+		RETURNS: none
+		NOTES: runs on the event loop. If no one is waiting the client keeps
+			   its controller until someone is
+		"""
+		self.session_timers[idx] = None
+		self.overtime[idx] = True
+		self.end_overtime()
+
+	############################################################################
+	def end_overtime(self):
+		"""
+		PURPOSE: ends the session of a client that has used up its session 
+				 time so its controller goes to the next client in line
+		ARGS: none
+		RETURNS: none
+		NOTES: runs on the event loop. Only ends a session if there are more 
+			   clients waiting than sessions already being ended
+		"""
+		if len(self.waiting) <= sum(self.ending):
+			return
+		for idx in range(8):
+			if self.overtime[idx] and self.clients[idx]:
+				print("Session over for player %d" % (idx + 1))
+				self.overtime[idx] = False
+				self.ending[idx] = True
+				self.clients[idx].cancel()
+				return
+
+	############################################################################
+	async def send_heartbeats(self):
+		"""
+		PURPOSE: sends heartbeats to the clients and ends any client we 
+				 haven't heard from in time
+		ARGS: none
+		RETURNS: none
+		NOTES: runs until the server is stopped. Clients echo each heartbeat
+			   back so we always hear from a client that is still there, 
+			   one that isn't loses its controller within heartbeat_timeout
+			   plus heartbeat_period seconds. Clients that have never echoed
+			   a heartbeat or agreed on protocol version 2 are older ones 
+			   that don't echo, so they never time out
 		"""
-		print("Listening for connecitons...")
 		while True:
-			try:
-				conn, addr = self.listen_socket.accept()
-				addr = addr[0]
-			except:
-				break
-			print("Got connection from %s" % addr)
-			if self.avail_controllers.empty():
-				print("No available controllers. Closing connection %s" % addr)
-				self.sock_send(conn, bytes([Message_Type.FULL.value, 0, 0]))
-				conn.close()
+			await asyncio.sleep(self.heartbeat_period)
+			now = self.loop.time()
+			self.heartbeat_id = (self.heartbeat_id + 1) % 256
+			for idx in range(8):
+				writer = self.client_writers[idx]
+				if writer is None or writer.is_closing():
+					continue
+				if self.echoes[idx] and now - self.last_heard[idx] > self.heartbeat_timeout:
+					if self.clients[idx] and not self.timed_out[idx]:
+						print("Player %d timed out" % (idx + 1))
+						self.timed_out[idx] = True
+						self.clients[idx].cancel()
+					continue
+				if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+					continue
+				self.heartbeat_times[idx][self.heartbeat_id] = now
+				writer.write(encode_msg(self.client_versions[idx], Message_Type.HEARTBEAT, bytes([self.heartbeat_id])))
+
+	############################################################################
+	def get_heartbeat_rtts(self):
+		"""
+		PURPOSE: gets the recent heartbeat round trip times of each client
+		ARGS: none
+		RETURNS: (list) a list of round trip times in seconds for each 
+				 player, oldest first, indexed by player - 1
+		NOTES: only the last RTT_HISTORY round trips of each client's 
+			   current session are kept
+		"""
+		return [list(rtts) for rtts in self.heartbeat_rtts]
+
+	############################################################################
+	async def handle_metrics(self, reader, writer):
+		"""
+		PURPOSE: answers a HTTP request for our metrics
+		ARGS:
+			reader (asyncio.StreamReader): stream to receive the request on
+			writer (asyncio.StreamWriter): stream to send the metrics on
+		RETURNS: none
+		NOTES: called by the event loop for each new connection, serves one
+			   request and closes the connection
+		"""
+		try:
+			request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+			path = request.split(b' ')[1] if request.count(b' ') >= 2 else b''
+			if path in (b'/', b'/metrics'):
+				status = '200 OK'
+				body = self.render_metrics().encode()
 			else:
-				rc = self.avail_controllers.get()
-				idx = rc.player - 1
-				client = threading.Thread(target=self.handle_client, args=(conn, addr, rc))
-				self.threads[idx] = client
-				self.sock_send(conn, bytes([Message_Type.START.value, 0, 0]))
-				client.start()
+				status = '404 Not Found'
+				body = b'Not found\n'
+			writer.write(('HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % (status, len(body))).encode() + body)
+			await writer.drain()
+		except asyncio.CancelledError as e:
+			#Server is shutting down
+			pass
+		except Exception as e:
+			pass
+		try:
+			writer.close()
+			await writer.wait_closed()
+		except:
+			pass
+
+	############################################################################
+	def render_metrics(self):
+		"""
+		PURPOSE: builds our metrics in the prometheus text format
+		ARGS: none
+		RETURNS: (str) the metrics
+		NOTES: runs on the event loop. Everything is collected as it happens
+			   with plain counters, this is the only place it gets formatted
+		"""
+		players = ['player="%d"' % (idx + 1) for idx in range(8)]
+		stats = self.rh.get_stats()
+		lines = []
+		lines += format_metric('rokenbok_clients_connected', 'gauge', 'Clients with a controller', [('', sum(1 for writer in self.client_writers if writer))])
+		lines += format_metric('rokenbok_clients_waiting', 'gauge', 'Clients waiting in line for a controller', [('', len(self.waiting))])
+		lines += format_metric('rokenbok_spectators', 'gauge', 'Connected spectators', [('', len(self.spectators))])
+		lines += format_metric('rokenbok_spectator_drops_total', 'counter', 'States skipped because a spectator was not keeping up', [('', self.spectator_drops)])
+		lines += format_metric('rokenbok_controllers_in_use', 'gauge', 'Controllers given out to clients', [('', 8 - self.avail_controllers.qsize())])
+		lines += format_metric('rokenbok_controllers', 'gauge', 'Controllers in the pool', [('', 8)])
+		lines += format_metric('rokenbok_client_events_total', 'counter', 'Key presses and releases received from each player', list(zip(players, self.client_events)))
+		lines += format_metric('rokenbok_heartbeat_rtt_seconds', 'histogram', 'Heartbeat round trip time of each player', list(zip(players, self.rtt_histograms)))
+		lines += format_metric('rokenbok_hub_tx_frames_total', 'counter', 'Frames sent to the arduino', [('', stats['tx_frames'])])
+		lines += format_metric('rokenbok_hub_tx_bytes_total', 'counter', 'Bytes sent to the arduino', [('', stats['tx_bytes'])])
+		lines += format_metric('rokenbok_hub_rx_frames_total', 'counter', 'Frames received from the arduino', [('', stats['frames'])])
+		lines += format_metric('rokenbok_hub_rx_fps', 'gauge', 'Frames per second received from the arduino', [('', stats['fps'])])
+		lines += format_metric('rokenbok_hub_parse_errors_total', 'counter', 'Garbage or invalid frames from the arduino', [('', stats['parse_errors'])])
+		lines += format_metric('rokenbok_hub_naks_total', 'counter', 'Frames the arduino rejected', [('', stats['naks'])])
+		lines += format_metric('rokenbok_hub_retransmits_total', 'counter', 'Keyframes sent to resync the arduino', [('', stats['retransmits'])])
+		lines += format_metric('rokenbok_hub_write_seconds', 'histogram', 'Time taken to write each frame to the arduino', [('', stats['write_latency'])])
+		locks = sorted(stats['locks'].items())
+		lines += format_metric('rokenbok_hub_lock_acquisitions_total', 'counter', 'Times each hub lock was acquired', [('lock="%s"' % name, lock[0]) for name, lock in locks])
+		lines += format_metric('rokenbok_hub_lock_wait_seconds_total', 'counter', 'Time spent waiting for each hub lock', [('lock="%s"' % name, lock[1]) for name, lock in locks])
+		lines += format_metric('rokenbok_hub_lock_hold_seconds_total', 'counter', 'Time each hub lock was held', [('lock="%s"' % name, lock[2]) for name, lock in locks])
+		return '\n'.join(lines) + '\n'
+
+	############################################################################
+	async def handle_spectator(self, reader, writer):
+		"""
+		PURPOSE: handles a spectator
+		ARGS:
+			reader (asyncio.StreamReader): stream to receive from the 
+										   spectator on
+			writer (asyncio.StreamWriter): stream to send to the spectator on
+		RETURNS: none
+		NOTES: called by the event loop for each new spectator. Spectators 
+			   are sent states by broadcast_state and anything they send is
+			   ignored
+		"""
+		addr = writer.get_extra_info('peername')[0]
+		sock = writer.get_extra_info('socket')
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		print("Got spectator from %s" % addr)
+		self.spectators[writer] = None
+		self.state_dirty.set()
+		self.spectator_tasks.add(asyncio.current_task())
+		try:
+			while await reader.read(1024):
+				pass
+		except asyncio.CancelledError as e:
+			#Server is shutting down
+			pass
+		except Exception as e:
+			pass
+
+		del self.spectators[writer]
+		self.spectator_tasks.discard(asyncio.current_task())
+		try:
+			writer.write(bytes([Message_Type.END.value]) + bytes(SPECTATE_MSG_LEN - 1))
+			writer.close()
+			await writer.wait_closed()
+		except:
+			pass
+		print("Closing spectator %s" % addr)
+
+	############################################################################
+	async def broadcast_state(self):
+		"""
+		PURPOSE: sends the state of every controller to the spectators
+		ARGS: none
+		RETURNS: none
+		NOTES: runs until the server is stopped. Waits for something to 
+			   change instead of checking every period, but sends at most one
+			   state per period. The state is only built once for all the 
+			   spectators, and only sent to a spectator if it changed since 
+			   the last one it was sent. A spectator that still
+			   has a state waiting to be sent is skipped so states are 
+			   dropped instead of piling up
+		"""
+		while True:
+			await self.state_dirty.wait()
+			self.state_dirty.clear()
+			if not self.spectators:
+				continue
+
+			des_state, cur_state = self.rh.get_state()
+			if cur_state is None:
+				msg = bytes([Message_Type.STATE.value, 0]) + des_state + bytes(len(des_state))
+			else:
+				msg = bytes([Message_Type.STATE.value, 1]) + des_state + cur_state
+			for writer, last_msg in list(self.spectators.items()):
+				if msg == last_msg or writer.is_closing():
+					continue
+				if writer.transport.get_write_buffer_size():
+					#Try again next period
+					self.spectator_drops += 1
+					self.state_dirty.set()
+					continue
+				writer.write(msg)
+				self.spectators[writer] = msg
+			await asyncio.sleep(self.spectator_period)
+
+	############################################################################
+	async def accept_connections(self):
+		"""
+		PURPOSE: waits for and accepts connections
+		ARGS: none
+		RETURNS: none
+		NOTES: runs until the server is stopped
+		"""
+		print("Listening for connecitons...")
+		broadcast = None
+		if self.spectator_server:
+			broadcast = asyncio.ensure_future(self.broadcast_state())
+		heartbeats = None
+		if self.heartbeat_period is not None:
+			heartbeats = asyncio.ensure_future(self.send_heartbeats())
+		try:
+			await self.server.serve_forever()
+		except asyncio.CancelledError as e:
+			pass
+
+		#Let every client and spectator know we are shutting down
+		if heartbeats:
+			heartbeats.cancel()
+		if self.metrics_server:
+			self.metrics_server.close()
+		if self.udp_transport:
+			self.udp_transport.close()
+		if self.spectator_server:
+			self.spectator_server.close()
+			broadcast.cancel()
+		clients = [client for client in self.clients if client]
+		clients += list(self.spectator_tasks)
+		clients += [task for got_controller, writer, task in self.waiting]
+		for client in clients:
+			client.cancel()
+		await asyncio.gather(*clients, return_exceptions=True)
 
 	############################################################################
 	def stop(self):
@@ -198,17 +862,16 @@ class Rokenbok_Server:
 		NOTES:
 		"""
 		print("Shutting down")
-		self.run_threads.clear()
-		#Wait for threads to die
-		time.sleep(0.2)
-		#Close listening socket
-		self.listen_socket.close()
-		#Stop hub
-		self.rh.stop()
-		#Join listen thread
+		self.rh.remove_state_cb(self.hub_changed)
 		if self.listen_thread:
+			#Stop accepting connections, which closes the listening socket 
+			#and ends every client
+			self.loop.call_soon_threadsafe(self.server.close)
+			#Join listen thread
 			self.listen_thread.join()
 			self.listen_thread = None
+		#Stop hub
+		self.rh.stop()
 
 	############################################################################
 
@@ -0,0 +1,250 @@
+#ifndef FRAME_PARSER_H
+#define FRAME_PARSER_H
+
+//Parses the bytes the host pc sends us one byte at a
+//time. Kept free of anything arduino specific so it can
+//be compiled and tested on the host pc (see harness/).
+//Hub_Protocol.Frame_Decoder is the python version of
+//this parser and the two must stay the same.
+//
+//Protocol version 1 frames are 2 sync bytes followed by
+//all 19 bytes of state. Version 2 frames are 2 sync
+//bytes, a 3 byte bitmap of which state bytes changed
+//(bit n of the bitmap is state byte n, least significant
+//byte first) and then the value of each changed byte in
+//order. Version 3 frames are like version 2 frames with
+//a sequence number between the sync bytes and the bitmap
+//and a CRC-8 of the sequence number, bitmap and values at
+//the end. A version 3 frame is only applied if its CRC is
+//good and either it follows the last frame we applied or
+//it is a keyframe (every state byte changed), otherwise
+//we NAK it and the host pc resyncs us with a keyframe.
+//Control messages are 2 control sync bytes, a command
+//byte and for some commands one argument byte.
+
+#include <stdint.h>
+#include <string.h>
+
+#define FP_SYNC_BYTE 0xAA
+#define FP_CTRL_SYNC_BYTE 0x55
+#define FP_STATE_LEN 19
+#define FP_BITMAP_LEN 3
+#define FP_SEL_IDX 11
+#define FP_NO_SEL 0xFF
+#define FP_MAX_VERSION 3
+#define FP_CRC_POLY 0x07
+
+//Control commands
+#define FP_CTRL_HELLO 'H'
+#define FP_CTRL_PROBE '?'
+#define FP_CTRL_VERSION 'V'
+#define FP_CTRL_NAK 'N'
+#define FP_CTRL_BAUD 'B'
+
+//What feeding a byte produced
+enum FP_EVENT {
+  FP_NONE = 0,  //need more bytes
+  FP_FRAME,     //a frame was applied to state
+  FP_CTRL,      //a control message is in cmd and arg
+  FP_ERROR,     //a bad frame was thrown away
+  FP_NAK        //a version 3 frame was rejected
+};
+
+//Where we are in a frame
+enum FP_MODE {
+  FP_HUNT = 0,  //looking for sync bytes
+  FP_CTRL_ARG,  //waiting for a control argument
+  FP_BODY,      //reading a version 1 frame
+  FP_SEQ,       //reading a version 3 sequence number
+  FP_BITMAP,    //reading a version 2 or 3 bitmap
+  FP_DELTA,     //reading version 2 or 3 values
+  FP_CRC        //reading a version 3 CRC
+};
+
+struct Frame_Parser {
+  uint8_t version;
+  uint8_t mode;
+  uint8_t sync_count;
+  uint8_t ctrl_count;
+  uint8_t idx;
+  uint8_t need;
+  uint8_t bitmap[FP_BITMAP_LEN];
+  uint8_t buf[FP_STATE_LEN];
+  uint8_t state[FP_STATE_LEN];
+  uint8_t cmd;
+  uint8_t arg;
+  uint8_t seq;          //sequence number of the frame
+  uint8_t expected_seq; //sequence number we want next
+  uint8_t crc;          //CRC of the frame so far
+  uint8_t synced;       //0 until we apply a keyframe
+};
+
+static inline void fp_init(struct Frame_Parser *p)
+{
+  memset(p, 0, sizeof(*p));
+  p->version = 1;
+  memset(p->state + FP_SEL_IDX, FP_NO_SEL, FP_STATE_LEN - FP_SEL_IDX);
+}
+
+//Switches protocol versions, a version 3 parser needs a
+//keyframe before it will apply anything
+static inline void fp_set_version(struct Frame_Parser *p, uint8_t version)
+{
+  if (version >= 1 && version <= FP_MAX_VERSION) {
+    p->version = version;
+    p->synced = 0;
+  }
+}
+
+static inline uint8_t fp_crc8(uint8_t crc, uint8_t b)
+{
+  crc ^= b;
+  for (uint8_t ii = 0; ii < 8; ii++) {
+    crc = (crc & 0x80) ? (uint8_t)((crc << 1) ^ FP_CRC_POLY) : (uint8_t)(crc << 1);
+  }
+  return crc;
+}
+
+static inline uint8_t fp_bit(const uint8_t *bitmap, uint8_t n)
+{
+  return (bitmap[n >> 3] >> (n & 7)) & 1;
+}
+
+static inline uint8_t fp_needs_arg(uint8_t cmd)
+{
+  return cmd == FP_CTRL_VERSION || cmd == FP_CTRL_BAUD;
+}
+
+//Copies the changed values in buf into state
+static inline void fp_apply_delta(struct Frame_Parser *p)
+{
+  uint8_t jj = 0;
+  for (uint8_t ii = 0; ii < FP_STATE_LEN; ii++) {
+    if (fp_bit(p->bitmap, ii)) {
+      p->state[ii] = p->buf[jj++];
+    }
+  }
+}
+
+//Checks a complete version 3 frame and applies it if we
+//can
+static inline enum FP_EVENT fp_finish_v3(struct Frame_Parser *p, uint8_t crc)
+{
+  p->mode = FP_HUNT;
+  if (crc != p->crc) {
+    return FP_NAK;
+  }
+  uint8_t keyframe = (p->need == FP_STATE_LEN);
+  if (!keyframe && (!p->synced || p->seq != p->expected_seq)) {
+    //We missed a frame so this delta doesn't apply to
+    //the state we have
+    return FP_NAK;
+  }
+  fp_apply_delta(p);
+  p->synced = 1;
+  p->expected_seq = p->seq + 1;
+  return FP_FRAME;
+}
+
+static inline enum FP_EVENT fp_feed(struct Frame_Parser *p, uint8_t b)
+{
+  switch (p->mode) {
+    case FP_HUNT:
+      if (p->ctrl_count == 2) {
+        p->ctrl_count = 0;
+        p->cmd = b;
+        if (fp_needs_arg(b)) {
+          p->mode = FP_CTRL_ARG;
+          return FP_NONE;
+        }
+        p->arg = 0;
+        return FP_CTRL;
+      } else if (b == FP_SYNC_BYTE) {
+        p->ctrl_count = 0;
+        if (++p->sync_count == 2) {
+          p->sync_count = 0;
+          p->idx = 0;
+          p->crc = 0;
+          if (p->version >= 3) {
+            p->mode = FP_SEQ;
+          } else if (p->version == 2) {
+            p->mode = FP_BITMAP;
+          } else {
+            p->mode = FP_BODY;
+          }
+        }
+      } else if (b == FP_CTRL_SYNC_BYTE) {
+        p->sync_count = 0;
+        p->ctrl_count++;
+      } else {
+        p->sync_count = 0;
+        p->ctrl_count = 0;
+      }
+      return FP_NONE;
+    case FP_CTRL_ARG:
+      p->arg = b;
+      p->mode = FP_HUNT;
+      return FP_CTRL;
+    case FP_BODY:
+      p->buf[p->idx++] = b;
+      if (p->idx < FP_STATE_LEN) {
+        return FP_NONE;
+      }
+      memcpy(p->state, p->buf, FP_STATE_LEN);
+      p->mode = FP_HUNT;
+      return FP_FRAME;
+    case FP_SEQ:
+      p->seq = b;
+      p->crc = fp_crc8(p->crc, b);
+      p->mode = FP_BITMAP;
+      return FP_NONE;
+    case FP_BITMAP:
+      p->bitmap[p->idx++] = b;
+      p->crc = fp_crc8(p->crc, b);
+      if (p->idx < FP_BITMAP_LEN) {
+        return FP_NONE;
+      }
+      //Only the low 3 bits of the last bitmap byte are
+      //used, anything else means we synced on data
+      if (p->bitmap[FP_BITMAP_LEN - 1] & 0xF8) {
+        p->mode = FP_HUNT;
+        return (p->version >= 3) ? FP_NAK : FP_ERROR;
+      }
+      p->need = 0;
+      for (uint8_t ii = 0; ii < FP_STATE_LEN; ii++) {
+        p->need += fp_bit(p->bitmap, ii);
+      }
+      p->idx = 0;
+      if (p->need == 0) {
+        //Nothing changed, the host pc is just checking in
+        if (p->version >= 3) {
+          p->mode = FP_CRC;
+          return FP_NONE;
+        }
+        p->mode = FP_HUNT;
+        return FP_FRAME;
+      }
+      p->mode = FP_DELTA;
+      return FP_NONE;
+    case FP_DELTA:
+      p->buf[p->idx++] = b;
+      p->crc = fp_crc8(p->crc, b);
+      if (p->idx < p->need) {
+        return FP_NONE;
+      }
+      if (p->version >= 3) {
+        p->mode = FP_CRC;
+        return FP_NONE;
+      }
+      fp_apply_delta(p);
+      p->mode = FP_HUNT;
+      return FP_FRAME;
+    case FP_CRC:
+      return fp_finish_v3(p, b);
+    default:
+      p->mode = FP_HUNT;
+      return FP_ERROR;
+  }
+}
+
+#endif
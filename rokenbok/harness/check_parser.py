@@ -0,0 +1,95 @@
+#Imports
+import os
+import random
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from Hub_Protocol import STATE_LEN, CTRL_VERSION, PROBE_MSG, BAUD_RATES, version_msg, baud_msg, Decode_Event, Frame_Encoder, Frame_Decoder
+
+################################################################################
+def make_stream(num_frames, seed):
+	"""
+	PURPOSE: builds a stream of bytes like the host pc would send, with
+			 version switches, keyframes, deltas, probes, baud rate changes, lost 
+			 frames and garbage mixed in
+	ARGS:
+		num_frames (int): number of frames to put in the stream
+		seed (int): seed for the random number generator
+	RETURNS: (bytes) the stream
+	NOTES:
+	"""
+	rng = random.Random(seed)
+	state = bytearray(STATE_LEN)
+	encoder = Frame_Encoder(1)
+	stream = bytearray()
+	for ii in range(num_frames):
+		roll = rng.random()
+		if roll < 0.05:
+			#Switch protocol versions, the next frame has to be a keyframe
+			version = rng.choice((1, 2, 3))
+			stream += version_msg(version)
+			encoder = Frame_Encoder(version)
+		elif roll < 0.08:
+			stream += rng.choice((PROBE_MSG, baud_msg(rng.randrange(len(BAUD_RATES)))))
+		elif roll < 0.11:
+			#Garbage, including bytes that look like sync bytes
+			stream += bytes(rng.choice((0xAA, 0x55, rng.randrange(256))) for jj in range(rng.randrange(1, 6)))
+			encoder.reset()
+		elif roll < 0.14:
+			#A frame that gets lost, the next delta should be NAKed
+			encoder.encode(state, False)
+
+		for jj in range(rng.randrange(4)):
+			state[rng.randrange(STATE_LEN)] = rng.choice((0x00, 0xFF, 0xAA, 0x55, rng.randrange(256)))
+		stream += encoder.encode(state, rng.random() < 0.1)
+	return bytes(stream)
+
+################################################################################
+def decode_python(stream):
+	"""
+	PURPOSE: runs a stream through the python version of the parser
+	ARGS:
+		stream (bytes): bytes to parse
+	RETURNS: (list) lines in the same format parser_harness prints
+	NOTES:
+	"""
+	decoder = Frame_Decoder()
+	lines = []
+	for byte in stream:
+		event = decoder.feed_byte(byte)
+		if event == Decode_Event.FRAME:
+			lines.append("F " + decoder.state.hex())
+		elif event == Decode_Event.CTRL:
+			if decoder.cmd == CTRL_VERSION:
+				decoder.set_version(decoder.arg)
+			lines.append("C %d %d" % (decoder.cmd, decoder.arg))
+		elif event == Decode_Event.ERROR:
+			lines.append("E")
+		elif event == Decode_Event.NAK:
+			lines.append("N %d" % decoder.expected_seq)
+	return lines
+
+################################################################################
+if __name__ == "__main__":
+	harness = sys.argv[1] if len(sys.argv) > 1 else './parser_harness'
+
+	failures = 0
+	for seed in range(20):
+		stream = make_stream(500, seed)
+		result = subprocess.run([harness], input=stream, stdout=subprocess.PIPE, check=True)
+		c_lines = result.stdout.decode().splitlines()
+		py_lines = decode_python(stream)
+		if c_lines != py_lines:
+			failures += 1
+			for idx, (c_line, py_line) in enumerate(zip(c_lines, py_lines)):
+				if c_line != py_line:
+					print("Seed %d differs at event %d: C '%s' python '%s'" % (seed, idx, c_line, py_line))
+					break
+			else:
+				print("Seed %d: C gave %d events, python gave %d" % (seed, len(c_lines), len(py_lines)))
+
+	if failures:
+		print("%d of 20 streams differ" % failures)
+		sys.exit(1)
+	print("C and python parsers agree on all 20 streams")
@@ -0,0 +1,49 @@
+//Feeds bytes from stdin through the same frame parser
+//the arduino runs and prints what it produced, one line
+//per event:
+//  F <state as hex>   a frame was applied
+//  C <cmd> <arg>      a control message (decimal)
+//  E                  a bad frame was thrown away
+//  N <expected seq>   a version 3 frame was rejected
+//VERSION control messages switch the parser's version
+//just like the firmware does. Build with 'make' and see
+//check_parser.py for comparing it against the python
+//version of the parser.
+
+#include <stdio.h>
+#include "../frame_parser.h"
+
+int main(void)
+{
+  struct Frame_Parser parser;
+  int c;
+
+  fp_init(&parser);
+  while ((c = getchar()) != EOF) {
+    switch (fp_feed(&parser, (uint8_t)c)) {
+      case FP_FRAME:
+        putchar('F');
+        putchar(' ');
+        for (int ii = 0; ii < FP_STATE_LEN; ii++) {
+          printf("%02x", parser.state[ii]);
+        }
+        putchar('\n');
+        break;
+      case FP_CTRL:
+        if (parser.cmd == FP_CTRL_VERSION) {
+          fp_set_version(&parser, parser.arg);
+        }
+        printf("C %d %d\n", parser.cmd, parser.arg);
+        break;
+      case FP_ERROR:
+        printf("E\n");
+        break;
+      case FP_NAK:
+        printf("N %d\n", parser.expected_seq);
+        break;
+      default:
+        break;
+    }
+  }
+  return 0;
+}
@@ -1,3 +1,5 @@
+#include "frame_parser.h"
+
 enum UPDATE_STATE {
   START = 0,
   BEGIN_SYNC,
@@ -32,7 +34,31 @@ enum UPDATE_STATE {
 };
 
 const byte slave_ready_pin = 7;
-const byte sync_byte = 0b10101010;
+const byte sync_byte = FP_SYNC_BYTE;
+
+//Control messages are two control sync bytes followed
+//by a command byte (see frame_parser.h). We announce
+//ourselves with HELLO and the highest protocol version
+//we speak when we boot and whenever the host pc sends
+//PROBE. The host pc picks the version with VERSION, we
+//always start out speaking version 1
+const byte ctrl_sync_byte = FP_CTRL_SYNC_BYTE;
+
+//The host pc can speed up the serial port with BAUD and
+//an index into baud_rates, we always boot at the first
+//one. Once the host pc has checked the new rate works it
+//sends the same BAUD again to keep it, if that doesn't
+//arrive within baud_confirm_ms we go back to the first
+//one
+const long baud_rates[] = {115200, 250000, 500000, 1000000};
+const byte num_baud_rates = sizeof(baud_rates) / sizeof(baud_rates[0]);
+const unsigned long baud_confirm_ms = 500;
+byte baud_idx = 0;
+byte baud_pending = 0;
+unsigned long baud_time = 0;
+
+//Parses frames from the host pc
+struct Frame_Parser parser;
 
 byte des_forward = 0; //1 to activate
 byte des_back = 0;    //1 to activate
@@ -47,27 +73,36 @@ byte des_sharing = 0; //1 to allow sharing
 byte des_priority = 0; //1 to allow sharing
 byte des_sel[8];
 
-byte cur_forward = 0;
-byte cur_back = 0;
-byte cur_left = 0;
-byte cur_right = 0;
-byte cur_a = 0;
-byte cur_b = 0;
-byte cur_x = 0;
-byte cur_y = 0;
-byte cur_slow = 0;
-byte cur_sharing = 0;
-byte cur_priority = 0;
-byte cur_sel[8];
+//Written by the SPI interrupt
+volatile byte cur_forward = 0;
+volatile byte cur_back = 0;
+volatile byte cur_left = 0;
+volatile byte cur_right = 0;
+volatile byte cur_a = 0;
+volatile byte cur_b = 0;
+volatile byte cur_x = 0;
+volatile byte cur_y = 0;
+volatile byte cur_slow = 0;
+volatile byte cur_sharing = 0;
+volatile byte cur_priority = 0;
+volatile byte cur_sel[8];
 
 UPDATE_STATE cur_state = START;
 
 byte handle_msg(byte rec_data);
+void send_state();
+void send_hello();
+void send_version();
+void send_nak();
+void send_baud(byte idx);
+void set_baud(byte idx);
+void handle_ctrl(byte cmd, byte arg);
+void set_desired();
 
 void setup()
 {
   //Used to communicate to host pc
-  Serial.begin(115200);
+  Serial.begin(baud_rates[0]);
   Serial.setTimeout(1000);
   pinMode(13, OUTPUT);
   digitalWrite(13, LOW);
@@ -76,6 +111,7 @@ void setup()
     des_sel[ii] = 0xFF;
     cur_sel[ii] = 0xFF;
   }
+  fp_init(&parser);
 
   //We are the slave in SPI
   pinMode(MISO, OUTPUT);
@@ -85,65 +121,187 @@ void setup()
   //Setup SPI
   SPCR |= _BV(SPE);   //turn on SPI in slave mode
   SPCR |= _BV(SPIE);  //turn on interrupts
+
+  //Let the host pc know we are ready for frames
+  send_hello();
 }
 
 void loop()
 {
-  //Wait to receive sync bytes
-  byte sync_count = 0;
-  while (sync_count < 2) {
-    if (Serial.available()) {
-      if (Serial.read() == sync_byte) {
-        sync_count++;
-      } else {
-        sync_count = 0;
-      }
+  //Handle every byte the host pc has sent us
+  while (Serial.available()) {
+    switch (fp_feed(&parser, Serial.read())) {
+      case FP_FRAME:
+        set_desired();
+        //Send a response with the actual state of the hub
+        //using the same layout as a version 1 frame so
+        //the host pc can tell if the hub is doing what it
+        //wants
+        send_state();
+        break;
+      case FP_CTRL:
+        handle_ctrl(parser.cmd, parser.arg);
+        break;
+      case FP_NAK:
+        //Ask the host pc to resync us with a keyframe
+        send_nak();
+        break;
+      default:
+        break;
     }
   }
-  
-  //Wait until serial buffer has all of the bytes
-  //we are expecting to read
-  while (Serial.available() < 19) {
-    //Do nothing
+
+  if (baud_pending && (millis() - baud_time) >= baud_confirm_ms) {
+    //The host pc never kept the new baud rate, go back
+    //to the one we booted at
+    set_baud(0);
+    baud_pending = 0;
   }
-  
-  //The serial buffer now has all the bytes we need to read
-  des_forward = Serial.read();
-  des_back = Serial.read();
-  des_left = Serial.read();
-  des_right = Serial.read();
-  des_a = Serial.read();
-  des_b = Serial.read();
-  des_x = Serial.read();
-  des_y = Serial.read();
-  des_slow = Serial.read();
-  des_sharing = Serial.read();
-  des_priority = Serial.read();
-  Serial.readBytes(des_sel, 8);
-  /*
-  //Send a response
-  //Send sync bytes (forward and backward most likely wont
-  //be pressed at the same time
-  Serial.write(sync_byte);
-  Serial.write(sync_byte);
-  //Send current state to host pc
-  Serial.write(cur_forward);
-  Serial.write(cur_back);
-  Serial.write(cur_left);
-  Serial.write(cur_right);
-  Serial.write(cur_a);
-  Serial.write(cur_b);
-  Serial.write(cur_x);
-  Serial.write(cur_y);
-  Serial.write(cur_slow);
-  Serial.write(cur_sharing);
-  Serial.write(cur_sel, 8);
-  */
+
   if (Serial.available() > 1000) {
     digitalWrite(13, HIGH);
   }
 }
 
+void set_desired()
+{
+  //Copy the new state with interrupts off so the hub
+  //never sees half of a frame
+  noInterrupts();
+  des_forward = parser.state[0];
+  des_back = parser.state[1];
+  des_left = parser.state[2];
+  des_right = parser.state[3];
+  des_a = parser.state[4];
+  des_b = parser.state[5];
+  des_x = parser.state[6];
+  des_y = parser.state[7];
+  des_slow = parser.state[8];
+  des_sharing = parser.state[9];
+  des_priority = parser.state[10];
+  for (int ii = 0; ii < 8; ii++) {
+    des_sel[ii] = parser.state[FP_SEL_IDX + ii];
+  }
+  interrupts();
+}
+
+void send_hello()
+{
+  Serial.write(ctrl_sync_byte);
+  Serial.write(ctrl_sync_byte);
+  Serial.write(FP_CTRL_HELLO);
+  Serial.write(FP_MAX_VERSION);
+}
+
+void send_version()
+{
+  Serial.write(ctrl_sync_byte);
+  Serial.write(ctrl_sync_byte);
+  Serial.write(FP_CTRL_VERSION);
+  Serial.write(parser.version);
+}
+
+void send_nak()
+{
+  Serial.write(ctrl_sync_byte);
+  Serial.write(ctrl_sync_byte);
+  Serial.write(FP_CTRL_NAK);
+  Serial.write(parser.expected_seq);
+}
+
+void send_baud(byte idx)
+{
+  Serial.write(ctrl_sync_byte);
+  Serial.write(ctrl_sync_byte);
+  Serial.write(FP_CTRL_BAUD);
+  Serial.write(idx);
+}
+
+void set_baud(byte idx)
+{
+  //Finish sending everything at the old baud rate before
+  //switching
+  Serial.flush();
+  Serial.end();
+  baud_idx = idx;
+  Serial.begin(baud_rates[baud_idx]);
+  parser.mode = FP_HUNT;
+}
+
+void handle_ctrl(byte cmd, byte arg)
+{
+  switch (cmd) {
+    case FP_CTRL_PROBE:
+      send_hello();
+      break;
+    case FP_CTRL_VERSION:
+      //Switch versions if we can and tell the host pc
+      //which version we are speaking
+      fp_set_version(&parser, arg);
+      send_version();
+      break;
+    case FP_CTRL_BAUD:
+      //Tell the host pc which baud rate we are switching
+      //to at the old baud rate, then switch and wait for
+      //it to keep the new one
+      if (arg >= num_baud_rates) {
+        send_baud(baud_idx);
+        break;
+      }
+      if (baud_pending && arg == baud_idx) {
+        baud_pending = 0;
+        send_baud(arg);
+        break;
+      }
+      send_baud(arg);
+      set_baud(arg);
+      baud_pending = (arg != 0);
+      baud_time = millis();
+      break;
+    default:
+      //Unknown command, ignore it
+      break;
+  }
+}
+
+void send_state()
+{
+  //Copy the current state with interrupts off so we
+  //don't send half of an update from the hub. Version 3
+  //adds the sequence number of the frame we just applied
+  //and a CRC of the state and sequence number
+  byte state[23];
+  byte len = 21;
+  noInterrupts();
+  state[0] = sync_byte;
+  state[1] = sync_byte;
+  state[2] = cur_forward;
+  state[3] = cur_back;
+  state[4] = cur_left;
+  state[5] = cur_right;
+  state[6] = cur_a;
+  state[7] = cur_b;
+  state[8] = cur_x;
+  state[9] = cur_y;
+  state[10] = cur_slow;
+  state[11] = cur_sharing;
+  state[12] = cur_priority;
+  for (int ii = 0; ii < 8; ii++) {
+    state[13 + ii] = cur_sel[ii];
+  }
+  interrupts();
+  if (parser.version >= 3) {
+    state[21] = parser.seq;
+    byte crc = 0;
+    for (int ii = 2; ii < 22; ii++) {
+      crc = fp_crc8(crc, state[ii]);
+    }
+    state[22] = crc;
+    len = 23;
+  }
+  Serial.write(state, len);
+}
+
 byte handle_msg(byte rec_data)
 {
   switch (cur_state) {